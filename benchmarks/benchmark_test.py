@@ -0,0 +1,235 @@
+"""Benchmarks of the render pipeline.
+
+Run with `invoke benchmark` or `pytest benchmarks --benchmark-json=FILE`, the
+results are written as JSON and can be compared with `pytest-benchmark compare`.
+The equations are taken from corpus/equations.json, a synthetic corpus
+generated from templates by corpus/generate.py. Benchmarks that render
+equations are skipped if the LaTeX tools are not installed.
+"""
+
+from functools import partial
+import json
+import multiprocessing
+from pathlib import Path
+import re
+import shutil
+import time
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import markdown  # noqa: E402
+
+from pelican.plugins.math_svg import database  # noqa: E402
+from pelican.plugins.math_svg.database import (  # noqa: E402
+    get_database,
+    hash_equation,
+    render_cache,
+)
+from pelican.plugins.math_svg.engine import RenderEngine  # noqa: E402
+from pelican.plugins.math_svg.extension import (  # noqa: E402
+    INLINE_MATH_PATTERN,
+    PelicanMathExtension,
+)
+from pelican.plugins.math_svg.main import plan_jobs, run_job  # noqa: E402
+from pelican.plugins.math_svg.optimize import optimize  # noqa: E402
+from pelican.plugins.math_svg.postprocess import postprocess_svg  # noqa: E402
+from pelican.plugins.math_svg.render import (  # noqa: E402
+    render_equations,
+    render_svg,
+)
+from pelican.plugins.math_svg.settings import PelicanMathSettings  # noqa: E402
+
+BENCHMARKS = Path(__file__).parent
+CORPUS = json.loads((BENCHMARKS / "corpus" / "equations.json").read_text())
+FIXTURES = {
+    path.stem: path.read_text() for path in sorted(BENCHMARKS.glob("fixtures/*.svg"))
+}
+
+# rendering the whole corpus would take far too long
+COLD_EQUATIONS = 32
+
+requires_tex = pytest.mark.skipif(
+    any(
+        shutil.which(tool) is None
+        for tool in [PelicanMathSettings().latex_program, "pdfcrop", "dvisvgm"]
+    ),
+    reason="LaTeX tools are not installed",
+)
+
+
+def reset_state():
+    for db in database._databases.values():
+        db.connection.close()
+    database._databases.clear()
+    render_cache.clear()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # the equation database is created in the current directory
+    monkeypatch.chdir(tmp_path)
+    reset_state()
+    yield tmp_path
+    reset_state()
+
+
+@pytest.fixture
+def settings() -> PelicanMathSettings:
+    return PelicanMathSettings()
+
+
+def fill_cache(settings: PelicanMathSettings, svg: str, inline_equations=()):
+    inline_equations = CORPUS["inline"] + list(inline_equations)
+    render_cache.resize(len(inline_equations) + len(CORPUS["display"]))
+    for inline, equations in ((True, inline_equations), (False, CORPUS["display"])):
+        for equation in equations:
+            render_cache.put(
+                (inline, hash_equation(equation), settings.fingerprint),
+                svg,
+            )
+
+
+def build_document() -> str:
+    # paragraphs of ten inline equations, followed by a display equation
+    blocks = []
+    inline = CORPUS["inline"]
+    display = CORPUS["display"]
+    for index in range(0, len(inline), 10):
+        blocks.append(
+            "Some text "
+            + " and ".join(f"${equation}$" for equation in inline[index : index + 10])
+            + "."
+        )
+        blocks.append(f"$$\n{display[(index // 10) % len(display)]}\n$$")
+    return "\n\n".join(blocks)
+
+
+@pytest.mark.parametrize("fixture", list(FIXTURES))
+def test_postprocess(benchmark, settings, fixture):
+    benchmark(postprocess_svg, FIXTURES[fixture], "x", settings)
+
+
+@pytest.mark.parametrize("fixture", list(FIXTURES))
+def test_builtin_optimize(benchmark, fixture):
+    import lxml.etree
+
+    code = FIXTURES[fixture].encode()
+    parser = lxml.etree.ETCompatXMLParser()
+
+    def run():
+        optimize(lxml.etree.fromstring(code, parser=parser), 3)
+
+    benchmark(run)
+
+
+def test_markdown_conversion(benchmark, workdir, settings):
+    fill_cache(settings, FIXTURES["x-squared"])
+    document = build_document()
+    benchmark.extra_info["equations"] = document.count("$") // 2
+    benchmark.extra_info["bytes"] = len(document)
+
+    def convert():
+        md = markdown.Markdown(extensions=[PelicanMathExtension(settings)])
+        return md.convert(document)
+
+    benchmark(convert)
+
+
+# Text that contains many dollar signs but little or no math, a single post like
+# this must not stall the build.
+ADVERSARIAL = {
+    "prices": "It costs $5, or $10 with shipping. " * 2000,
+    "unterminated": "$" + "x " * 50000,
+    "escaped": "$" + "\\$ " * 20000,
+    "double": "$x$$ " * 10000,
+    "backslashes": "$x\\\\$$ " * 10000,
+}
+
+
+@pytest.mark.parametrize("text", list(ADVERSARIAL))
+def test_inline_pattern_adversarial(benchmark, text):
+    # python-markdown compiles inline patterns with these flags
+    pattern = re.compile(INLINE_MATH_PATTERN, re.DOTALL | re.UNICODE)
+    data = ADVERSARIAL[text]
+    benchmark.extra_info["bytes"] = len(data)
+    benchmark(lambda: sum(1 for _ in pattern.finditer(data)))
+
+
+def test_markdown_conversion_adversarial(benchmark, workdir, settings):
+    document = "\n\n".join(ADVERSARIAL.values())
+    pattern = re.compile(INLINE_MATH_PATTERN, re.DOTALL | re.UNICODE)
+    fill_cache(
+        settings,
+        FIXTURES["x-squared"],
+        {match.group(1).strip() for match in pattern.finditer(document)},
+    )
+
+    def convert():
+        md = markdown.Markdown(extensions=[PelicanMathExtension(settings)])
+        return md.convert(document)
+
+    benchmark(convert)
+
+
+def test_render_svg_cache_hit(benchmark, workdir, settings):
+    fill_cache(settings, FIXTURES["x-squared"])
+    equations = iter(CORPUS["inline"] * 1000)
+    benchmark(lambda: render_svg(next(equations), True, settings))
+
+
+def test_render_svg_database_hit(benchmark, workdir, settings):
+    get_database().add_equations_bulk(
+        True,
+        [(equation, FIXTURES["x-squared"]) for equation in CORPUS["inline"]],
+        settings,
+    )
+    render_cache.resize(0)
+    equations = iter(CORPUS["inline"] * 1000)
+    benchmark(lambda: render_svg(next(equations), True, settings))
+    render_cache.resize(settings.cache_size)
+
+
+def render_sync(settings: PelicanMathSettings, equations: list[str], jobs: int):
+    for equation in equations:
+        render_equations([equation], True, settings)
+
+
+def render_pool(settings: PelicanMathSettings, equations: list[str], jobs: int):
+    with multiprocessing.Pool(jobs) as pool:
+        for _ in pool.imap_unordered(
+            partial(run_job, settings=settings),
+            plan_jobs(equations, [], 1),
+        ):
+            pass
+
+
+def render_async(settings: PelicanMathSettings, equations: list[str], jobs: int):
+    settings.jobs = jobs
+    engine = RenderEngine(settings)
+    for equation in equations:
+        engine.submit(equation, True)
+    engine.wait()
+    engine.close()
+
+
+ENGINES = {"sync": render_sync, "pool": render_pool, "async": render_async}
+
+
+@requires_tex
+@pytest.mark.parametrize(
+    "engine,jobs",
+    [("sync", 1), ("pool", 1), ("pool", 2), ("pool", 4), ("async", 2), ("async", 4)],
+)
+def test_cold_render(benchmark, workdir, settings, engine, jobs):
+    equations = CORPUS["inline"][:COLD_EQUATIONS]
+
+    def run():
+        start = time.perf_counter()
+        ENGINES[engine](settings, equations, jobs)
+        benchmark.extra_info["equations_per_second"] = len(equations) / (
+            time.perf_counter() - start
+        )
+
+    benchmark.pedantic(run, setup=reset_state, rounds=1, iterations=1)
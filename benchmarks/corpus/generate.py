@@ -0,0 +1,119 @@
+"""Generate the benchmark corpus of inline and display equations.
+
+Usage: python benchmarks/corpus/generate.py > benchmarks/corpus/equations.json
+
+The equations are built from templates of constructs that are common in
+technical blogs (sub- and superscripts, fractions, sums, integrals, matrices,
+aligned environments, ...), the corpus is synthetic and contains no equations
+of real posts. The generator is deterministic, so the corpus only changes when
+the templates do.
+"""
+
+import json
+import random
+import string
+
+SYMBOLS = ["x", "y", "z", "t", "n", "k", "a", "b", "c", r"\alpha", r"\beta"]
+SYMBOLS += [r"\gamma", r"\lambda", r"\mu", r"\sigma", r"\phi", r"\psi", r"\omega"]
+FUNCTIONS = ["f", "g", "h", r"\sin", r"\cos", r"\exp", r"\log", r"\tanh"]
+OPERATORS = ["+", "-", r"\cdot", r"\times", r"\otimes"]
+RELATIONS = ["=", r"\leq", r"\geq", r"\approx", r"\sim", r"\neq"]
+SETS = [r"\mathbb{R}", r"\mathbb{C}", r"\mathbb{N}", r"\mathbb{Z}", r"\mathcal{H}"]
+
+INLINE_TEMPLATES = [
+    "{s}",
+    "{s}_{{{s}}}",
+    "{s}^{{{n}}}",
+    "{s}_{{{s}}}^{{{n}}}",
+    r"{f}({s})",
+    r"{s} {o} {s}",
+    r"{s} {r} {n}",
+    r"\frac{{{s}}}{{{s}}}",
+    r"\sqrt{{{s}^2 {o} {s}^2}}",
+    r"{s} \in {set}",
+    r"{set}^{{{n}}}",
+    r"\|{s}\|_{{{n}}}",
+    r"\langle {s}, {s} \rangle",
+    r"O({s}^{{{n}}})",
+    r"\mathrm{{d}}{s}",
+    r"\hat{{{s}}}",
+    r"\vec{{{s}}}",
+    r"{f}'({s})",
+    r"\partial_{{{s}}} {f}",
+    r"e^{{i {s} {s}}}",
+    r"{s} \to \infty",
+    r"[{s}, {s}]",
+    r"\{{{s}_{{{s}}}\}}_{{{s}=1}}^{{{n}}}",
+]
+
+DISPLAY_TEMPLATES = [
+    r"\sum_{{{s}=1}}^{{\infty}} \frac{{1}}{{{s}^{{{n}}}}} {r} {f}({n})",
+    (
+        r"\int_{{0}}^{{\infty}} {f}({s}) \, \mathrm{{d}}{s} {r} "
+        r"\frac{{\sqrt{{\pi}}}}{{{n}}}"
+    ),
+    r"\lim_{{{s} \to 0}} \frac{{{f}({s} + h) - {f}({s})}}{{h}}",
+    r"\prod_{{{s}=1}}^{{{n}}} \left(1 {o} \frac{{{s}}}{{{s}}}\right)",
+    (
+        r"{f}({s}) = \begin{{cases}} {s}^{{{n}}} & {s} \geq 0 \\ -{s} & "
+        r"\text{{otherwise}} \end{{cases}}"
+    ),
+    (
+        r"\begin{{pmatrix}} {s} & {s} \\ {s} & {s} \end{{pmatrix}} "
+        r"\begin{{pmatrix}} {s} \\ {s} \end{{pmatrix}}"
+    ),
+    (
+        r"\begin{{aligned}} {s} &= {f}({s}) {o} {s} \\ &{r} {s}^{{{n}}} {o} {n} "
+        r"\end{{aligned}}"
+    ),
+    r"\mathbb{{E}}[{s}] = \int_{{{set}}} {s} \, p({s}) \, \mathrm{{d}}{s}",
+    r"\nabla \cdot \vec{{{s}}} = \frac{{\partial {s}}}{{\partial t}} {o} {s}",
+    (
+        r"\left| \sum_{{{s}}} {s}_{{{s}}} {s}_{{{s}}} \right|^2 {r} \sum_{{{s}}} "
+        r"|{s}_{{{s}}}|^2"
+    ),
+    r"i \hbar \frac{{\partial}}{{\partial t}} \psi = \hat{{H}} \psi {o} {s}",
+    (
+        r"\det \begin{{bmatrix}} {s} & {s} & {s} \\ {s} & {s} & {s} \\ 0 & 0 & 1 "
+        r"\end{{bmatrix}} = {n}"
+    ),
+    (
+        r"{f}({s}) = \sum_{{{s}=0}}^{{{n}}} \binom{{{n}}}{{{s}}} {s}^{{{s}}} (1 - "
+        r"{s})^{{{n} - {s}}}"
+    ),
+    (
+        r"\oint_{{\partial \Omega}} {s} \, \mathrm{{d}}{s} = \iint_{{\Omega}} "
+        r"\nabla \times {s} \, \mathrm{{d}}A"
+    ),
+]
+
+
+# every placeholder of a template is filled independently
+VALUES = {
+    "s": lambda rng: rng.choice(SYMBOLS),
+    "f": lambda rng: rng.choice(FUNCTIONS),
+    "o": lambda rng: rng.choice(OPERATORS),
+    "r": lambda rng: rng.choice(RELATIONS),
+    "set": lambda rng: rng.choice(SETS),
+    "n": lambda rng: str(rng.randint(1, 12)),
+}
+
+
+def fill(template: str, rng: random.Random) -> str:
+    result = ""
+    for literal, field, _, _ in string.Formatter().parse(template):
+        result += literal
+        if field is not None:
+            result += VALUES[field](rng)
+    return result
+
+
+def main():
+    rng = random.Random(0)
+    inline = sorted({fill(rng.choice(INLINE_TEMPLATES), rng) for _ in range(4000)})
+    display = sorted({fill(rng.choice(DISPLAY_TEMPLATES), rng) for _ in range(1000)})
+    print(json.dumps({"inline": inline, "display": display}, indent=1))
+
+
+if __name__ == "__main__":
+    main()
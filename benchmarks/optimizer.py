@@ -0,0 +1,78 @@
+"""Compare the built-in SVG optimizer with scour and svgo.
+
+Usage: python benchmarks/optimizer.py [DIRECTORY_WITH_DVISVGM_OUTPUT]
+
+The plugin has to be importable, run `pip install -e .` in the repository first.
+
+The directory defaults to the fixtures next to this script. The results are
+printed as JSON.
+"""
+
+import json
+from pathlib import Path
+import shutil
+import sys
+import time
+
+import lxml.etree
+
+from pelican.plugins.math_svg.optimize import optimize
+from pelican.plugins.math_svg.render import run_scour, run_svgo
+
+SCOUR_ARGS = [
+    "--strip-xml-prolog",
+    "--remove-descriptions",
+    "--remove-metadata",
+    "--enable-comment-stripping",
+    "--strip-xml-space",
+    "--enable-id-stripping",
+]
+SVGO_ARGS = ["--multipass", "--precision", "5"]
+
+
+def run_builtin(code: str) -> str:
+    doc = lxml.etree.fromstring(
+        code.encode(),
+        parser=lxml.etree.ETCompatXMLParser(),
+    )
+    optimize(doc, 3)
+    return lxml.etree.tostring(doc).decode()
+
+
+def main():
+    if len(sys.argv) > 1:
+        directory = Path(sys.argv[1])
+    else:
+        directory = Path(__file__).parent / "fixtures"
+    inputs = [
+        path.read_text().strip()
+        for path in sorted(directory.glob("**/*.svg"))
+        if path.is_file()
+    ]
+
+    engines = {"builtin": run_builtin}
+    if shutil.which("scour"):
+        engines["scour"] = lambda code: run_scour(code, SCOUR_ARGS)
+    if shutil.which("svgo"):
+        engines["svgo"] = lambda code: run_svgo(code, SVGO_ARGS, True)
+
+    results = {
+        "files": len(inputs),
+        "input_bytes": sum(len(code.encode()) for code in inputs),
+        "engines": {},
+    }
+    for name, engine in engines.items():
+        start = time.perf_counter()
+        outputs = [engine(code) for code in inputs]
+        elapsed = time.perf_counter() - start
+        results["engines"][name] = {
+            "output_bytes": sum(len(code.encode()) for code in outputs),
+            "seconds": elapsed,
+            "seconds_per_file": elapsed / max(len(inputs), 1),
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Compare the PDF and the DVI render pipeline.
+
+Usage: python benchmarks/pipeline.py [BATCH_SIZE]
+
+The plugin has to be importable, run `pip install -e .` in the repository first.
+
+Every equation is rendered with both pipelines, the results are printed as
+JSON. Besides the timings, the dimensions of the SVGs and the number of paths
+are compared to check that both pipelines produce equivalent output. The
+benchmark is skipped if the LaTeX tools are not installed.
+"""
+
+import json
+import shutil
+import sys
+import tempfile
+import time
+
+import lxml.etree
+
+from pelican.plugins.math_svg.render import render_equations
+from pelican.plugins.math_svg.settings import PelicanMathSettings
+
+EQUATIONS = [
+    r"x^2",
+    r"\alpha + \beta = \gamma",
+    r"\frac{a}{b}",
+    r"\int_0^\infty e^{-x^2}\,dx = \frac{\sqrt{\pi}}{2}",
+    r"\sum_{n=1}^{\infty} \frac{1}{n^2} = \frac{\pi^2}{6}",
+    r"\begin{pmatrix} a & b \\ c & d \end{pmatrix}",
+    r"\lim_{h \to 0} \frac{f(x + h) - f(x)}{h}",
+    r"\mathbb{R}^n \times \mathbb{C}",
+]
+REQUIRED_TOOLS = ["dvisvgm", "pdfcrop"]
+
+
+def get_shape(svg: str) -> tuple[float, float, int]:
+    doc = lxml.etree.fromstring(svg.encode())
+    _, _, width, height = (float(value) for value in doc.attrib["viewBox"].split())
+    paths = len(doc.findall(".//{http://www.w3.org/2000/svg}path"))
+    paths += len(doc.findall(".//{http://www.w3.org/2000/svg}use"))
+    return width, height, paths
+
+
+def run_pipeline(
+    pipeline: str,
+    batch_size: int,
+    cache_path: str,
+) -> tuple[float, list[str | None]]:
+    settings = PelicanMathSettings()
+    settings.pipeline = pipeline
+    # render_equations records stage timings in the equation database, keep
+    # them out of the cache of the current directory
+    settings.cache_path = cache_path
+    # optimizers are identical for both pipelines and only add noise
+    settings.optimizer = "builtin"
+
+    start = time.perf_counter()
+    svgs: list[str | None] = []
+    for index in range(0, len(EQUATIONS), batch_size):
+        svgs += render_equations(EQUATIONS[index : index + batch_size], True, settings)
+    return time.perf_counter() - start, svgs
+
+
+def main():
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+    missing = [
+        tool
+        for tool in REQUIRED_TOOLS + [PelicanMathSettings().latex_program]
+        if shutil.which(tool) is None
+    ]
+    if missing:
+        print(f"skipped, missing tools: {', '.join(missing)}")
+        return
+
+    results = {"equations": len(EQUATIONS), "batch_size": batch_size, "pipelines": {}}
+    outputs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for pipeline in ("pdf", "dvi"):
+            seconds, outputs[pipeline] = run_pipeline(pipeline, batch_size, directory)
+            results["pipelines"][pipeline] = {
+                "seconds": seconds,
+                "seconds_per_equation": seconds / len(EQUATIONS),
+                "failed": outputs[pipeline].count(None),
+            }
+
+    differences = []
+    for equation, pdf, dvi in zip(EQUATIONS, outputs["pdf"], outputs["dvi"]):
+        if pdf is None or dvi is None:
+            continue
+        pdf_width, pdf_height, pdf_paths = get_shape(pdf)
+        dvi_width, dvi_height, dvi_paths = get_shape(dvi)
+        differences.append(
+            {
+                "equation": equation,
+                "width": dvi_width / pdf_width - 1.0,
+                "height": dvi_height / pdf_height - 1.0,
+                "paths": dvi_paths - pdf_paths,
+            }
+        )
+    results["speedup"] = (
+        results["pipelines"]["pdf"]["seconds"] / results["pipelines"]["dvi"]["seconds"]
+    )
+    results["differences"] = differences
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
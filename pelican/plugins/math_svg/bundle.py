@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import tarfile
+import uuid
+
+from .database import CachedRender, Database, hash_equation
+from .settings import PelicanMathSettings
+
+# A bundle is an xz compressed tar archive of the renders, stored once per
+# distinct SVG as objects/<sha256>.svg, and a manifest mapping equations to
+# their objects. xz compresses across files, renders share most of their
+# glyphs.
+BUNDLE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+
+
+class BundleError(Exception):
+    pass
+
+
+def add_file(archive: tarfile.TarFile, name: str, data: bytes, mtime: float):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(mtime)
+    archive.addfile(info, io.BytesIO(data))
+
+
+def pack_bundle(db: Database, path: Path, profiles: list[str] | None = None) -> int:
+    # write the renders of some (or all) settings profiles to a bundle,
+    # returns the number of packed renders
+    manifest: dict = {"version": BUNDLE_VERSION, "profiles": {}, "renders": []}
+    objects: set[str] = set()
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+    try:
+        with tarfile.open(tmp_path, "w:xz") as archive:
+            for render in db.fetch_renders(profiles):
+                data = render.rendered.encode()
+                digest = hashlib.sha256(data).hexdigest()
+                if digest not in objects:
+                    add_file(archive, f"objects/{digest}.svg", data, render.updated)
+                    objects.add(digest)
+                manifest["profiles"][render.profile] = None
+                manifest["renders"].append(
+                    {
+                        "inline": render.inline,
+                        "profile": render.profile,
+                        "equation": render.equation,
+                        "object": digest,
+                        "updated": render.updated,
+                    },
+                )
+
+            serialized = db.fetch_profiles()
+            for profile in manifest["profiles"]:
+                manifest["profiles"][profile] = serialized.get(profile)
+            add_file(
+                archive,
+                MANIFEST_NAME,
+                json.dumps(manifest, separators=(",", ":")).encode(),
+                max((entry["updated"] for entry in manifest["renders"]), default=0),
+            )
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    return len(manifest["renders"])
+
+
+def read_bundle(path: Path) -> tuple[dict[str, str], list[CachedRender]]:
+    # settings profiles and renders of a bundle
+    objects: dict[str, str] = {}
+    manifest = None
+    try:
+        with tarfile.open(path, "r:xz") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                fptr = archive.extractfile(member)
+                if member.name == MANIFEST_NAME:
+                    manifest = json.load(fptr)
+                elif member.name.startswith("objects/"):
+                    data = fptr.read()
+                    digest = hashlib.sha256(data).hexdigest()
+                    if member.name != f"objects/{digest}.svg":
+                        raise BundleError(f"corrupt object {member.name} in {path}")
+                    objects[digest] = data.decode()
+    except (tarfile.TarError, EOFError, ValueError) as e:
+        raise BundleError(f"cannot read bundle {path}: {e}") from e
+
+    if manifest is None:
+        raise BundleError(f"missing manifest in {path}")
+    if manifest.get("version") != BUNDLE_VERSION:
+        raise BundleError(f"unsupported bundle version {manifest.get('version')}")
+
+    renders = []
+    for entry in manifest["renders"]:
+        if entry["object"] not in objects:
+            raise BundleError(f"missing object {entry['object']} in {path}")
+        renders.append(
+            CachedRender(
+                entry["inline"],
+                hash_equation(entry["equation"]),
+                entry["profile"],
+                entry["equation"],
+                objects[entry["object"]],
+                entry["updated"],
+            ),
+        )
+    profiles = {
+        profile: serialized
+        for profile, serialized in manifest["profiles"].items()
+        if serialized is not None
+    }
+    return profiles, renders
+
+
+def merge_bundle(
+    db: Database,
+    path: Path,
+    settings: PelicanMathSettings,
+) -> tuple[int, int]:
+    # returns the number of merged and skipped renders
+    profiles, renders = read_bundle(path)
+    return db.merge_renders(renders, profiles, settings)
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+from collections import Counter
+from collections.abc import Callable
+import re
+import zlib
+
+# Compressed renders are stored as BLOBs starting with a header of one codec
+# byte and a four byte dictionary id (0 for none). Renders stored as TEXT are
+# uncompressed.
+CODECS = {"zlib": 1, "zstd": 2}
+HEADER_SIZE = 5
+
+ZLIB_LEVEL = 9
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+ZSTD_LEVEL = 19
+ZSTD_DICTIONARY_SIZE = 64 * 1024
+
+# dictionaries are only trained from enough renders to generalize
+MIN_SAMPLES = 64
+
+RE_TAG = re.compile(r"<[^<>]+>")
+
+
+class CompressionError(Exception):
+    pass
+
+
+def get_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def compress_svg(svg: str, codec: int, dictionary: tuple[int, bytes] | None) -> bytes:
+    dict_id, dict_data = dictionary if dictionary is not None else (0, b"")
+    data = svg.encode()
+
+    if codec == CODECS["zlib"]:
+        if dict_data:
+            compressor = zlib.compressobj(ZLIB_LEVEL, zdict=dict_data)
+        else:
+            compressor = zlib.compressobj(ZLIB_LEVEL)
+        payload = compressor.compress(data) + compressor.flush()
+    elif codec == CODECS["zstd"]:
+        zstandard = get_zstandard()
+        if zstandard is None:
+            raise CompressionError("zstd compression requires zstandard")
+        if dict_data:
+            compressor = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL,
+                dict_data=zstandard.ZstdCompressionDict(dict_data),
+            )
+        else:
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        payload = compressor.compress(data)
+    else:
+        raise CompressionError(f"unknown codec: {codec}")
+
+    return bytes([codec]) + dict_id.to_bytes(4, "big") + payload
+
+
+def get_dictionary_id(data: bytes) -> int:
+    return int.from_bytes(data[1:HEADER_SIZE], "big")
+
+
+def decompress_svg(
+    data: str | bytes | None,
+    get_dictionary: Callable[[int], bytes],
+) -> str | None:
+    if (data is None) or isinstance(data, str):
+        return data
+
+    codec = data[0]
+    dict_id = get_dictionary_id(data)
+    dict_data = get_dictionary(dict_id) if dict_id else b""
+    payload = data[HEADER_SIZE:]
+
+    if codec == CODECS["zlib"]:
+        if dict_data:
+            decompressor = zlib.decompressobj(zdict=dict_data)
+        else:
+            decompressor = zlib.decompressobj()
+        return (decompressor.decompress(payload) + decompressor.flush()).decode()
+
+    if codec == CODECS["zstd"]:
+        zstandard = get_zstandard()
+        if zstandard is None:
+            raise CompressionError("zstd decompression requires zstandard")
+        if dict_data:
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(dict_data),
+            )
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+        return decompressor.decompress(payload).decode()
+
+    raise CompressionError(f"unknown codec: {codec}")
+
+
+def train_zlib_dictionary(samples: list[str], size: int) -> bytes:
+    # zlib has no dictionary training, use the tags (mostly glyph paths) that
+    # occur in most renders, the most valuable ones at the end where they are
+    # the cheapest to reference
+    counts: Counter[str] = Counter()
+    for sample in samples:
+        counts.update(set(RE_TAG.findall(sample)))
+
+    chosen: list[str] = []
+    used = 0
+    for tag, count in sorted(
+        counts.items(),
+        key=lambda item: item[1] * len(item[0]),
+        reverse=True,
+    ):
+        if count < 2:
+            break
+        if used + len(tag) > size:
+            continue
+        chosen.append(tag)
+        used += len(tag)
+    return "".join(reversed(chosen)).encode()
+
+
+def train_dictionary(codec: int, samples: list[str]) -> bytes | None:
+    if len(samples) < MIN_SAMPLES:
+        return None
+
+    if codec == CODECS["zlib"]:
+        return train_zlib_dictionary(samples, ZLIB_DICTIONARY_SIZE) or None
+
+    if codec == CODECS["zstd"]:
+        zstandard = get_zstandard()
+        if zstandard is None:
+            raise CompressionError("zstd compression requires zstandard")
+        try:
+            return zstandard.train_dictionary(
+                ZSTD_DICTIONARY_SIZE,
+                [sample.encode() for sample in samples],
+            ).as_bytes()
+        except zstandard.ZstdError:
+            # too few or too similar samples
+            return None
+
+    raise CompressionError(f"unknown codec: {codec}")
@@ -1,43 +1,431 @@
 from __future__ import annotations
 
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
 import hashlib
+import logging
+import os
 from pathlib import Path
 import sqlite3
+import threading
+import time
+from typing import NamedTuple
 
-from .settings import PelicanMathSettings
+from .compress import (
+    CODECS,
+    HEADER_SIZE,
+    CompressionError,
+    compress_svg,
+    decompress_svg,
+    get_dictionary_id,
+    train_dictionary,
+)
+from .macros import compare_settings, get_used_macros
+from .settings import PelicanMathSettings, fingerprint_settings
+from .stats import StageStats
 
 
 def hash_equation(equation: str) -> str:
     return hashlib.sha256(equation.encode()).hexdigest()
 
 
+class CachedRender(NamedTuple):
+    inline: bool
+    hash: str
+    profile: str
+    equation: str
+    rendered: str
+    # time the render was stored, 0 if unknown
+    updated: float
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class RenderCache:
+    # bounded LRU mapping (inline, equation hash, settings fingerprint) to SVG
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[tuple[bool, str, str], str] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple[bool, str, str]) -> str | None:
+        with self.lock:
+            svg = self.entries.get(key)
+            if svg is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return svg
+
+    def put(self, key: tuple[bool, str, str], svg: str):
+        with self.lock:
+            self.entries[key] = svg
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def resize(self, maxsize: int):
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> CacheInfo:
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+
+render_cache = RenderCache()
+
+
+# maximum number of renders used to train a compression dictionary
+MAX_SAMPLES = 5000
+# equations looked up by a single query of fetch_rendered_equations
+BULK_LOOKUP_SIZE = 500
+
+# one connection per process, connections must not be shared with forked
+# children
+_databases: dict[tuple[int, Path], Database] = {}
+_databases_lock = threading.Lock()
+
+# Connections inherited from the parent process. They must never be closed:
+# closing (or garbage collecting) a connection in a forked child releases the
+# POSIX locks of the parent and may corrupt its WAL. They are kept open and
+# unused until the child exits.
+_inherited: list[Database] = []
+
+
+def forget_databases():
+    global _databases_lock
+    _inherited.extend(_databases.values())
+    _databases.clear()
+    # the lock might have been held by another thread of the parent
+    _databases_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=forget_databases)
+
+
+def get_database_path(settings: PelicanMathSettings | None = None) -> Path:
+    settings = settings or PelicanMathSettings()
+    return Path(settings.cache_path) / "equations.db"
+
+
+def get_database(settings: PelicanMathSettings | None = None) -> Database:
+    key = (os.getpid(), get_database_path(settings).absolute())
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = Database(key[1])
+        db = _databases[key]
+
+    if settings is not None:
+        # renders of a previous profile are carried over before the first
+        # lookup
+        db.add_profile(settings)
+    return db
+
+
 class Database:
-    def __init__(self):
-        path = Path(".cache") / "pelican-math-svg"
-        path.mkdir(exist_ok=True, parents=True)
-        self.connection = sqlite3.connect(path / "equations.db")
+    def __init__(self, path: Path):
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.connection = sqlite3.connect(
+            path,
+            timeout=30.0,
+            check_same_thread=False,
+        )
+        self.lock = threading.RLock()
 
         cursor = self.connection.cursor()
 
+        # WAL allows readers (e.g. Pelican) while the renderer is writing
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute("PRAGMA mmap_size = 268435456")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+
+        self.profiles: set[str] = set()
+        self.dictionaries: dict[int, bytes] = {}
+        self.current_dictionaries: dict[int, tuple[int, bytes] | None] = {}
+        self.migrate()
+
+    def create_tables(self, cursor: sqlite3.Cursor):
         cursor.execute(
-            "CREATE TABLE IF NOT EXISTS inline ("
-            "  hash TEXT PRIMARY KEY CHECK (length(hash) == 64), "
-            "  equation TEXT UNIQUE, "
-            "  rendered TEXT, "
+            "CREATE TABLE IF NOT EXISTS settings_profiles ("
+            "  fingerprint TEXT PRIMARY KEY, "
             "  settings TEXT"
             ")",
         )
 
+        for table in ("inline", "display"):
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "  hash TEXT CHECK (length(hash) == 64), "
+                "  profile TEXT REFERENCES settings_profiles(fingerprint), "
+                "  equation TEXT, "
+                "  rendered TEXT, "
+                "  updated REAL, "
+                "  PRIMARY KEY (hash, profile)"
+                ")",
+            )
+
+        # content files seen by the scanner
         cursor.execute(
-            "CREATE TABLE IF NOT EXISTS display ("
-            "  hash TEXT PRIMARY KEY CHECK (length(hash) == 64), "
-            "  equation TEXT UNIQUE, "
-            "  rendered TEXT, "
-            "  settings TEXT"
+            "CREATE TABLE IF NOT EXISTS sources ("
+            "  path TEXT, "
+            "  profile TEXT REFERENCES settings_profiles(fingerprint), "
+            "  mtime REAL, "
+            "  hash TEXT, "
+            "  PRIMARY KEY (path, profile)"
             ")",
         )
 
-        self.connection.commit()
+        # timings and sizes of the last render of every equation
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS stats ("
+            "  hash TEXT, "
+            "  inline INTEGER, "
+            "  profile TEXT REFERENCES settings_profiles(fingerprint), "
+            "  stage TEXT, "
+            "  seconds REAL, "
+            "  bytes_in INTEGER, "
+            "  bytes_out INTEGER, "
+            "  PRIMARY KEY (hash, inline, profile, stage)"
+            ")",
+        )
+
+        # compression dictionaries of the stored renders
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS dictionaries ("
+            "  id INTEGER PRIMARY KEY, "
+            "  codec INTEGER, "
+            "  data BLOB"
+            ")",
+        )
+
+        # commands and environments used by every equation, renders of
+        # equations that do not use changed macros are kept when only macro
+        # definitions in the preamble change
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS macros ("
+            "  hash TEXT, "
+            "  name TEXT, "
+            "  PRIMARY KEY (hash, name)"
+            ") WITHOUT ROWID",
+        )
+
+        # content-addressed file names of renders (see store.get_svg_name),
+        # valid as long as the render was not updated
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS svg_names ("
+            "  hash TEXT, "
+            "  inline INTEGER, "
+            "  profile TEXT REFERENCES settings_profiles(fingerprint), "
+            "  updated REAL, "
+            "  name TEXT, "
+            "  PRIMARY KEY (hash, inline, profile)"
+            ") WITHOUT ROWID",
+        )
+
+        # cache usage of every Pelican build
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS builds ("
+            "  finished REAL, "
+            "  profile TEXT REFERENCES settings_profiles(fingerprint), "
+            "  hits INTEGER, "
+            "  misses INTEGER"
+            ")",
+        )
+
+    def migrate(self):
+        with self.lock, self.connection:
+            cursor = self.connection.cursor()
+            (version,) = cursor.execute("PRAGMA user_version").fetchone()
+
+            if version == 0:
+                # version 0 stored the serialized settings in every row
+                legacy = [
+                    table
+                    for table in ("inline", "display")
+                    if "settings"
+                    in [
+                        column[1]
+                        for column in cursor.execute(f"PRAGMA table_info({table})")
+                    ]
+                ]
+                for table in legacy:
+                    cursor.execute(f"ALTER TABLE {table} RENAME TO {table}_v0")
+
+                self.create_tables(cursor)
+
+                for table in legacy:
+                    for (serialized,) in cursor.execute(
+                        f"SELECT DISTINCT settings FROM {table}_v0",
+                    ).fetchall():
+                        fingerprint = fingerprint_settings(serialized or "")
+                        cursor.execute(
+                            "INSERT OR IGNORE INTO settings_profiles VALUES (?, ?)",
+                            (fingerprint, serialized),
+                        )
+                        cursor.execute(
+                            f"INSERT OR REPLACE INTO {table} "
+                            "(hash, profile, equation, rendered) "
+                            f"SELECT hash, ?, equation, rendered FROM {table}_v0 "
+                            "WHERE settings IS ?",
+                            (fingerprint, serialized),
+                        )
+                    cursor.execute(f"DROP TABLE {table}_v0")
+
+                cursor.execute("PRAGMA user_version = 2")
+
+            if version == 1:
+                # version 2 records when a render was stored, to merge caches
+                for table in ("inline", "display"):
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN updated REAL")
+                cursor.execute("PRAGMA user_version = 2")
+
+            if version < 3:
+                # version 3 indexes the macros used by the stored equations
+                self.create_tables(cursor)
+                for table in ("inline", "display"):
+                    self.index_macros(
+                        cursor,
+                        [
+                            equation
+                            for (equation,) in cursor.execute(
+                                f"SELECT DISTINCT equation FROM {table}",
+                            ).fetchall()
+                        ],
+                    )
+                cursor.execute("PRAGMA user_version = 3")
+
+            self.create_tables(cursor)
+
+    def index_macros(
+        self,
+        cursor: sqlite3.Connection | sqlite3.Cursor,
+        equations: Iterable[str],
+    ):
+        cursor.executemany(
+            "INSERT OR IGNORE INTO macros VALUES (?, ?)",
+            [
+                (hash_equation(equation), name)
+                for equation in equations
+                for name in get_used_macros(equation)
+            ],
+        )
+
+    def get_dictionary(self, dict_id: int) -> bytes:
+        if dict_id not in self.dictionaries:
+            entry = self.connection.execute(
+                "SELECT data FROM dictionaries WHERE id = ?",
+                (dict_id,),
+            ).fetchone()
+            if entry is None:
+                raise CompressionError(f"missing compression dictionary {dict_id}")
+            self.dictionaries[dict_id] = entry[0]
+        return self.dictionaries[dict_id]
+
+    def get_current_dictionary(self, codec: int) -> tuple[int, bytes] | None:
+        # the newest dictionary is used for new renders
+        if codec not in self.current_dictionaries:
+            entry = self.connection.execute(
+                "SELECT id, data FROM dictionaries WHERE codec = ? "
+                "ORDER BY id DESC LIMIT 1",
+                (codec,),
+            ).fetchone()
+            self.current_dictionaries[codec] = None if entry is None else tuple(entry)
+        return self.current_dictionaries[codec]
+
+    def encode(
+        self,
+        rendered: str | None,
+        settings: PelicanMathSettings,
+    ) -> str | bytes | None:
+        if (rendered is None) or (settings.compression == "none"):
+            return rendered
+        codec = CODECS[settings.compression]
+        return compress_svg(rendered, codec, self.get_current_dictionary(codec))
+
+    def decode(self, rendered: str | bytes | None) -> str | None:
+        return decompress_svg(rendered, self.get_dictionary)
+
+    def add_profile(self, settings: PelicanMathSettings):
+        if settings.fingerprint in self.profiles:
+            return
+
+        with self.lock, self.connection:
+            added = self.connection.execute(
+                "INSERT OR IGNORE INTO settings_profiles VALUES (?, ?)",
+                (settings.fingerprint, settings.serialize()),
+            ).rowcount
+            if added:
+                self.carry_over(settings)
+        self.profiles.add(settings.fingerprint)
+
+    def carry_over(
+        self,
+        settings: PelicanMathSettings,
+        logger: logging.Logger = logging.getLogger(__name__ + ".carry_over"),
+    ) -> int:
+        # Copy the renders of the newest profile that only differs in macro
+        # definitions to a new profile, except for equations using changed
+        # macros. Those are added unrendered. Returns the number of copied
+        # renders.
+        serialized = settings.serialize()
+        for fingerprint, other in self.connection.execute(
+            "SELECT fingerprint, settings FROM settings_profiles "
+            "WHERE fingerprint != ? ORDER BY rowid DESC",
+            (settings.fingerprint,),
+        ).fetchall():
+            try:
+                changed = compare_settings(other or "", serialized)
+            except ValueError:
+                # profiles of old versions
+                continue
+            if changed is None:
+                continue
+
+            names = sorted(changed)
+            affected = (
+                "SELECT hash FROM macros "
+                f"WHERE name IN ({', '.join('?' * len(names))})"
+            )
+            copied = 0
+            invalidated = 0
+            for table in ("inline", "display"):
+                copied += self.connection.execute(
+                    f"INSERT OR IGNORE INTO {table} "
+                    f"SELECT hash, ?, equation, rendered, updated FROM {table} "
+                    "WHERE profile = ? AND rendered IS NOT NULL "
+                    f"AND hash NOT IN ({affected})",
+                    [settings.fingerprint, fingerprint] + names,
+                ).rowcount
+                invalidated += self.connection.execute(
+                    f"INSERT OR IGNORE INTO {table} "
+                    f"SELECT hash, ?, equation, NULL, NULL FROM {table} "
+                    f"WHERE profile = ? AND hash IN ({affected})",
+                    [settings.fingerprint, fingerprint] + names,
+                ).rowcount
+            logger.info(
+                f"Kept {copied} renders of settings profile {fingerprint}, "
+                f"{invalidated} equations use changed macros: {', '.join(names)}",
+            )
+            return copied
+        return 0
 
     def add_equation(
         self,
@@ -46,61 +434,459 @@ class Database:
         settings: PelicanMathSettings,
         rendered: str | None = None,
     ):
-        hash = hash_equation(equation)
-        cursor = self.connection.cursor()
+        self.add_equations_bulk(inline, [(equation, rendered)], settings)
 
-        if inline:
-            cursor.execute(
-                "INSERT OR REPLACE INTO inline VALUES (?, ?, ?, ?)",
-                (hash, equation, rendered, settings.serialize()),
+    def add_equations_bulk(
+        self,
+        inline: bool,
+        equations: list[tuple[str, str | None]],
+        settings: PelicanMathSettings,
+    ):
+        self.add_profile(settings)
+        table = "inline" if inline else "display"
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        hash_equation(equation),
+                        settings.fingerprint,
+                        equation,
+                        self.encode(rendered, settings),
+                        None if rendered is None else now,
+                    )
+                    for equation, rendered in equations
+                ],
             )
-        else:
-            cursor.execute(
-                "INSERT OR REPLACE INTO display VALUES (?, ?, ?, ?)",
-                (hash, equation, rendered, settings.serialize()),
+            self.index_macros(self.connection, [equation for equation, _ in equations])
+
+    def add_missing_equations(
+        self,
+        inline: bool,
+        equations: list[str],
+        settings: PelicanMathSettings,
+    ):
+        # like add_equations_bulk but keeps existing renders
+        self.add_profile(settings)
+        table = "inline" if inline else "display"
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f"INSERT OR IGNORE INTO {table} VALUES (?, ?, ?, NULL, NULL)",
+                [
+                    (hash_equation(equation), settings.fingerprint, equation)
+                    for equation in equations
+                ],
+            )
+            self.index_macros(self.connection, equations)
+
+    def fetch_source(
+        self,
+        path: str,
+        settings: PelicanMathSettings,
+    ) -> tuple[float, str] | None:
+        entry = self.connection.execute(
+            "SELECT mtime, hash FROM sources WHERE path = ? AND profile = ?",
+            (path, settings.fingerprint),
+        ).fetchone()
+        if entry:
+            return entry[0], entry[1]
+
+        return None
+
+    def update_source(
+        self,
+        path: str,
+        mtime: float,
+        hash: str,
+        settings: PelicanMathSettings,
+    ):
+        self.add_profile(settings)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                (path, settings.fingerprint, mtime, hash),
             )
-        self.connection.commit()
 
     def fetch_rendered_equation(
         self,
         inline: bool,
         equation: str,
-    ) -> tuple[str | None, str | None]:
-        hash = hash_equation(equation)
-        cursor = self.connection.cursor()
-        if inline:
-            cursor.execute(
-                "SELECT rendered, settings FROM inline WHERE hash = ?",
-                (hash,),
-            )
-        else:
-            cursor.execute(
-                "SELECT rendered, settings FROM display WHERE hash = ?",
-                (hash,),
+        settings: PelicanMathSettings,
+    ) -> str | None:
+        table = "inline" if inline else "display"
+        entry = self.connection.execute(
+            f"SELECT rendered FROM {table} WHERE hash = ? AND profile = ?",
+            (hash_equation(equation), settings.fingerprint),
+        ).fetchone()
+        if entry:
+            return self.decode(entry[0])
+
+        return None
+
+    def fetch_rendered_hashes(
+        self,
+        inline: bool,
+        hashes: list[str],
+        settings: PelicanMathSettings,
+    ) -> dict[str, str]:
+        # renders of several equation hashes at once, missing ones are left out
+        table = "inline" if inline else "display"
+        renders: dict[str, str] = {}
+        # stay below the limit of 999 variables of older SQLite versions
+        for start in range(0, len(hashes), BULK_LOOKUP_SIZE):
+            batch = hashes[start : start + BULK_LOOKUP_SIZE]
+            for hash, rendered in self.connection.execute(
+                f"SELECT hash, rendered FROM {table} WHERE profile = ? "
+                f"AND rendered IS NOT NULL AND hash IN ({', '.join('?' * len(batch))})",
+                [settings.fingerprint] + batch,
+            ):
+                renders[hash] = self.decode(rendered)
+        return renders
+
+    def fetch_rendered_equations(
+        self,
+        inline: bool,
+        equations: Iterable[str],
+        settings: PelicanMathSettings,
+    ) -> dict[str, str]:
+        # renders of several equations at once, missing ones are left out
+        hashes = {hash_equation(equation): equation for equation in equations}
+        return {
+            hashes[hash]: rendered
+            for hash, rendered in self.fetch_rendered_hashes(
+                inline,
+                list(hashes),
+                settings,
+            ).items()
+        }
+
+    def fetch_svg_names(
+        self,
+        inline: bool,
+        settings: PelicanMathSettings,
+    ) -> list[tuple[str, str | None]]:
+        # equation hash and file name of every render, the name is None if it
+        # was not recorded yet or the render changed since
+        table = "inline" if inline else "display"
+        return self.connection.execute(
+            f"SELECT r.hash, n.name FROM {table} r LEFT JOIN svg_names n "
+            "ON n.hash = r.hash AND n.inline = ? AND n.profile = r.profile "
+            "AND n.updated IS r.updated "
+            "WHERE r.profile = ? AND r.rendered IS NOT NULL",
+            (inline, settings.fingerprint),
+        ).fetchall()
+
+    def add_svg_names(
+        self,
+        inline: bool,
+        names: list[tuple[str, str]],
+        settings: PelicanMathSettings,
+    ):
+        table = "inline" if inline else "display"
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO svg_names "
+                f"SELECT hash, ?, profile, updated, ? FROM {table} "
+                "WHERE hash = ? AND profile = ?",
+                [(inline, name, hash, settings.fingerprint) for hash, name in names],
             )
-        entry = cursor.fetchone()
-        self.connection.commit()
+
+    def fetch_equation(
+        self,
+        inline: bool,
+        hash: str,
+        settings: PelicanMathSettings,
+    ) -> tuple[str, str | None] | None:
+        # equation and render (if any) for an equation hash
+        table = "inline" if inline else "display"
+        entry = self.connection.execute(
+            f"SELECT equation, rendered FROM {table} WHERE hash = ? AND profile = ?",
+            (hash, settings.fingerprint),
+        ).fetchone()
         if entry:
-            return entry[0], entry[1]
+            return entry[0], self.decode(entry[1])
+
+        return None
+
+    def add_stats(
+        self,
+        inline: bool,
+        stats: list[tuple[str, list[StageStats]]],
+        settings: PelicanMathSettings,
+    ):
+        self.add_profile(settings)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        hash_equation(equation),
+                        inline,
+                        settings.fingerprint,
+                        entry.stage,
+                        entry.seconds,
+                        entry.bytes_in,
+                        entry.bytes_out,
+                    )
+                    for equation, entries in stats
+                    for entry in entries
+                ],
+            )
+
+    def fetch_stats(self, settings: PelicanMathSettings) -> list[StageStats]:
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "SELECT stage, seconds, bytes_in, bytes_out FROM stats WHERE profile = ?",
+            (settings.fingerprint,),
+        )
+        return [StageStats(*entry) for entry in cursor.fetchall()]
+
+    def fetch_slowest(
+        self,
+        settings: PelicanMathSettings,
+        count: int,
+    ) -> list[tuple[bool, str, float]]:
+        # inline flag, hash and total render time of the slowest equations
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "SELECT inline, hash, SUM(seconds) AS total FROM stats "
+            "WHERE profile = ? GROUP BY hash, inline ORDER BY total DESC LIMIT ?",
+            (settings.fingerprint, count),
+        )
+        return [(bool(entry[0]), entry[1], entry[2]) for entry in cursor.fetchall()]
 
-        return None, None
+    def add_build(self, hits: int, misses: int, settings: PelicanMathSettings):
+        self.add_profile(settings)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO builds VALUES (?, ?, ?, ?)",
+                (time.time(), settings.fingerprint, hits, misses),
+            )
 
-    def fetch_missing_inline(self) -> list[str]:
+    def fetch_builds(
+        self,
+        settings: PelicanMathSettings,
+    ) -> list[tuple[float, int, int]]:
         cursor = self.connection.cursor()
-        cursor.execute("SELECT equation FROM inline WHERE rendered IS NULL")
+        cursor.execute(
+            "SELECT finished, hits, misses FROM builds "
+            "WHERE profile = ? ORDER BY finished",
+            (settings.fingerprint,),
+        )
+        return [(entry[0], entry[1], entry[2]) for entry in cursor.fetchall()]
+
+    def fetch_missing_inline(self, settings: PelicanMathSettings) -> list[str]:
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "SELECT equation FROM inline WHERE rendered IS NULL AND profile = ?",
+            (settings.fingerprint,),
+        )
         return [entry[0] for entry in cursor.fetchall()]
 
-    def fetch_missing_display(self) -> list[str]:
+    def fetch_missing_display(self, settings: PelicanMathSettings) -> list[str]:
         cursor = self.connection.cursor()
-        cursor.execute("SELECT equation FROM display WHERE rendered IS NULL")
+        cursor.execute(
+            "SELECT equation FROM display WHERE rendered IS NULL AND profile = ?",
+            (settings.fingerprint,),
+        )
         return [entry[0] for entry in cursor.fetchall()]
 
-    def fetch_rendered_inline(self) -> list[tuple[str, str]]:
+    def fetch_rendered_inline(
+        self,
+        settings: PelicanMathSettings,
+    ) -> list[tuple[str, str]]:
         cursor = self.connection.cursor()
-        cursor.execute("SELECT hash, rendered FROM inline WHERE rendered IS NOT NULL")
-        return [(entry[0], entry[1]) for entry in cursor.fetchall()]
+        cursor.execute(
+            "SELECT hash, rendered FROM inline "
+            "WHERE rendered IS NOT NULL AND profile = ?",
+            (settings.fingerprint,),
+        )
+        return [(entry[0], self.decode(entry[1])) for entry in cursor.fetchall()]
 
-    def fetch_rendered_display(self) -> list[tuple[str, str]]:
+    def fetch_rendered_display(
+        self,
+        settings: PelicanMathSettings,
+    ) -> list[tuple[str, str]]:
         cursor = self.connection.cursor()
-        cursor.execute("SELECT hash, rendered FROM display WHERE rendered IS NOT NULL")
-        return [(entry[0], entry[1]) for entry in cursor.fetchall()]
+        cursor.execute(
+            "SELECT hash, rendered FROM display "
+            "WHERE rendered IS NOT NULL AND profile = ?",
+            (settings.fingerprint,),
+        )
+        return [(entry[0], self.decode(entry[1])) for entry in cursor.fetchall()]
+
+    def fetch_profiles(self) -> dict[str, str]:
+        # serialized settings of every profile, keyed by fingerprint
+        return dict(
+            self.connection.execute(
+                "SELECT fingerprint, settings FROM settings_profiles",
+            ).fetchall(),
+        )
+
+    def fetch_renders(
+        self,
+        profiles: list[str] | None = None,
+    ) -> Iterator[CachedRender]:
+        # all renders, optionally only those of some settings profiles
+        for inline, table in ((True, "inline"), (False, "display")):
+            query = (
+                f"SELECT hash, profile, equation, rendered, updated FROM {table} "
+                "WHERE rendered IS NOT NULL"
+            )
+            if profiles is not None:
+                query += f" AND profile IN ({', '.join('?' * len(profiles))})"
+            cursor = self.connection.execute(query, profiles or [])
+            while entries := cursor.fetchmany(1000):
+                for hash, profile, equation, rendered, updated in entries:
+                    yield CachedRender(
+                        inline,
+                        hash,
+                        profile,
+                        equation,
+                        self.decode(rendered),
+                        updated or 0.0,
+                    )
+
+    def merge_renders(
+        self,
+        renders: Iterable[CachedRender],
+        profiles: dict[str, str],
+        settings: PelicanMathSettings,
+    ) -> tuple[int, int]:
+        # Add renders of another cache, existing renders are only replaced by
+        # newer ones. Returns the number of merged and skipped renders.
+        merged = 0
+        skipped = 0
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO settings_profiles VALUES (?, ?)",
+                profiles.items(),
+            )
+            for render in renders:
+                table = "inline" if render.inline else "display"
+                entry = self.connection.execute(
+                    f"SELECT rendered IS NOT NULL, updated FROM {table} "
+                    "WHERE hash = ? AND profile = ?",
+                    (render.hash, render.profile),
+                ).fetchone()
+                if entry and entry[0] and ((entry[1] or 0.0) >= render.updated):
+                    skipped += 1
+                    continue
+                self.connection.execute(
+                    f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?, ?)",
+                    (
+                        render.hash,
+                        render.profile,
+                        render.equation,
+                        self.encode(render.rendered, settings),
+                        render.updated,
+                    ),
+                )
+                merged += 1
+                self.index_macros(self.connection, [render.equation])
+        return merged, skipped
+
+    def recompress(self, settings: PelicanMathSettings, train: bool = True) -> int:
+        # Store all renders with the configured compression, optionally with a
+        # new dictionary trained from the existing renders. Returns the number
+        # of converted renders.
+        if train and settings.compression != "none":
+            codec = CODECS[settings.compression]
+            samples = [
+                self.decode(entry[0])
+                for table in ("inline", "display")
+                for entry in self.connection.execute(
+                    f"SELECT rendered FROM {table} WHERE rendered IS NOT NULL "
+                    "ORDER BY random() LIMIT ?",
+                    (MAX_SAMPLES,),
+                ).fetchall()
+            ]
+            data = train_dictionary(codec, samples)
+            if data is not None:
+                with self.lock, self.connection:
+                    self.connection.execute(
+                        "INSERT INTO dictionaries (codec, data) VALUES (?, ?)",
+                        (codec, data),
+                    )
+                self.current_dictionaries.pop(codec, None)
+
+        converted = 0
+        for table in ("inline", "display"):
+            cursor = self.connection.execute(
+                f"SELECT rowid, rendered FROM {table} WHERE rendered IS NOT NULL",
+            )
+            while entries := cursor.fetchmany(1000):
+                with self.lock, self.connection:
+                    self.connection.executemany(
+                        f"UPDATE {table} SET rendered = ? WHERE rowid = ?",
+                        [
+                            (self.encode(self.decode(rendered), settings), rowid)
+                            for rowid, rendered in entries
+                        ],
+                    )
+                converted += len(entries)
+        return converted
+
+    def vacuum(self, settings: PelicanMathSettings, prune: bool = True) -> int:
+        # Compact the database, optionally dropping everything stored for other
+        # settings profiles. Returns the number of removed profiles.
+        removed = 0
+        with self.lock, self.connection:
+            if prune:
+                for table in (
+                    "inline",
+                    "display",
+                    "sources",
+                    "stats",
+                    "builds",
+                    "svg_names",
+                ):
+                    self.connection.execute(
+                        f"DELETE FROM {table} WHERE profile != ?",
+                        (settings.fingerprint,),
+                    )
+                removed = self.connection.execute(
+                    "DELETE FROM settings_profiles WHERE fingerprint != ?",
+                    (settings.fingerprint,),
+                ).rowcount
+                self.profiles &= {settings.fingerprint}
+
+            # macros and file names of equations that are not stored anymore
+            self.connection.execute(
+                "DELETE FROM macros WHERE hash NOT IN "
+                "(SELECT hash FROM inline UNION SELECT hash FROM display)",
+            )
+            for inline, table in ((1, "inline"), (0, "display")):
+                self.connection.execute(
+                    "DELETE FROM svg_names WHERE inline = ? AND NOT EXISTS "
+                    f"(SELECT 1 FROM {table} AS r WHERE r.hash = svg_names.hash "
+                    "AND r.profile = svg_names.profile)",
+                    (inline,),
+                )
+
+            # dictionaries that no render refers to anymore
+            used: set[int] = set()
+            for table in ("inline", "display"):
+                used.update(
+                    get_dictionary_id(entry[0])
+                    for entry in self.connection.execute(
+                        f"SELECT DISTINCT substr(rendered, 1, {HEADER_SIZE}) "
+                        f"FROM {table} WHERE typeof(rendered) = 'blob'",
+                    )
+                )
+            for (dict_id,) in self.connection.execute(
+                "SELECT id FROM dictionaries",
+            ).fetchall():
+                if dict_id not in used:
+                    self.connection.execute(
+                        "DELETE FROM dictionaries WHERE id = ?",
+                        (dict_id,),
+                    )
+            self.dictionaries.clear()
+            self.current_dictionaries.clear()
+
+        with self.lock:
+            self.connection.execute("VACUUM")
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import Future
+import logging
+from pathlib import Path
+import re
+import threading
+from xml.sax.saxutils import escape
+
+from .database import get_database, hash_equation
+from .normalize import patch_title
+from .render import render_equations, render_fallback, store_svg
+from .settings import PelicanMathSettings
+from .store import svg_markup
+
+# Placeholders are HTML comments, they are escaped in feeds. They contain the
+# hash of the stored equation and, if it was normalized, the hash of the
+# equation as written.
+RE_PLACEHOLDER = re.compile(
+    r"<!--math-svg:(inline|display):([0-9a-f]{64})(?::([0-9a-f]{64}))?-->"
+)
+RE_ESCAPED_PLACEHOLDER = re.compile(
+    r"&lt;!--math-svg:(inline|display):([0-9a-f]{64})(?::([0-9a-f]{64}))?--&gt;"
+)
+
+_engine: RenderEngine | None = None
+_engine_lock = threading.Lock()
+
+# files written by Pelican that may contain placeholders
+_written: set[Path] = set()
+_written_lock = threading.Lock()
+
+
+# inline flag, hash of the stored equation and hash of the equation as written
+PlaceholderKey = tuple[bool, str, str]
+
+
+def get_placeholder(key: PlaceholderKey) -> str:
+    inline, hash, source_hash = key
+    suffix = "" if source_hash == hash else f":{source_hash}"
+    return f"<!--math-svg:{'inline' if inline else 'display'}:{hash}{suffix}-->"
+
+
+def get_placeholder_key(match: re.Match) -> PlaceholderKey:
+    return (
+        match.group(1) == "inline",
+        match.group(2),
+        match.group(3) or match.group(2),
+    )
+
+
+class RenderEngine:
+    # renders equations on a background event loop while Pelican keeps parsing
+    def __init__(self, settings: PelicanMathSettings):
+        self.settings = settings
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(max(settings.jobs, 1))
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.lock = threading.Lock()
+        self.sources: dict[PlaceholderKey, str] = {}
+        self.tasks: dict[tuple[bool, str], Future] = {}
+
+    def submit(self, equation: str, inline: bool, source: str | None = None) -> str:
+        # source is the equation as written if equation is its normalized form
+        source = equation if source is None else source
+        key = (inline, hash_equation(equation))
+        with self.lock:
+            if key not in self.tasks:
+                # the unrendered equation is stored immediately, the render CLI
+                # picks it up if the build is interrupted
+                get_database(self.settings).add_missing_equations(
+                    inline, [equation], self.settings
+                )
+                self.tasks[key] = asyncio.run_coroutine_threadsafe(
+                    self.render(equation, inline),
+                    self.loop,
+                )
+            placeholder_key = (inline, key[1], hash_equation(source))
+            self.sources[placeholder_key] = source
+        return get_placeholder(placeholder_key)
+
+    async def render(self, equation: str, inline: bool) -> str | None:
+        async with self.semaphore:
+            svg = (
+                await asyncio.to_thread(
+                    render_equations,
+                    [equation],
+                    inline,
+                    self.settings,
+                )
+            )[0]
+
+        if svg is not None:
+            store_svg(equation, inline, self.settings, svg)
+        return svg
+
+    def wait(
+        self,
+        logger: logging.Logger = logging.getLogger(__name__ + ".RenderEngine.wait"),
+    ) -> dict[PlaceholderKey, str]:
+        # Markup of all submitted equations. Renders that raised (e.g. because
+        # a LaTeX tool is missing) get the fallback markup of the sync engine,
+        # no placeholder may remain in the written files.
+        markups: dict[PlaceholderKey, str] = {}
+        failed: set[tuple[bool, str]] = set()
+        for key, source in list(self.sources.items()):
+            try:
+                svg = self.tasks[key[:2]].result()
+            except Exception as e:
+                if key[:2] not in failed:
+                    logger.error(f"error rendering formula ${source}$: {e!r}")
+                    failed.add(key[:2])
+                svg = None
+            if svg is None:
+                markups[key] = render_fallback(source)
+                continue
+            if key[1] != key[2]:
+                svg = patch_title(svg, source, self.settings)
+            markups[key] = svg_markup(svg, source, self.settings)
+        return markups
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def get_engine(settings: PelicanMathSettings) -> RenderEngine:
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = RenderEngine(settings)
+        return _engine
+
+
+def add_written(path: str | Path):
+    with _written_lock:
+        _written.add(Path(path))
+
+
+def resolve_markup(
+    markups: dict[PlaceholderKey, str],
+    key: PlaceholderKey,
+    settings: PelicanMathSettings,
+) -> str | None:
+    # Placeholders restored from Pelican's content cache were not submitted
+    # during this build, look them up in the database instead. The equation
+    # as written is not stored, the title shows the normalized equation.
+    if key not in markups:
+        entry = get_database(settings).fetch_equation(key[0], key[1], settings)
+        if entry is None:
+            return None
+        equation, svg = entry
+        if svg is None:
+            markups[key] = render_fallback(equation)
+        else:
+            markups[key] = svg_markup(svg, equation, settings)
+    return markups[key]
+
+
+def fill_placeholders(
+    paths: list[Path],
+    markups: dict[PlaceholderKey, str],
+    settings: PelicanMathSettings,
+    logger: logging.Logger = logging.getLogger(__name__ + ".fill_placeholders"),
+) -> int:
+    def replace(match: re.Match) -> str:
+        markup = resolve_markup(markups, get_placeholder_key(match), settings)
+        return match.group(0) if markup is None else markup
+
+    def replace_escaped(match: re.Match) -> str:
+        markup = resolve_markup(markups, get_placeholder_key(match), settings)
+        return match.group(0) if markup is None else escape(markup)
+
+    filled = 0
+    for path in paths:
+        if not path.exists():
+            continue
+        code = path.read_text(encoding="utf-8")
+        if "math-svg:" not in code:
+            continue
+
+        code = RE_PLACEHOLDER.sub(replace, code)
+        code = RE_ESCAPED_PLACEHOLDER.sub(replace_escaped, code)
+        path.write_text(code, encoding="utf-8")
+        logger.debug(f"Filled equations into {path}")
+        filled += 1
+    return filled
+
+
+def finish_engine(settings: PelicanMathSettings) -> int:
+    # wait for all renders and fill them into the written files, returns the
+    # number of changed files
+    global _engine
+    with _engine_lock:
+        engine, _engine = _engine, None
+
+    markups: dict[PlaceholderKey, str] = {}
+    if engine is not None:
+        markups = engine.wait()
+        engine.close()
+
+    with _written_lock:
+        paths = sorted(_written)
+        _written.clear()
+    return fill_placeholders(paths, markups, settings)
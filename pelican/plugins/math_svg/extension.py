@@ -1,8 +1,20 @@
 import markdown
 
-from .markdown_extension import DisplayMathProcessor, InlineMathProcessor
+from .markdown_extension import (
+    DisplayMathProcessor,
+    InlineMathProcessor,
+    MathPreprocessor,
+    PageEquations,
+)
 from .settings import PelicanMathSettings
 
+# A $ that is not preceded by \ or $, followed by the equation up to the next
+# $ that is not preceded by \ and not followed by $. The lookahead captures the
+# longest possible equation and the backreference consumes it without
+# backtracking, starting with a literal $ lets the regex engine skip directly
+# to candidate positions.
+INLINE_MATH_PATTERN = r"\$(?<![\\$]\$)(?=[^$])(?=([^$]*(?:(?<=\\)\$[^$]*)*))\1\$(?!\$)"
+
 
 class PelicanMathExtension(markdown.Extension):
     def __init__(self, settings: PelicanMathSettings):
@@ -12,17 +24,23 @@ class PelicanMathExtension(markdown.Extension):
 
     def extendMarkdown(self, md: markdown.core.Markdown):
         md.registerExtension(self)
+
+        # state of the document converted by this Markdown instance, Pelican
+        # shares the extension between its Markdown instances
+        page = PageEquations(self.settings)
+        # after fenced code blocks and raw HTML have been stashed
+        md.preprocessors.register(MathPreprocessor(page, md), "math_prefetch", 10)
         md.inlinePatterns.register(
             InlineMathProcessor(
-                r"(?<!\\|\$)\$((?:[^$]|\\\$)+)(?<!\\)\$(?!\$)",
-                self.settings,
+                INLINE_MATH_PATTERN,
+                page,
                 md,
             ),
             "inline_math",
             200,
         )
         md.parser.blockprocessors.register(
-            DisplayMathProcessor(self.settings, md.parser),
+            DisplayMathProcessor(page, md.parser),
             "display_math",
             200,
         )
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import uuid
+
+from .settings import PelicanMathSettings
+
+# formats that are known to exist (or to be broken) in this process
+_formats: dict[str, Path | None] = {}
+
+
+def get_format_dir(settings: PelicanMathSettings) -> Path:
+    return Path.cwd() / settings.cache_path / "formats"
+
+
+def get_format_name(settings: PelicanMathSettings) -> str:
+    digest = hashlib.sha256(settings.serialize().encode()).hexdigest()
+    return f"preamble-{digest[:16]}"
+
+
+def build_format(
+    settings: PelicanMathSettings,
+    preamble: list[str],
+    logger: logging.Logger = logging.getLogger(__name__ + ".build_format"),
+) -> Path | None:
+    # LuaTeX cannot dump the Lua state that mylatexformat leaves behind
+    if Path(settings.latex_program).name.startswith(("lualatex", "luatex")):
+        logger.warning(
+            f"LaTeX formats are not supported with {settings.latex_program}, "
+            "use pdflatex or xelatex to enable MATH_SVG['latex']['format']"
+        )
+        return None
+
+    name = get_format_name(settings)
+    format_dir = get_format_dir(settings)
+    format_path = format_dir / f"{name}.fmt"
+    if format_path.exists():
+        return format_path
+
+    # build in a private directory and move the result into place afterwards,
+    # several workers might try to build the same format at the same time
+    build_dir = format_dir / f"{name}-{uuid.uuid4().hex}"
+    build_dir.mkdir(parents=True)
+
+    texfile_path = build_dir / "preamble.tex"
+    with open(texfile_path, "w") as fptr:
+        fptr.write("\n".join(preamble + [r"\begin{document}", r"\end{document}"]))
+
+    cmd = (
+        [
+            settings.latex_program,
+            "--ini",
+            f"--jobname={name}",
+            f"--output-directory={build_dir}",
+        ]
+        + settings.latex_args
+        + [
+            f"&{settings.latex_program}",
+            "mylatexformat.ltx",
+            f'"{texfile_path}"',
+        ]
+    )
+    logger.debug(f"{cmd=}")
+    try:
+        output = subprocess.check_output(cmd, cwd=build_dir).decode()
+        for line in output.splitlines():
+            logger.debug(line)
+        os.replace(build_dir / f"{name}.fmt", format_path)
+    except (subprocess.CalledProcessError, OSError) as e:
+        logger.warning(f"failed to build LaTeX format {name}: {e}")
+        logger.warning("rendering without precompiled preamble")
+        return None
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    logger.debug(f"Built LaTeX format {format_path}")
+    return format_path
+
+
+def ensure_format(
+    settings: PelicanMathSettings,
+    preamble: list[str],
+    logger: logging.Logger = logging.getLogger(__name__ + ".ensure_format"),
+) -> Path | None:
+    name = get_format_name(settings)
+    if name not in _formats:
+        _formats[name] = build_format(settings, preamble, logger)
+    return _formats[name]
+
+
+def get_format_env(format_path: Path) -> dict[str, str]:
+    env = os.environ.copy()
+    # the trailing separator keeps the default search path of kpathsea
+    env["TEXFORMATS"] = (
+        str(format_path.parent)
+        + os.pathsep
+        + env.get(
+            "TEXFORMATS",
+            "",
+        )
+    )
+    return env
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import json
+import re
+
+# control words, control symbols and environments used by an equation
+RE_CONTROL_SEQUENCE = re.compile(r"\\[A-Za-z]+|\\.", re.DOTALL)
+RE_ENVIRONMENT = re.compile(r"\\begin\s*\{([^{}]*)\}")
+
+# Preamble lines defining a single new command or environment. Redefinitions
+# (\renewcommand, \def, \let, ...) might change commands used internally
+# by packages, they are treated like any other preamble line.
+RE_COMMAND_DEFINITION = re.compile(
+    r"\\(?:newcommand|providecommand|DeclareMathOperator|"
+    r"(?:New|Provide)DocumentCommand)\*?\s*\{?\s*(\\(?:[A-Za-z]+|.))",
+)
+RE_ENVIRONMENT_DEFINITION = re.compile(
+    r"\\(?:newenvironment|NewDocumentEnvironment)\*?\s*\{([^{}]*)\}",
+)
+RE_DEFINITION_COMMAND = re.compile(
+    r"\\(?:(?:re)?new(?:command|environment)|providecommand|DeclareMathOperator|"
+    r"(?:New|Renew|Provide|Declare)Document(?:Command|Environment)|[egx]?def|let)"
+    r"(?![A-Za-z])",
+)
+
+
+def environment_name(name: str) -> str:
+    return f"\\begin{{{name.strip()}}}"
+
+
+def get_used_macros(code: str) -> set[str]:
+    return set(RE_CONTROL_SEQUENCE.findall(code)) | {
+        environment_name(name) for name in RE_ENVIRONMENT.findall(code)
+    }
+
+
+def get_definition(line: str) -> str | None:
+    # name of the command or environment defined by a preamble line, None if
+    # the line does something else (or more than that)
+    if ("@" in line) or (len(RE_DEFINITION_COMMAND.findall(line)) != 1):
+        return None
+    match = RE_COMMAND_DEFINITION.match(line.strip())
+    if match:
+        return match.group(1)
+    match = RE_ENVIRONMENT_DEFINITION.match(line.strip())
+    if match:
+        return environment_name(match.group(1))
+    return None
+
+
+def parse_preamble(preamble: list[str]) -> tuple[list[str], dict[str, str]]:
+    # lines that are not definitions and definitions by name
+    others: list[str] = []
+    definitions: dict[str, str] = {}
+    for line in preamble:
+        name = get_definition(line)
+        if (name is None) or (name in definitions):
+            others.append(line)
+        else:
+            definitions[name] = line
+    return others, definitions
+
+
+def get_changed_macros(old: list[str], new: list[str]) -> set[str] | None:
+    # Commands and environments whose definition differs between two
+    # preambles, including those defined in terms of them. None if the
+    # preambles differ in something else than definitions.
+    old_others, old_definitions = parse_preamble(old)
+    new_others, new_definitions = parse_preamble(new)
+    if old_others != new_others:
+        return None
+
+    changed = {
+        name
+        for name in old_definitions.keys() | new_definitions.keys()
+        if old_definitions.get(name) != new_definitions.get(name)
+    }
+    while True:
+        dependent = {
+            name
+            for name, line in new_definitions.items()
+            if (name not in changed) and (get_used_macros(line) & changed)
+        }
+        if not dependent:
+            return changed
+        changed |= dependent
+
+
+def compare_settings(old: str, new: str) -> set[str] | None:
+    # changed macros between two serialized settings, None if the settings
+    # differ in more than macro definitions
+    old_obj = json.loads(old)
+    new_obj = json.loads(new)
+    old_preamble = old_obj.get("latex", {}).pop("preamble", [])
+    new_preamble = new_obj.get("latex", {}).pop("preamble", [])
+    if old_obj != new_obj:
+        return None
+    return get_changed_macros(old_preamble, new_preamble)
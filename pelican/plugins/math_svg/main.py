@@ -1,63 +1,525 @@
+from __future__ import annotations
+
 from functools import partial
 import logging
 import multiprocessing
+from multiprocessing.pool import AsyncResult
 from pathlib import Path
+import sys
+import time
+from typing import NamedTuple
 
 import typer
 
 from pelican import get_instance, parse_arguments
 
-from .database import Database
-from .markdown_extension import render_svg
+from .bundle import BundleError, merge_bundle, pack_bundle
+from .database import get_database, get_database_path
+from .latex_format import ensure_format
+from .render import generate_preamble, render_equations, split_batches
+from .scan import scan_sources
 from .settings import PelicanMathSettings
+from .stats import (
+    BATCH_STAGES,
+    EQUATION_STAGES,
+    StageStats,
+    compression_ratio,
+    format_table,
+    percentile,
+)
+from .store import SPRITE_NAME, SpriteStore, get_svg_name, sprite_svg, write_svgs
+from .workqueue import MAX_ATTEMPTS, QueuedJob, WorkQueue, get_worker_id
 
 app = typer.Typer()
+queue_app = typer.Typer(help="Distribute rendering over several hosts.")
+app.add_typer(queue_app, name="queue")
+cache_app = typer.Typer(help="Share rendered equations between machines.")
+app.add_typer(cache_app, name="cache")
+
+
+class Job(NamedTuple):
+    inline: bool
+    equations: list[str]
+
+
+def plan_jobs(
+    inline: list[str],
+    display: list[str],
+    batch_size: int,
+) -> list[Job]:
+    # Start with the long display equations, they take longest to render and
+    # would otherwise stall the last workers at the end of the run.
+    jobs = [
+        Job(False, batch)
+        for batch in split_batches(sorted(display, key=len, reverse=True), batch_size)
+    ]
+    jobs += [
+        Job(True, batch)
+        for batch in split_batches(sorted(inline, key=len, reverse=True), batch_size)
+    ]
+    return jobs
+
+
+def run_job(job: Job, settings: PelicanMathSettings) -> tuple[Job, list[str | None]]:
+    return job, render_equations(job.equations, job.inline, settings)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def report_progress(done: int, total: int, elapsed: float, final: bool = False):
+    rate = done / elapsed if elapsed > 0 else 0.0
+    eta = format_duration((total - done) / rate) if rate > 0 else "?"
+    end = "\n" if final or not sys.stderr.isatty() else "\r"
+    print(
+        f"{done}/{total} equations, {rate:.1f} equations/s, ETA {eta}",
+        end=end,
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+def run_worker(
+    queue: WorkQueue,
+    settings: PelicanMathSettings,
+    processes: int,
+    poll: float = 5.0,
+) -> tuple[int, int]:
+    # Render jobs of the queue until it is empty, returns the number of
+    # rendered and failed equations. Jobs leased by other workers are waited
+    # for, their leases may expire.
+    worker = get_worker_id()
+    running: dict[int, tuple[QueuedJob, AsyncResult]] = {}
+    rendered = 0
+    failed = 0
+
+    last_claim = 0.0
+    last_renewal = time.monotonic()
+    with multiprocessing.Pool(processes) as pool:
+        while True:
+            now = time.monotonic()
+            if (len(running) < processes) and (now - last_claim >= poll):
+                while len(running) < processes:
+                    job = queue.claim(worker, settings)
+                    if job is None:
+                        # do not hammer the shared queue while it is empty
+                        last_claim = now
+                        break
+                    running[job.id] = (
+                        job,
+                        pool.apply_async(
+                            render_equations,
+                            (job.equations, job.inline, settings),
+                        ),
+                    )
+
+            if not running:
+                status = queue.status(settings)
+                if status.pending + status.leased == 0:
+                    break
+                time.sleep(poll)
+                continue
+
+            for id, (job, result) in list(running.items()):
+                if not result.ready():
+                    continue
+                svgs = result.get()
+                queue.finish(job, svgs, settings)
+                del running[id]
+                # a slot is free, claim the next job right away
+                last_claim = 0.0
+                failed += svgs.count(None)
+                rendered += len(svgs) - svgs.count(None)
+
+            if running and (now - last_renewal >= queue.lease / 3):
+                queue.renew(worker, list(running))
+                last_renewal = now
+
+            time.sleep(0.1)
+
+    return rendered, failed
 
 
 @app.command()
-def render(jobs: int = typer.Option(multiprocessing.cpu_count(), "-j")):
+def render(
+    jobs: int = typer.Option(multiprocessing.cpu_count(), "-j"),
+    batch_size: int = typer.Option(
+        1,
+        "--batch-size",
+        help="Number of equations rendered by a single LaTeX run.",
+    ),
+    worker: Path | None = typer.Option(
+        None,
+        "--worker",
+        metavar="QUEUE",
+        help="Render the jobs of a shared work queue instead of the database.",
+    ),
+):
     pelican, _ = get_instance(parse_arguments([]))
     settings = PelicanMathSettings.from_settings(pelican)
 
-    db = Database()
+    if settings.latex_format:
+        # build the format once before the workers start
+        ensure_format(settings, generate_preamble(settings, True))
+
+    if worker is not None:
+        work_queue = WorkQueue(worker)
+        rendered, failed = run_worker(work_queue, settings, jobs)
+        print(f"rendered {rendered} equations")
+        if failed:
+            print(f"failed to render {failed} equations")
+        status = work_queue.status(settings)
+        if status.other_profiles:
+            print(
+                f"skipped {status.other_profiles} jobs of other settings, check that "
+                "all hosts use the same configuration and plugin version",
+            )
+        return
+
+    db = get_database(settings)
 
-    missing = db.fetch_missing_inline()
+    # Results are committed as soon as a job finishes, an interrupted run
+    # continues with the equations that are still missing.
+    planned = plan_jobs(
+        db.fetch_missing_inline(settings),
+        db.fetch_missing_display(settings),
+        batch_size,
+    )
+    total = sum(len(job.equations) for job in planned)
+    rendered = {True: 0, False: 0}
+    failed = 0
+    done = 0
+
+    start = time.perf_counter()
+    last_report = start
     with multiprocessing.Pool(jobs) as pool:
-        rendered = pool.map(
-            partial(render_svg, inline=True, settings=settings),
-            missing,
+        for job, svgs in pool.imap_unordered(
+            partial(run_job, settings=settings),
+            planned,
+        ):
+            results = [
+                (eq, svg) for eq, svg in zip(job.equations, svgs) if svg is not None
+            ]
+            db.add_equations_bulk(job.inline, results, settings)
+            rendered[job.inline] += len(results)
+            failed += len(job.equations) - len(results)
+            done += len(job.equations)
+
+            now = time.perf_counter()
+            if now - last_report >= 1.0:
+                report_progress(done, total, now - start)
+                last_report = now
+    report_progress(done, total, time.perf_counter() - start, final=True)
+
+    print(f"rendered {rendered[True]} inline equations")
+    print(f"rendered {rendered[False]} display equations")
+    if failed:
+        print(f"failed to render {failed} equations")
+
+
+def print_queue_status(queue: WorkQueue, settings: PelicanMathSettings):
+    status = queue.status(settings)
+    print(
+        f"{status.pending} jobs pending, {status.leased} leased, "
+        f"{status.abandoned} abandoned after {MAX_ATTEMPTS} attempts, "
+        f"{status.results} renders to merge",
+    )
+    if status.other_profiles:
+        print(f"{status.other_profiles} jobs of other settings")
+
+
+@queue_app.command("push")
+def queue_push(
+    queue: Path,
+    batch_size: int = typer.Option(
+        1,
+        "--batch-size",
+        help="Number of equations rendered by a single LaTeX run.",
+    ),
+):
+    pelican, _ = get_instance(parse_arguments([]))
+    settings = PelicanMathSettings.from_settings(pelican)
+
+    db = get_database(settings)
+    work_queue = WorkQueue(queue)
+    added = work_queue.push(
+        [
+            (job.inline, job.equations)
+            for job in plan_jobs(
+                db.fetch_missing_inline(settings),
+                db.fetch_missing_display(settings),
+                batch_size,
+            )
+        ],
+        settings,
+    )
+    print(f"queued {added} equations")
+    print_queue_status(work_queue, settings)
+
+
+@queue_app.command("status")
+def queue_status(queue: Path):
+    pelican, _ = get_instance(parse_arguments([]))
+    settings = PelicanMathSettings.from_settings(pelican)
+
+    print_queue_status(WorkQueue(queue), settings)
+
+
+@queue_app.command("merge")
+def queue_merge(queue: Path):
+    pelican, _ = get_instance(parse_arguments([]))
+    settings = PelicanMathSettings.from_settings(pelican)
+
+    db = get_database(settings)
+    work_queue = WorkQueue(queue)
+    results = work_queue.take_results(settings)
+    for inline in (True, False):
+        db.add_equations_bulk(
+            inline,
+            [
+                (equation, rendered)
+                for kind, equation, rendered in results
+                if (kind == inline) and (rendered is not None)
+            ],
+            settings,
         )
-    for equation, render in zip(missing, rendered):
-        db.add_equation(True, equation, settings, render)
-    print(f"rendered {len(rendered)} inline equations")
 
-    missing = db.fetch_missing_inline()
-    with multiprocessing.Pool(jobs) as pool:
-        rendered = pool.map(
-            partial(render_svg, inline=False, settings=settings),
-            missing,
+    failed = sum(1 for _, _, rendered in results if rendered is None)
+    print(f"merged {len(results) - failed} renders")
+    if failed:
+        print(f"{failed} equations failed to render")
+    print_queue_status(work_queue, settings)
+
+
+@app.command()
+def scan():
+    pelican, _ = get_instance(parse_arguments([]))
+    settings = PelicanMathSettings.from_settings(pelican)
+
+    result = scan_sources(
+        Path(pelican.settings["PATH"]),
+        settings,
+        get_database(settings),
+        pelican.settings.get("IGNORE_FILES", []),
+    )
+    print(
+        f"scanned {result.scanned} files ({result.skipped} unchanged), "
+        f"found {result.inline} inline and {result.display} display equations",
+    )
+
+
+def format_ms(seconds: float) -> str:
+    return f"{seconds * 1000:.1f}ms"
+
+
+@app.command()
+def stats(
+    slowest: int = typer.Option(10, help="Number of slowest equations to list."),
+):
+    pelican, _ = get_instance(parse_arguments([]))
+    settings = PelicanMathSettings.from_settings(pelican)
+
+    db = get_database(settings)
+
+    entries = db.fetch_stats(settings)
+    if not entries:
+        print("no render statistics recorded")
+        return
+
+    stages: dict[str, list[StageStats]] = {}
+    for entry in entries:
+        stages.setdefault(entry.stage, []).append(entry)
+
+    rows = []
+    for stage in BATCH_STAGES + EQUATION_STAGES:
+        if stage not in stages:
+            continue
+        seconds = [entry.seconds for entry in stages[stage]]
+        ratio = compression_ratio(stages[stage])
+        rows.append(
+            [
+                stage,
+                str(len(seconds)),
+                format_ms(percentile(seconds, 50)),
+                format_ms(percentile(seconds, 95)),
+                format_ms(percentile(seconds, 99)),
+                f"{sum(seconds):.2f}s",
+                "" if ratio is None else f"{ratio:.1%}",
+            ],
+        )
+    print(
+        format_table(
+            ["stage", "count", "p50", "p95", "p99", "total", "size out/in"],
+            rows,
+        ),
+    )
+    print("(times of latex, pdfcrop and dvisvgm are split between batched equations)")
+
+    print()
+    print(f"slowest {slowest} equations:")
+    for inline, hash, seconds in db.fetch_slowest(settings, slowest):
+        entry = db.fetch_equation(inline, hash, settings)
+        equation = hash if entry is None else " ".join(entry[0].split())
+        if len(equation) > 60:
+            equation = equation[:57] + "..."
+        kind = "inline" if inline else "display"
+        print(f"  {format_ms(seconds):>10}  {kind:<7}  {equation}")
+
+    builds = db.fetch_builds(settings)
+    if builds:
+        hits = sum(build[1] for build in builds)
+        lookups = hits + sum(build[2] for build in builds)
+        print()
+        print(
+            f"render cache: {hits}/{lookups} hits "
+            f"({hits / max(lookups, 1):.1%}) in {len(builds)} builds",
         )
-    for equation, render in zip(missing, rendered):
-        db.add_equation(False, equation, settings, render)
-    print(f"rendered {len(rendered)} display equations")
+
+
+def get_database_size(settings: PelicanMathSettings) -> int:
+    path = get_database_path(settings)
+    return sum(
+        candidate.stat().st_size
+        for candidate in (path, path.with_name(path.name + "-wal"))
+        if candidate.exists()
+    )
+
+
+@app.command()
+def migrate(
+    train: bool = typer.Option(
+        True,
+        help="Train a new compression dictionary from the stored renders.",
+    ),
+):
+    pelican, _ = get_instance(parse_arguments([]))
+    settings = PelicanMathSettings.from_settings(pelican)
+
+    converted = get_database(settings).recompress(settings, train)
+    print(f"stored {converted} renders with {settings.compression} compression")
+    print("run pelican-math-svg vacuum to reclaim the freed space")
 
 
 @app.command()
-def export(output: Path):
-    db = Database()
+def vacuum(
+    prune: bool = typer.Option(
+        True,
+        help="Remove the renders of settings profiles other than the current one.",
+    ),
+):
+    pelican, _ = get_instance(parse_arguments([]))
+    settings = PelicanMathSettings.from_settings(pelican)
+
+    size = get_database_size(settings)
+    removed = get_database(settings).vacuum(settings, prune)
+    print(
+        f"removed {removed} stale settings profiles, database size "
+        f"{size / 1e6:.1f} MB -> {get_database_size(settings) / 1e6:.1f} MB",
+    )
+
+
+@cache_app.command("pack")
+def cache_pack(
+    output: Path,
+    all_profiles: bool = typer.Option(
+        False,
+        "--all",
+        help="Include the renders of all settings profiles, not only the current one.",
+    ),
+):
+    pelican, _ = get_instance(parse_arguments([]))
+    settings = PelicanMathSettings.from_settings(pelican)
+
+    packed = pack_bundle(
+        get_database(settings),
+        output,
+        None if all_profiles else [settings.fingerprint],
+    )
+    print(
+        f"packed {packed} renders into {output} ({output.stat().st_size / 1e6:.1f} MB)"
+    )
+
+
+@cache_app.command("merge")
+def cache_merge(bundles: list[Path]):
+    pelican, _ = get_instance(parse_arguments([]))
+    settings = PelicanMathSettings.from_settings(pelican)
+
+    db = get_database(settings)
+    for bundle in bundles:
+        try:
+            merged, skipped = merge_bundle(db, bundle, settings)
+        except BundleError as e:
+            print(f"error: {e}", file=sys.stderr)
+            raise typer.Exit(1)
+        print(f"{bundle}: merged {merged} renders, kept {skipped} existing renders")
+
+
+@app.command()
+def export(
+    output: Path,
+    prune: bool = typer.Option(
+        True,
+        help="Remove SVG files of renders that are no longer in the database.",
+    ),
+    layout: str = typer.Option(
+        "equation",
+        help='"equation" writes inline/ and display/ directories with files '
+        'named after the equation hash, "content" names the files after their '
+        'content like the "img" and "object" output modes.',
+    ),
+):
+    if layout not in ("content", "equation"):
+        raise typer.BadParameter(f"unknown layout: {layout}", param_hint="--layout")
+
+    pelican, _ = get_instance(parse_arguments([]))
+    settings = PelicanMathSettings.from_settings(pelican)
+
+    db = get_database(settings)
+
+    renders = {
+        "inline": db.fetch_rendered_inline(settings),
+        "display": db.fetch_rendered_display(settings),
+    }
+
+    sprite = SpriteStore()
+    if settings.output == "sprite":
+        # the exported files reference the sprite in the export directory
+        url = SPRITE_NAME if layout == "content" else f"../{SPRITE_NAME}"
+        renders = {
+            kind: [
+                (hash, sprite_svg(rendered, sprite, url, settings.builtin_precision))
+                for hash, rendered in entries
+            ]
+            for kind, entries in renders.items()
+        }
 
-    dir_inline = output / "inline"
-    dir_display = output / "display"
-    dir_inline.mkdir(exist_ok=True, parents=True)
-    dir_display.mkdir(exist_ok=True, parents=True)
+    if layout == "content":
+        directories = {
+            output: {
+                get_svg_name(rendered): rendered
+                for entries in renders.values()
+                for _, rendered in entries
+            },
+        }
+    else:
+        directories = {
+            output / kind: {f"{hash}.svg": rendered for hash, rendered in entries}
+            for kind, entries in renders.items()
+        }
 
-    for hash, rendered in db.fetch_rendered_inline():
-        with open((dir_inline / hash).with_suffix(".svg"), "w") as fptr:
-            fptr.write(rendered)
+    written = sum(
+        write_svgs(directory, svgs, prune) for directory, svgs in directories.items()
+    )
+    total = sum(len(svgs) for svgs in directories.values())
+    print(f"exported {written} new SVG files ({total} in total)")
 
-    for hash, rendered in db.fetch_rendered_display():
-        with open((dir_display / hash).with_suffix(".svg"), "w") as fptr:
-            fptr.write(rendered)
+    if settings.output == "sprite":
+        added = sprite.write(output)
+        print(f"added {added} glyphs to {output / SPRITE_NAME}")
 
 
 if __name__ == "__main__":
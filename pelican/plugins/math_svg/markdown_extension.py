@@ -3,22 +3,62 @@ from xml.etree import ElementTree
 
 from markdown.blockprocessors import BlockProcessor
 from markdown.inlinepatterns import InlineProcessor
+from markdown.preprocessors import Preprocessor
 
-from .render import render_svg
+from .render import prefetch_svgs, render_markup
 from .settings import PelicanMathSettings
 
 
+class PageEquations:
+    # equations of the document that is being converted
+    def __init__(self, settings: PelicanMathSettings):
+        self.settings = settings
+        self.prefetched: dict[bool, dict[str, str | None]] = {True: {}, False: {}}
+        self.placeholders: dict[tuple[bool, str], str] = {}
+
+    def reset(self):
+        self.prefetched = {True: {}, False: {}}
+        self.placeholders.clear()
+
+    def store(self, md, math: str, inline: bool) -> str:
+        # repeated equations share a single stash entry
+        key = (inline, math)
+        if key not in self.placeholders:
+            self.placeholders[key] = md.htmlStash.store(
+                render_markup(math, inline, self.settings, self.prefetched[inline]),
+            )
+        return self.placeholders[key]
+
+
+class MathPreprocessor(Preprocessor):
+    # collects the equations of a document and resolves them at once
+    def __init__(self, page: PageEquations, md=None):
+        super().__init__(md)
+        self.page = page
+
+    def run(self, lines):
+        # imported here, the scanner depends on this module
+        from .scan import extract_equations
+
+        self.page.reset()
+        inline, display = extract_equations("\n".join(lines))
+        self.page.prefetched = {
+            True: prefetch_svgs(inline, True, self.page.settings),
+            False: prefetch_svgs(display, False, self.page.settings),
+        }
+        return lines
+
+
 class InlineMathProcessor(InlineProcessor):
-    def __init__(self, pattern, settings: PelicanMathSettings, md=None):
+    def __init__(self, pattern, page: PageEquations, md=None):
         super().__init__(pattern, md)
-        self.settings = settings
+        self.page = page
 
     def handleMatch(self, m, data):
-        equation = m.group(1).strip()
-        svg = render_svg(self.unescape(equation), True, self.settings)
+        equation = self.unescape(m.group(1).strip())
         element = ElementTree.Element("span")
         element.set("class", "math")
-        element.text = self.md.htmlStash.store(svg)
+        element.text = self.page.store(self.md, equation, True)
         return element, m.start(0), m.end(0)
 
 
@@ -26,9 +66,9 @@ class DisplayMathProcessor(BlockProcessor):
     RE_START = re.compile(r"^\s*\$\$\s*\n")
     RE_END = re.compile(r"\n\s*\$\$\s*$")
 
-    def __init__(self, settings: PelicanMathSettings, parser) -> None:
+    def __init__(self, page: PageEquations, parser) -> None:
         super().__init__(parser)
-        self.settings = settings
+        self.page = page
 
     def test(self, parent, block):
         return self.RE_START.match(block)
@@ -47,8 +87,10 @@ class DisplayMathProcessor(BlockProcessor):
 
                 element = ElementTree.SubElement(parent, "div")
                 element.set("class", "math")
-                element.text = self.parser.md.htmlStash.store(
-                    render_svg(stripped_block.strip(), False, self.settings),
+                element.text = self.page.store(
+                    self.parser.md,
+                    stripped_block.strip(),
+                    False,
                 )
                 # self.parser.parseBlocks(element, blocks[0 : block_index + 1])
 
@@ -1,16 +1,142 @@
+import logging
+import os
+from pathlib import Path
+from weakref import WeakKeyDictionary
+
 from pelican import Pelican
 import pelican.plugins.signals
 
+from .database import get_database, render_cache
 from .extension import PelicanMathExtension
 from .settings import PelicanMathSettings
+from .store import SPRITE_NAME, get_svg_name, sprite_store, svg_store
+from .workers import close_svgo_servers
+
+# settings of every Pelican instance, built once when it is initialized so
+# that all signal handlers use the same settings profile
+_settings: WeakKeyDictionary[Pelican, PelicanMathSettings] = WeakKeyDictionary()
+
+
+def get_settings(sender: Pelican) -> PelicanMathSettings:
+    if sender not in _settings:
+        _settings[sender] = PelicanMathSettings.from_settings(sender)
+    return _settings[sender]
 
 
 def init_math(sender: Pelican):
-    settings = PelicanMathSettings.from_settings(sender)
+    settings = get_settings(sender)
+    render_cache.resize(settings.cache_size)
     sender.settings["MARKDOWN"].setdefault("extensions", []).append(
         PelicanMathExtension(settings),
     )
 
+    if settings.engine == "async":
+        pelican.plugins.signals.content_written.connect(track_written)
+        pelican.plugins.signals.feed_written.connect(track_written)
+
+
+def track_written(path: str, **kwargs):
+    from .engine import add_written
+
+    add_written(path)
+
+
+def fill_equations(sender: Pelican):
+    settings = get_settings(sender)
+    if settings.engine != "async":
+        return
+
+    # asyncio is only imported when the async engine is used
+    from .engine import finish_engine
+
+    filled = finish_engine(settings)
+    logging.getLogger(__name__ + ".fill_equations").debug(
+        f"filled equations into {filled} files",
+    )
+
+
+def report_cache(sender: Pelican):
+    settings = get_settings(sender)
+    info = render_cache.info()
+    get_database(settings).add_build(info.hits, info.misses, settings)
+    logging.getLogger(__name__ + ".report_cache").info(
+        f"math-svg cache: {info.hits} hits, {info.misses} misses, "
+        f"{info.currsize}/{info.maxsize} entries",
+    )
+
+
+def add_stored_renders(settings: PelicanMathSettings, directory: Path):
+    # Pages restored from Pelican's content cache reference the files (or
+    # glyphs) of renders that were not looked up during this build. Add all
+    # stored renders of the settings whose files are missing, e.g. after the
+    # output directory was cleaned.
+    if settings.output not in ("img", "object", "sprite"):
+        return
+    if (settings.output == "sprite") and (directory / SPRITE_NAME).exists():
+        return
+
+    db = get_database(settings)
+
+    if settings.output == "sprite":
+        from .store import sprite_svg
+
+        for _, rendered in db.fetch_rendered_inline(
+            settings,
+        ) + db.fetch_rendered_display(settings):
+            sprite_svg(
+                rendered,
+                sprite_store,
+                f"{settings.output_url}/{SPRITE_NAME}",
+                settings.builtin_precision,
+            )
+        return
+
+    # the file names are recorded in the database, only renders whose files
+    # are missing (or whose names are unknown) are decoded
+    existing = set(os.listdir(directory)) if directory.is_dir() else set()
+    for inline in (True, False):
+        missing = [
+            hash
+            for hash, name in db.fetch_svg_names(inline, settings)
+            if (name is None) or (name not in existing)
+        ]
+        names = []
+        for hash, rendered in db.fetch_rendered_hashes(
+            inline,
+            missing,
+            settings,
+        ).items():
+            name = get_svg_name(rendered)
+            if name not in existing:
+                svg_store.add(rendered)
+            names.append((hash, name))
+        db.add_svg_names(inline, names, settings)
+
+
+def write_svg_files(sender: Pelican):
+    settings = get_settings(sender)
+    directory = Path(sender.output_path) / settings.output_dir
+    logger = logging.getLogger(__name__ + ".write_svg_files")
+
+    if sender.settings.get("LOAD_CONTENT_CACHE", False):
+        add_stored_renders(settings, directory)
+
+    written = svg_store.write(directory)
+    logger.debug(f"wrote {written} SVG files")
+
+    added = sprite_store.write(directory)
+    logger.debug(f"added {added} glyphs to the sprite")
+
+
+def close_workers(sender: Pelican):
+    # svgo servers are started again by the next build (e.g. with autoreload)
+    close_svgo_servers()
+
 
 def register():
     pelican.plugins.signals.initialized.connect(init_math)
+    # equations have to be filled in before their SVG files are written
+    pelican.plugins.signals.finalized.connect(fill_equations)
+    pelican.plugins.signals.finalized.connect(write_svg_files)
+    pelican.plugins.signals.finalized.connect(report_cache)
+    pelican.plugins.signals.finalized.connect(close_workers)
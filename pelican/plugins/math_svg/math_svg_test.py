@@ -1,5 +1,847 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+from pathlib import Path
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import lxml.etree
+import markdown
+
+from . import database, engine, latex_format, main, render, workers
+from .bundle import merge_bundle, pack_bundle
+from .compress import CODECS, compress_svg, decompress_svg, train_zlib_dictionary
+from .database import Database, RenderCache, get_database, hash_equation, render_cache
+from .extension import INLINE_MATH_PATTERN, PelicanMathExtension
+from .main import plan_jobs
+from .math_svg import add_stored_renders
+from .normalize import normalize_equation, patch_title
+from .optimize import optimize, parse_path, shorten_path_data, to_absolute
+from .postprocess import postprocess_svg, resolve_transform
+from .scan import extract_equations, scan_sources
+from .scratch import get_workspace, prune_failed
+from .settings import PelicanMathSettings
+from .stats import StageStats, amortize, percentile
+from .store import SpriteStore, get_svg_name, sprite_svg, svg_store
+from .workqueue import WorkQueue
+
 # from pelican.plugins import math_svg
 
 
 def test_regex_inline():
-    pass
+    # the pattern must match exactly like the original, simpler pattern
+    reference = re.compile(
+        r"(?<!\\|\$)\$((?:[^$]|\\\$)+)(?<!\\)\$(?!\$)", re.DOTALL | re.UNICODE
+    )
+    pattern = re.compile(INLINE_MATH_PATTERN, re.DOTALL | re.UNICODE)
+
+    rng = random.Random(0)
+    texts = [r"$x$", r"$$x$$", r"\$x$", r"$x\$ y$", r"$x$$", r"a $5 and $6", "$a\nb$"]
+    texts += [
+        "".join(rng.choice("$$\\ab \n") for _ in range(rng.randint(0, 24)))
+        for _ in range(5000)
+    ]
+    for text in texts:
+        # python-markdown searches from the end of the previous match
+        for start in range(len(text) + 1):
+            expected = reference.search(text, start)
+            match = pattern.search(text, start)
+            assert (match and (match.span(), match.group(1))) == (
+                expected and (expected.span(), expected.group(1))
+            ), (text, start)
+
+
+def path_points(data: str) -> list[tuple[float, float]]:
+    points = []
+    x, y = 0.0, 0.0
+    for command, parameters in to_absolute(parse_path(data)):
+        if command == "H":
+            x = parameters[0]
+        elif command == "V":
+            y = parameters[0]
+        elif command != "Z":
+            x, y = parameters[-2], parameters[-1]
+        points.append((x, y))
+    return points
+
+
+def test_shorten_path_data():
+    data = "M1.5 2.25L3.0004 2.25L3.0004 4C3.1 4.2 3.3 4.4 3.5 4.5Z m1 1 2 2"
+    shortened = shorten_path_data(data, 3)
+    assert len(shortened) < len(data)
+    for original, result in zip(path_points(data), path_points(shortened)):
+        assert abs(original[0] - result[0]) < 1e-3
+        assert abs(original[1] - result[1]) < 1e-3
+
+
+def test_optimize_keeps_referenced_ids():
+    doc = lxml.etree.fromstring(
+        b"<svg xmlns='http://www.w3.org/2000/svg' "
+        b"xmlns:xlink='http://www.w3.org/1999/xlink' version='1.1'>"
+        b"<metadata>x</metadata>"
+        b"<defs><path id='g0-1' d='M0 0L1 1'/></defs><defs/>"
+        b"<g id='page1'><use x='1.00001' y='2' xlink:href='#g0-1'/></g>"
+        b"<title>$x$</title></svg>",
+    )
+    optimize(doc, 3)
+    code = lxml.etree.tostring(doc).decode()
+    assert 'id="g0-1"' in code
+    assert "page1" not in code
+    assert "metadata" not in code
+    assert code.count("<defs") == 1
+    assert "<g" not in code
+    assert 'x="1"' in code
+    assert "<title>$x$</title>" in code
+
+
+def test_render_cache_evicts_least_recently_used():
+    cache = RenderCache(2)
+    cache.put((True, "a", "s"), "<svg>a</svg>")
+    cache.put((True, "b", "s"), "<svg>b</svg>")
+    assert cache.get((True, "a", "s")) == "<svg>a</svg>"
+    cache.put((True, "c", "s"), "<svg>c</svg>")
+    assert cache.get((True, "b", "s")) is None
+    assert cache.get((False, "a", "s")) is None
+    assert cache.info() == (1, 2, 2, 2)
+
+
+def test_plan_jobs_starts_with_long_display_equations():
+    jobs = plan_jobs(["a", "abc"], ["x", "x+y"], 1)
+    assert [(job.inline, job.equations) for job in jobs] == [
+        (False, ["x+y"]),
+        (False, ["x"]),
+        (True, ["abc"]),
+        (True, ["a"]),
+    ]
+
+
+def test_percentile_uses_nearest_rank():
+    values = [float(value) for value in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile(values[:3], 95) == 3.0
+    assert amortize(StageStats("latex", 1.0, 100, 40), 4) == StageStats(
+        "latex", 0.25, 25, 10
+    )
+
+
+def test_prune_failed_keeps_newest_jobs(tmp_path):
+    for index, name in enumerate(["old", "middle", "new"]):
+        job = tmp_path / "failed" / name
+        job.mkdir(parents=True)
+        (job / "render.log").write_text("x" * 100)
+        os.utime(job, (index, index))
+
+    prune_failed(tmp_path, 250)
+    assert sorted(path.name for path in (tmp_path / "failed").iterdir()) == [
+        "middle",
+        "new",
+    ]
+
+
+def test_compress_svg_roundtrip_with_dictionary():
+    svg = '<svg><path d="M1 2h3v4z"/><title>$x$</title></svg>'
+    dictionary = train_zlib_dictionary([svg, svg], 1024)
+    data = compress_svg(svg, CODECS["zlib"], (7, dictionary))
+    assert data[0] == CODECS["zlib"]
+    assert decompress_svg(data, {7: dictionary}.__getitem__) == svg
+    assert decompress_svg(svg, {}.__getitem__) == svg
+    assert decompress_svg(None, {}.__getitem__) is None
+
+
+def test_sprite_svg_deduplicates_glyphs():
+    template = (
+        '<svg xmlns="http://www.w3.org/2000/svg" '
+        'xmlns:xlink="http://www.w3.org/1999/xlink">'
+        '<defs><path id="{id}" d="M1.0001 2 L3 2 L3 5 Z"/></defs>'
+        '<use x="1" y="0" xlink:href="#{id}"/><rect width="1" height="1"/></svg>'
+    )
+    store = SpriteStore()
+    first = sprite_svg(template.format(id="g0-1"), store, "/math/glyphs.svg", 3)
+    second = sprite_svg(template.format(id="g3-7"), store, "/math/glyphs.svg", 3)
+
+    assert len(store.symbols) == 1
+    (symbol_id,) = store.symbols
+    assert f'href="/math/glyphs.svg#{symbol_id}"' in first
+    assert first == second
+    assert "<defs" not in first
+    assert "<rect" in first
+
+
+def test_import_does_not_load_heavy_modules():
+    # lxml and asyncio are only needed once an equation is rendered
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [str(Path(__file__).parents[3]), env.get("PYTHONPATH", "")]
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import pelican.plugins.math_svg"],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    modules = {
+        line.rsplit("|", 1)[-1].strip().split(".")[0]
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    assert not modules & {"lxml", "pkg_resources", "asyncio"}
+
+
+def test_work_queue_reassigns_expired_leases(tmp_path):
+    settings = PelicanMathSettings()
+    queue = WorkQueue(tmp_path / "queue.db")
+    assert queue.push([(True, ["x", "y"]), (False, ["z"])], settings) == 3
+    assert queue.push([(True, ["x"])], settings) == 0
+
+    first = queue.claim("a", settings)
+    second = queue.claim("b", settings)
+    assert queue.claim("b", settings) is None
+    queue.finish(second, ["<svg/>"], settings)
+
+    # worker a stopped renewing its lease
+    queue.lease = 0.0
+    assert queue.renew("a", [first.id]) == 1
+    assert queue.claim("b", settings) == first
+    assert queue.renew("a", [first.id]) == 0
+
+    queue.finish(first, ["<svg/>", None], settings)
+    assert queue.status(settings).pending == 0
+    assert sorted(queue.take_results(settings)) == [
+        (False, "z", "<svg/>"),
+        (True, "x", "<svg/>"),
+        (True, "y", None),
+    ]
+
+
+def test_cache_bundle_keeps_newest_renders(tmp_path):
+    settings = PelicanMathSettings()
+    source = Database(tmp_path / "source.db")
+    source.add_equations_bulk(True, [("x", "<svg>x</svg>"), ("y", "<svg/>")], settings)
+    source.add_equations_bulk(False, [("z", "<svg/>")], settings)
+    pack_bundle(source, tmp_path / "bundle.tar.xz", [settings.fingerprint])
+
+    # rendered after the bundle was packed
+    target = Database(tmp_path / "target.db")
+    target.add_equations_bulk(True, [("y", "<svg>new</svg>")], settings)
+
+    assert merge_bundle(target, tmp_path / "bundle.tar.xz", settings) == (2, 1)
+    assert target.fetch_rendered_equation(True, "x", settings) == "<svg>x</svg>"
+    assert target.fetch_rendered_equation(True, "y", settings) == "<svg>new</svg>"
+    assert target.fetch_rendered_equation(False, "z", settings) == "<svg/>"
+    assert merge_bundle(target, tmp_path / "bundle.tar.xz", settings) == (0, 3)
+
+
+def test_normalize_equation_keeps_significant_whitespace():
+    def normalize(equation: str) -> str:
+        return normalize_equation(equation, whitespace=True, braces=True)
+
+    assert normalize("x ^ 2") == normalize("x^{2}") == normalize("x^2") == "x^2"
+    assert normalize("\\frac {a} {b}\n  + c") == "\\frac{a}{b}+c"
+    assert normalize("\\alpha x + \\alpha 2") == "\\alpha x+\\alpha2"
+    assert normalize("x_{\\alpha}b") == "x_\\alpha b"
+    assert normalize("a \\\\\n  [2pt] b") == "a\\\\ [2pt]b"
+    assert normalize("\\text {if  x} y") == "\\text{if x}y"
+    assert normalize("x_{ab} + y_{é}") == "x_{ab}+y_{é}"
+    assert normalize("a % comment\n b") == "a % comment\n b"
+    assert normalize_equation("x ^ {2}", whitespace=False, braces=False) == "x ^ {2}"
+
+    settings = PelicanMathSettings()
+    svg = '<svg xmlns="http://www.w3.org/2000/svg"><title>$x^2$</title></svg>'
+    assert patch_title(svg, "x ^ {2} < 1", settings) == (
+        '<svg xmlns="http://www.w3.org/2000/svg"><title>$x ^ {2} &lt; 1$</title></svg>'
+    )
+
+
+def test_preamble_macro_changes_only_invalidate_using_equations(tmp_path):
+    def make_settings(*preamble: str) -> PelicanMathSettings:
+        settings = PelicanMathSettings()
+        settings.latex_preamble += list(preamble)
+        return settings
+
+    db = Database(tmp_path / "equations.db")
+    old = make_settings(r"\newcommand{\R}{\mathbb{R}}", r"\newcommand{\Rn}{\R^n}")
+    db.add_equations_bulk(
+        True,
+        [("x", "<svg/>"), (r"\R", "<svg/>"), (r"\Rn", "<svg/>"), (r"\N", "<svg/>")],
+        old,
+    )
+
+    new = make_settings(
+        r"\newcommand{\R}{\mathbf{R}}",
+        r"\newcommand{\Rn}{\R^n}",
+        r"\newcommand{\N}{\mathbf{N}}",
+    )
+    db.add_profile(new)
+    assert sorted(db.fetch_missing_inline(new)) == [r"\N", r"\R", r"\Rn"]
+    assert db.fetch_rendered_equation(True, "x", new) == "<svg/>"
+
+    # other preamble changes still invalidate everything
+    package = make_settings(r"\usepackage{bm}", r"\newcommand{\R}{\mathbb{R}}")
+    db.add_profile(package)
+    assert db.fetch_rendered_equation(True, "x", package) is None
+
+
+def test_markdown_resolves_page_equations_at_once(tmp_path, monkeypatch):
+    settings = PelicanMathSettings()
+    settings.cache_path = str(tmp_path)
+    settings.output = "inline"
+    db = get_database(settings)
+    db.add_equations_bulk(True, [(r"\alpha", "<svg>a</svg>")], settings)
+    db.add_equations_bulk(False, [("x^2", "<svg>x</svg>")], settings)
+    render_cache.clear()
+
+    # renders are only looked up by the bulk query
+    def fetch_rendered_equation(*args):
+        raise AssertionError("equation looked up separately")
+
+    monkeypatch.setattr(db, "fetch_rendered_equation", fetch_rendered_equation)
+    md = markdown.Markdown(extensions=[PelicanMathExtension(settings)])
+    html = md.convert(
+        " ".join([r"$\alpha$"] * 300) + "\n\n$$\nx^2\n$$\n\n$$\nx^2\n$$\n",
+    )
+    assert html.count("<svg>a</svg>") == 300
+    assert html.count("<svg>x</svg>") == 2
+    assert md.htmlStash.html_counter == 2
+
+
+def test_extract_equations_skips_code():
+    text = (
+        "Text $y$.\n\n"
+        "    echo $HOME and $PATH\n    cost $5\n\n"
+        "```\nprice $a$ and $b$\n```\n\n"
+        "* item $z$\n\n    continued $w$\n\n        code $v$\n\n"
+        "$$\nx^2\n$$\n"
+    )
+    assert extract_equations(text) == (["y", "z", "w"], ["x^2"])
+
+
+def test_from_settings_does_not_modify_pelican_settings():
+    preamble = [r"\documentclass{standalone}"]
+    pelican = SimpleNamespace(
+        settings={
+            "MATH_SVG": {
+                "latex": {
+                    "preamble": preamble,
+                    "preamble_extend": [r"\usepackage{bm}"],
+                },
+            },
+        },
+    )
+    fingerprints = {
+        PelicanMathSettings.from_settings(pelican).fingerprint for _ in range(3)
+    }
+    assert len(fingerprints) == 1
+    assert preamble == [r"\documentclass{standalone}"]
+
+
+def open_forked_database(settings: PelicanMathSettings) -> tuple[bool, int]:
+    db = get_database(settings)
+    db.add_equation(True, "y", settings, "<svg/>")
+    return any(db is other for other in database._inherited), len(database._inherited)
+
+
+def test_forked_children_do_not_reuse_connections(tmp_path):
+    settings = PelicanMathSettings()
+    settings.cache_path = str(tmp_path)
+    get_database(settings).add_equation(True, "x", settings, "<svg/>")
+
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+        reused, inherited = pool.apply(open_forked_database, (settings,))
+    assert not reused
+    assert inherited >= 1
+
+    # the connection of the parent is still usable
+    assert get_database(settings).fetch_rendered_equation(True, "y", settings)
+
+
+def test_async_engine_falls_back_when_rendering_raises(tmp_path, monkeypatch):
+    def render_equations(equations, inline, settings):
+        raise FileNotFoundError("lualatex")
+
+    monkeypatch.setattr(engine, "render_equations", render_equations)
+    settings = PelicanMathSettings()
+    settings.cache_path = str(tmp_path)
+    render_engine = engine.RenderEngine(settings)
+    page = tmp_path / "page.html"
+    page.write_text(f"<p>{render_engine.submit('x', True)}</p>")
+    try:
+        markups = render_engine.wait()
+    finally:
+        render_engine.close()
+
+    engine.fill_placeholders([page], markups, settings)
+    assert page.read_text() == "<p><code>$x$</code></p>"
+
+
+def test_stored_renders_are_written_for_cached_pages(tmp_path, monkeypatch):
+    settings = PelicanMathSettings()
+    settings.cache_path = str(tmp_path)
+    settings.output = "img"
+    get_database(settings).add_equation(True, "x", settings, "<svg>x</svg>")
+
+    # a page restored from Pelican's content cache references the file
+    # without rendering the equation again
+    output = tmp_path / "output"
+    add_stored_renders(settings, output)
+    svg_store.write(output)
+    assert (output / get_svg_name("<svg>x</svg>")).read_text() == "<svg>x</svg>"
+
+    # the file names are recorded, existing files do not decode any render
+    db = get_database(settings)
+
+    def decode(rendered):
+        raise AssertionError("render decoded")
+
+    monkeypatch.setattr(db, "decode", decode)
+    add_stored_renders(settings, output)
+    assert not svg_store.svgs
+
+
+def test_normalize_equation_keeps_text_box_arguments():
+    def normalize(equation: str) -> str:
+        return normalize_equation(equation, True, True)
+
+    assert normalize(r"\makebox{a b}") != normalize(r"\makebox{ab}")
+    assert normalize(r"\makebox[2cm][l]{a  b} + x") == r"\makebox[2cm][l]{a b}+x"
+    assert normalize(r"\fcolorbox{red}{blue}{a b}") == r"\fcolorbox{red}{blue}{a b}"
+    assert normalize(r"\parbox{3cm}{a b} ^ {2}") == r"\parbox{3cm}{a b}^2"
+
+
+def test_workspaces_are_reused_by_new_threads(tmp_path):
+    settings = PelicanMathSettings()
+    settings.scratch_dir = str(tmp_path)
+
+    def run_job(index: int):
+        with get_workspace(settings) as workspace:
+            (workspace / "input.tex").write_text(str(index))
+
+    # every executor starts new threads with new idents
+    for _ in range(10):
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(run_job, range(8)))
+
+    workspaces = list((tmp_path / "workers").iterdir())
+    assert 1 <= len(workspaces) <= 4
+    assert not any(any(workspace.iterdir()) for workspace in workspaces)
+
+
+def test_prefetch_renders_missing_equations_in_batches(tmp_path, monkeypatch):
+    batches = []
+
+    def render_equations(equations, inline, settings):
+        batches.append(equations)
+        return [f"<svg>{equation}</svg>" for equation in equations]
+
+    monkeypatch.setattr(render, "render_equations", render_equations)
+    settings = PelicanMathSettings()
+    settings.cache_path = str(tmp_path)
+    settings.jobs = 2
+    equations = [f"p_{index}" for index in range(5)]
+
+    svgs = render.prefetch_svgs(equations + equations, True, settings)
+    assert sorted(len(batch) for batch in batches) == [2, 3]
+    assert svgs == {equation: f"<svg>{equation}</svg>" for equation in equations}
+    assert get_database(settings).fetch_rendered_equation(True, "p_4", settings)
+
+
+SVGO_STUB = """
+import json, os, sys
+crash = os.path.join(os.path.dirname(sys.argv[0]), "crashed")
+for line in sys.stdin:
+    svg = json.loads(line)["svg"]
+    if svg == "crash" and not os.path.exists(crash):
+        open(crash, "w").close()
+        sys.exit(1)
+    print(json.dumps({"data": str(os.getpid())}), flush=True)
+"""
+
+
+def test_svgo_servers_are_bounded_and_restarted(tmp_path, monkeypatch):
+    stub = tmp_path / "svgo_stub.py"
+    stub.write_text(SVGO_STUB)
+    monkeypatch.setattr(workers, "find_svgo_package", lambda: tmp_path)
+    monkeypatch.setattr(workers, "which", lambda name: name)
+    monkeypatch.setattr(
+        workers.SvgoServer,
+        "command",
+        lambda self: [sys.executable, str(stub)],
+    )
+
+    def run(code: str) -> str | None:
+        return workers.run_svgo_server(code, ["--multipass"], False, size=2)
+
+    try:
+        # idle servers are reused
+        assert len({run("<svg/>") for _ in range(3)}) == 1
+
+        # concurrent callers wait for one of the two servers
+        with ThreadPoolExecutor(6) as executor:
+            pids = set(executor.map(run, ["<svg/>"] * 30))
+        assert len(pids) <= 2
+
+        # a crashed server is started again
+        pid = run("crash")
+        assert pid is not None
+        assert pid not in pids
+    finally:
+        workers.close_svgo_servers()
+    assert all(pool.count == 0 for pool in workers._svgo_pools.values())
+
+
+def test_latex_format_is_passed_to_latex_and_falls_back(tmp_path, monkeypatch):
+    builds = []
+    commands = []
+
+    def check_output(cmd, cwd):
+        builds.append(cmd)
+        if "FAIL" in "".join(settings.latex_preamble):
+            raise subprocess.CalledProcessError(1, cmd)
+        (Path(cwd) / f"{cmd[2].removeprefix('--jobname=')}.fmt").touch()
+        return b""
+
+    def run_command(cmd, logger, env=None):
+        # stop after the LaTeX run, only the arguments are of interest
+        commands.append((cmd, env))
+        raise subprocess.CalledProcessError(1, cmd)
+
+    monkeypatch.setattr(latex_format.subprocess, "check_output", check_output)
+    monkeypatch.setattr(render, "run_command", run_command)
+    monkeypatch.setattr(latex_format, "_formats", {})
+    settings = PelicanMathSettings()
+    settings.cache_path = str(tmp_path)
+    settings.latex_format = True
+
+    def compile_svg():
+        try:
+            render.compile_svgs(
+                ["x"], True, settings, tmp_path, logging.getLogger(), []
+            )
+        except subprocess.CalledProcessError:
+            pass
+        return commands[-1]
+
+    # LuaTeX is refused without trying to build the format
+    assert latex_format.build_format(settings, []) is None
+    assert not builds
+
+    settings.latex_program = "pdflatex"
+    cmd, env = compile_svg()
+    name = latex_format.get_format_name(settings)
+    assert builds[-1][:2] == ["pdflatex", "--ini"]
+    assert f"--fmt={name}" in cmd
+    assert env["TEXFORMATS"].startswith(str(tmp_path / "formats") + os.pathsep)
+    assert (tmp_path / "formats" / f"{name}.fmt").exists()
+
+    # a failed build renders with the plain preamble and is not retried
+    settings.latex_preamble = settings.latex_preamble + ["FAIL"]
+    cmd, env = compile_svg()
+    compile_svg()
+    assert len(builds) == 2
+    assert not any(arg.startswith("--fmt=") for arg in cmd)
+    assert env is None
+
+
+def test_failing_batches_are_bisected(tmp_path, monkeypatch):
+    calls = []
+
+    def compile_svgs(equations, inline, settings, working_dir, logger, stats):
+        calls.append(equations)
+        if "bad" in equations:
+            raise render.RenderError("undefined control sequence")
+        return [f"<svg>{equation}</svg>" for equation in equations]
+
+    monkeypatch.setattr(render, "compile_svgs", compile_svgs)
+    monkeypatch.setattr(render, "process_svg", lambda svg, *args: svg)
+    settings = PelicanMathSettings()
+    settings.cache_path = str(tmp_path)
+    settings.scratch_dir = str(tmp_path / "scratch")
+    equations = [f"b_{index}" for index in range(16)]
+    equations[11] = "bad"
+
+    svgs = render.render_equations(equations, True, settings)
+    assert svgs[11] is None
+    assert [svg for svg in svgs if svg is None] == [None]
+    assert svgs[:11] + svgs[12:] == [
+        f"<svg>{equation}</svg>" for equation in equations if equation != "bad"
+    ]
+    # one failing batch per level and its sibling
+    assert len(calls) <= 2 * 4 + 1
+    assert (tmp_path / "scratch" / "failed").is_dir()
+
+
+def test_vacuum_removes_other_profiles(tmp_path):
+    db = Database(tmp_path / "equations.db")
+    old = PelicanMathSettings()
+    db.add_equations_bulk(True, [("x", "<svg>x</svg>"), (r"\old", "<svg/>")], old)
+    db.add_svg_names(True, [(hash_equation("x"), "x.svg")], old)
+    new = PelicanMathSettings()
+    new.latex_preamble = new.latex_preamble + [r"\usepackage{bm}"]
+    db.add_equations_bulk(True, [("x", "<svg>x</svg>"), (r"\new", "<svg/>")], new)
+    db.add_svg_names(True, [(hash_equation("x"), "x.svg")], new)
+
+    assert db.vacuum(new) == 1
+    assert db.fetch_rendered_equation(True, "x", new) == "<svg>x</svg>"
+    assert db.fetch_rendered_equation(True, r"\new", new) == "<svg/>"
+    assert dict(db.fetch_svg_names(True, new)) == {
+        hash_equation("x"): "x.svg",
+        hash_equation(r"\new"): None,
+    }
+    assert db.connection.execute("SELECT count(*) FROM svg_names").fetchone() == (1,)
+    assert (
+        db.connection.execute(
+            "SELECT name FROM macros WHERE hash = ?", (hash_equation(r"\old"),)
+        ).fetchall()
+        == []
+    )
+    assert db.connection.execute(
+        "SELECT name FROM macros WHERE hash = ?", (hash_equation(r"\new"),)
+    ).fetchall() == [(r"\new",)]
+
+
+def test_recompress_keeps_renders(tmp_path):
+    db = Database(tmp_path / "equations.db")
+    settings = PelicanMathSettings()
+    settings.compression = "none"
+    renders = [
+        (f"r_{index}", f'<svg><path d="M 0 0 L {index} 1"/><g id="g{index}"/></svg>')
+        for index in range(80)
+    ]
+    db.add_equations_bulk(True, renders, settings)
+    stored = db.connection.execute("SELECT rendered FROM inline").fetchall()
+    assert all(isinstance(rendered, str) for (rendered,) in stored)
+
+    settings.compression = "zlib"
+    assert db.recompress(settings) == len(renders)
+    assert db.connection.execute("SELECT count(*) FROM dictionaries").fetchone() == (1,)
+    stored = db.connection.execute("SELECT rendered FROM inline").fetchall()
+    assert all(isinstance(rendered, bytes) for (rendered,) in stored)
+    for equation, rendered in renders:
+        assert db.fetch_rendered_equation(True, equation, settings) == rendered
+
+    # back to plain text, the unused dictionary is removed by vacuum
+    settings.compression = "none"
+    assert db.recompress(settings) == len(renders)
+    db.vacuum(settings)
+    assert db.connection.execute("SELECT count(*) FROM dictionaries").fetchone() == (0,)
+    for equation, rendered in renders:
+        assert db.fetch_rendered_equation(True, equation, settings) == rendered
+
+
+def test_migrate_legacy_databases(tmp_path):
+    settings = PelicanMathSettings()
+    schemas = {
+        # version 0 stored the serialized settings in every row
+        0: [
+            f"CREATE TABLE {table} (hash TEXT, settings TEXT, "
+            "equation TEXT, rendered TEXT)"
+            for table in ("inline", "display")
+        ],
+        # version 1 had settings profiles but no update times
+        1: [
+            "CREATE TABLE settings_profiles (fingerprint TEXT PRIMARY KEY, "
+            "settings TEXT)",
+        ]
+        + [
+            f"CREATE TABLE {table} (hash TEXT, profile TEXT, equation TEXT, "
+            "rendered TEXT, PRIMARY KEY (hash, profile))"
+            for table in ("inline", "display")
+        ],
+    }
+    for version, schema in schemas.items():
+        path = tmp_path / f"v{version}.db"
+        connection = sqlite3.connect(path)
+        with connection:
+            for statement in schema:
+                connection.execute(statement)
+            profile = settings.serialize() if version == 0 else settings.fingerprint
+            if version == 1:
+                connection.execute(
+                    "INSERT INTO settings_profiles VALUES (?, ?)",
+                    (settings.fingerprint, settings.serialize()),
+                )
+            for table, equation in (("inline", r"\alpha"), ("display", "x")):
+                connection.execute(
+                    f"INSERT INTO {table} VALUES (?, ?, ?, ?)",
+                    (hash_equation(equation), profile, equation, f"<{equation}>"),
+                )
+            connection.execute(f"PRAGMA user_version = {version}")
+        connection.close()
+
+        db = Database(path)
+        assert db.connection.execute("PRAGMA user_version").fetchone() == (3,)
+        assert db.fetch_rendered_equation(True, r"\alpha", settings) == r"<\alpha>"
+        assert db.fetch_rendered_equation(False, "x", settings) == "<x>"
+        assert db.connection.execute("SELECT hash, name FROM macros").fetchall() == [
+            (hash_equation(r"\alpha"), r"\alpha"),
+        ]
+        # migrated databases accept new renders
+        db.add_equation(True, "y", settings, "<y>")
+        assert db.fetch_rendered_equation(True, "y", settings) == "<y>"
+
+
+def test_carry_over_only_rerenders_equations_using_changed_macros(
+    tmp_path, monkeypatch
+):
+    rendered = []
+
+    def render_equations(equations, inline, settings):
+        rendered.extend(equations)
+        return [f"<new>{equation}</new>" for equation in equations]
+
+    monkeypatch.setattr(render, "render_equations", render_equations)
+    old = PelicanMathSettings()
+    old.cache_path = str(tmp_path)
+    old.latex_preamble = old.latex_preamble + [
+        r"\newcommand{\Rset}{\mathbb{R}}",
+        r"\newcommand{\Rvec}{\Rset^n}",
+        r"\newenvironment{pmat}{\begin{pmatrix}}{\end{pmatrix}}",
+    ]
+    equations = [
+        "c_x",
+        r"c_y \in \Rset",
+        r"\Rvec",
+        r"\begin{pmat} c_z \end{pmat}",
+        r"\alpha",
+    ]
+    db = get_database(old)
+    db.add_equations_bulk(
+        True,
+        [(equation, f"<old>{equation}</old>") for equation in equations],
+        old,
+    )
+
+    new = PelicanMathSettings()
+    new.cache_path = str(tmp_path)
+    new.latex_preamble = [
+        line.replace(r"\mathbb{R}", r"\mathbf{R}") for line in old.latex_preamble
+    ]
+    with db.connection:
+        db.connection.execute(
+            "INSERT INTO settings_profiles VALUES (?, ?)",
+            (new.fingerprint, new.serialize()),
+        )
+    assert db.carry_over(new) == 3
+    db.profiles.add(new.fingerprint)
+
+    svgs = render.prefetch_svgs(equations, True, new)
+    assert sorted(rendered) == [r"\Rvec", r"c_y \in \Rset"]
+    assert svgs["c_x"] == "<old>c_x</old>"
+    assert svgs[r"\Rvec"] == r"<new>\Rvec</new>"
+
+
+def add_marker(doc, equation, settings):
+    doc.attrib["data-equation"] = equation
+
+
+def test_user_transforms():
+    settings = PelicanMathSettings()
+    # enabling the feature must not change the fingerprint of existing caches
+    assert "transforms" not in json.loads(settings.serialize())
+    default = settings.fingerprint
+
+    path = f"{add_marker.__module__}.add_marker"
+    for transform in (add_marker, path, path.replace(".add_marker", ":add_marker")):
+        settings = PelicanMathSettings()
+        settings.transforms = [transform]
+        serialized = json.loads(settings.serialize())["transforms"]
+        assert serialized == [transform if isinstance(transform, str) else path]
+        assert settings.fingerprint != default
+        svg = postprocess_svg(
+            '<svg xmlns="http://www.w3.org/2000/svg"/>', "x", settings
+        )
+        assert 'data-equation="x"' in svg
+
+    assert resolve_transform(path) is add_marker
+    for name in (
+        "add_marker",
+        "no_such_module.add_marker",
+        f"{add_marker.__module__}.no_such_transform",
+        f"{add_marker.__module__}.SVGO_STUB",
+    ):
+        try:
+            resolve_transform(name)
+        except ValueError as e:
+            assert name in str(e)
+        else:
+            raise AssertionError(f"{name} was resolved")
+
+
+def test_scan_sources_skips_unchanged_files(tmp_path):
+    settings = PelicanMathSettings()
+    settings.cache_path = str(tmp_path / "cache")
+    db = get_database(settings)
+    content = tmp_path / "content"
+    content.mkdir()
+    source = content / "page.md"
+    source.write_text("$s_1$ and\n\n$$\ns_2\n$$\n")
+
+    assert tuple(scan_sources(content, settings, db)) == (1, 0, 1, 1)
+    assert tuple(scan_sources(content, settings, db)) == (0, 1, 0, 0)
+
+    # a new modification time alone does not rescan the file
+    mtime = source.stat().st_mtime + 10
+    os.utime(source, (mtime, mtime))
+    assert tuple(scan_sources(content, settings, db)) == (0, 1, 0, 0)
+    assert db.fetch_source("page.md", settings)[0] == mtime
+    assert tuple(scan_sources(content, settings, db)) == (0, 1, 0, 0)
+
+    source.write_text("$s_1$ and $s_3$\n")
+    assert tuple(scan_sources(content, settings, db)) == (1, 0, 2, 0)
+    assert sorted(db.fetch_missing_inline(settings)) == ["s_1", "s_3"]
+
+
+def test_interrupted_render_resumes_with_missing_equations(tmp_path, monkeypatch):
+    settings = PelicanMathSettings()
+    settings.cache_path = str(tmp_path)
+    equations = [f"j_{index}" for index in range(10)]
+    get_database(settings).add_missing_equations(True, equations, settings)
+
+    runs: list[list[str]] = []
+    interrupt = [3]
+
+    def run_job(job, settings):
+        if len(runs) == interrupt[0]:
+            raise RuntimeError("interrupted")
+        runs.append(job.equations)
+        return job, [f"<svg>{equation}</svg>" for equation in job.equations]
+
+    monkeypatch.setattr(main, "run_job", run_job)
+    monkeypatch.setattr(main, "get_instance", lambda args: (None, None))
+    monkeypatch.setattr(main, "parse_arguments", lambda args: None)
+    monkeypatch.setattr(
+        main,
+        "PelicanMathSettings",
+        SimpleNamespace(from_settings=lambda pelican: settings),
+    )
+    monkeypatch.setattr(main.multiprocessing, "Pool", ThreadPool)
+
+    try:
+        main.render(jobs=1, batch_size=2, worker=None)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("render was not interrupted")
+    db = get_database(settings)
+    committed = sorted(set(equations) - set(db.fetch_missing_inline(settings)))
+    assert committed == sorted(sum(runs, []))
+    assert len(committed) == 6
+
+    # the second run only renders the remaining equations
+    first = len(runs)
+    interrupt[0] = -1
+    main.render(jobs=1, batch_size=2, worker=None)
+    assert sorted(sum(runs[first:], [])) == sorted(set(equations) - set(committed))
+    assert db.fetch_missing_inline(settings) == []
+    for equation in equations:
+        assert db.fetch_rendered_equation(True, equation, settings) == (
+            f"<svg>{equation}</svg>"
+        )
@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import html
+import re
+
+from .settings import PelicanMathSettings
+
+# control word, control symbol, whitespace or any other character
+RE_TOKEN = re.compile(r"\\[A-Za-z]+|\\.|\s+|.", re.DOTALL)
+RE_TITLE = re.compile(r"<title>.*?</title>", re.DOTALL)
+
+# Comments end at line breaks and definitions or verbatim text might be used
+# outside of math mode, such equations are never changed.
+RE_UNSAFE = re.compile(
+    r"%|\\(?:verb|def|edef|gdef|xdef|let|newcommand|renewcommand|"
+    r"providecommand|DeclareMathOperator|string|detokenize|meaning)(?![A-Za-z])",
+)
+
+# Commands with arguments that are not typeset in math mode, whitespace
+# matters. All their arguments are kept as written.
+TEXT_COMMANDS = {
+    r"\text",
+    r"\textrm",
+    r"\textsf",
+    r"\texttt",
+    r"\textnormal",
+    r"\textbf",
+    r"\textmd",
+    r"\textit",
+    r"\textsl",
+    r"\textsc",
+    r"\textup",
+    r"\textsuperscript",
+    r"\textsubscript",
+    r"\emph",
+    r"\mbox",
+    r"\makebox",
+    r"\hbox",
+    r"\vbox",
+    r"\fbox",
+    r"\framebox",
+    r"\parbox",
+    r"\raisebox",
+    r"\colorbox",
+    r"\fcolorbox",
+    r"\intertext",
+    r"\shortintertext",
+    r"\tag",
+    r"\label",
+    r"\ref",
+    r"\eqref",
+    r"\href",
+    r"\url",
+}
+
+
+def is_control_word(token: str) -> bool:
+    return token.startswith("\\") and token[1:2].isascii() and token[1:2].isalpha()
+
+
+def continues_control_word(token: str) -> bool:
+    # Unicode engines also treat non-ASCII letters as letters
+    return token[:1].isalpha() or not token[:1].isascii()
+
+
+def find_group_end(tokens: list[str], start: int) -> int | None:
+    # index of the } closing the group opened at tokens[start]
+    depth = 0
+    for index in range(start, len(tokens)):
+        if tokens[index] == "{":
+            depth += 1
+        elif tokens[index] == "}":
+            depth -= 1
+            if depth == 0:
+                return index
+    return None
+
+
+def find_optional_end(tokens: list[str], start: int) -> int | None:
+    # index of the ] closing the optional argument opened at tokens[start]
+    depth = 0
+    for index in range(start + 1, len(tokens)):
+        if tokens[index] == "{":
+            depth += 1
+        elif tokens[index] == "}":
+            depth -= 1
+        elif (tokens[index] == "]") and (depth == 0):
+            return index
+    return None
+
+
+def next_token(tokens: list[str], start: int) -> int:
+    # index of the next token that is not whitespace
+    while (start < len(tokens)) and tokens[start].isspace():
+        start += 1
+    return start
+
+
+def normalize_equation(equation: str, whitespace: bool, braces: bool) -> str:
+    # Rewrite an equation to a canonical form that renders identically. Math
+    # mode ignores whitespace, it is only kept where it ends a control word
+    # and after \\ (amsmath does not skip it before an optional argument).
+    # Optionally, braces around single tokens in sub- and superscripts are
+    # removed.
+    if not (whitespace or braces) or RE_UNSAFE.search(equation):
+        return equation
+
+    tokens = RE_TOKEN.findall(equation)
+    output: list[str] = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+
+        if token.isspace():
+            following = next_token(tokens, index)
+            if not whitespace:
+                output.append(token)
+            elif output and (
+                (output[-1] == "\\\\")
+                or (
+                    is_control_word(output[-1])
+                    and (following < len(tokens))
+                    and continues_control_word(tokens[following])
+                )
+            ):
+                output.append(" ")
+            index = following
+            continue
+
+        if (token in TEXT_COMMANDS) and whitespace:
+            # copy all following arguments, only collapsing whitespace like
+            # TeX does
+            output.append(token)
+            index += 1
+            while True:
+                start = next_token(tokens, index)
+                end = None
+                if start < len(tokens):
+                    if tokens[start] == "{":
+                        end = find_group_end(tokens, start)
+                    elif tokens[start] == "[":
+                        end = find_optional_end(tokens, start)
+                if end is None:
+                    break
+                output += [" " if t.isspace() else t for t in tokens[start : end + 1]]
+                index = end + 1
+            continue
+
+        output.append(token)
+        index += 1
+
+        if braces and (token in ("^", "_")):
+            # x^{2} -> x^2, x_{\alpha} -> x_\alpha
+            start = next_token(tokens, index)
+            inner = next_token(tokens, start + 1)
+            end = next_token(tokens, inner + 1)
+            if (
+                (end < len(tokens))
+                and (tokens[start] == "{")
+                and (tokens[end] == "}")
+                and (
+                    (tokens[inner].isascii() and tokens[inner].isalnum())
+                    or is_control_word(tokens[inner])
+                )
+            ):
+                if not whitespace:
+                    output += tokens[index:start]
+                output.append(tokens[inner])
+                if (
+                    is_control_word(tokens[inner])
+                    and (end + 1 < len(tokens))
+                    and continues_control_word(tokens[end + 1])
+                ):
+                    # \alpha must not run into a following letter
+                    output.append(" ")
+                index = end + 1
+
+    return "".join(output)
+
+
+def get_cache_key(equation: str, settings: PelicanMathSettings) -> str:
+    # the equation that is rendered and stored instead of the given one
+    return normalize_equation(
+        equation,
+        settings.normalize_whitespace,
+        settings.normalize_braces,
+    )
+
+
+def patch_title(svg: str, equation: str, settings: PelicanMathSettings) -> str:
+    # A render of an equivalent equation, replace the title of the render
+    # with the equation as written. Files of the "img" and "object" output
+    # modes are shared by all equivalent equations, they have to be
+    # reproducible from the stored renders (the tags carry the equation as
+    # written).
+    if (not settings.titles) or (settings.output in ("img", "object")):
+        return svg
+    title = html.escape(f"${equation}$", quote=False)
+    return RE_TITLE.sub(lambda _: f"<title>{title}</title>", svg, count=1)
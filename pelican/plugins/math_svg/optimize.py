@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import re
+
+import lxml.etree
+
+SVG_NAMESPACE = "http://www.w3.org/2000/svg"
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+RE_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+RE_PATH_TOKEN = re.compile(
+    r"[MmLlHhVvCcSsQqTtAaZz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+)
+RE_URL_REFERENCE = re.compile(r"url\(\s*#([^)\s]+)\s*\)")
+RE_LENGTH = re.compile(r"^([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)([a-z%]*)$")
+
+# number of parameters of every path command
+PATH_PARAMETERS = {
+    "M": 2,
+    "L": 2,
+    "H": 1,
+    "V": 1,
+    "C": 6,
+    "S": 4,
+    "Q": 4,
+    "T": 2,
+    "A": 7,
+    "Z": 0,
+}
+
+NUMERIC_ATTRIBUTES = {
+    "x",
+    "y",
+    "x1",
+    "y1",
+    "x2",
+    "y2",
+    "cx",
+    "cy",
+    "r",
+    "rx",
+    "ry",
+    "width",
+    "height",
+    "stroke-width",
+}
+
+REMOVED_ELEMENTS = {"metadata", "desc"}
+
+TEXT_ELEMENTS = {"title", "text", "tspan", "style"}
+
+
+def local_name(element: lxml.etree._Element) -> str:
+    return lxml.etree.QName(element).localname
+
+
+def format_number(value: float, precision: int) -> str:
+    text = f"{round(value, precision):.{precision}f}"
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    if text in ("-0", ""):
+        return "0"
+    if text.startswith("0."):
+        return text[1:]
+    if text.startswith("-0."):
+        return "-" + text[2:]
+    return text
+
+
+def needs_separator(last: str, number: str) -> bool:
+    # a separator is only required if the next number could continue the last
+    if not last:
+        return False
+    return not (number.startswith("-") or (number.startswith(".") and "." in last))
+
+
+def join_numbers(numbers: list[str], last: str = "") -> str:
+    result = ""
+    for number in numbers:
+        if needs_separator(last, number):
+            result += " "
+        result += number
+        last = number
+    return result
+
+
+def round_numbers(value: str, precision: int) -> str:
+    return RE_NUMBER.sub(
+        lambda m: format_number(float(m.group(0)), precision),
+        value,
+    )
+
+
+def parse_path(data: str) -> list[tuple[str, list[float]]]:
+    tokens = RE_PATH_TOKEN.findall(data)
+    segments: list[tuple[str, list[float]]] = []
+    command = ""
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token.isalpha():
+            command = token
+            index += 1
+            if command in "Zz":
+                segments.append((command, []))
+                continue
+        elif not command:
+            raise ValueError(f"invalid path data: {data}")
+
+        count = PATH_PARAMETERS[command.upper()]
+        parameters = [float(value) for value in tokens[index : index + count]]
+        if len(parameters) != count:
+            raise ValueError(f"invalid path data: {data}")
+        segments.append((command, parameters))
+        index += count
+
+        # further coordinate pairs after a moveto are implicit linetos
+        if command == "M":
+            command = "L"
+        elif command == "m":
+            command = "l"
+    return segments
+
+
+def to_absolute(
+    segments: list[tuple[str, list[float]]],
+) -> list[tuple[str, list[float]]]:
+    result: list[tuple[str, list[float]]] = []
+    x, y = 0.0, 0.0
+    start_x, start_y = 0.0, 0.0
+    for command, parameters in segments:
+        upper = command.upper()
+        relative = command != upper
+        parameters = list(parameters)
+        if relative:
+            if upper == "H":
+                parameters[0] += x
+            elif upper == "V":
+                parameters[0] += y
+            elif upper == "A":
+                parameters[5] += x
+                parameters[6] += y
+            else:
+                for i in range(0, len(parameters), 2):
+                    parameters[i] += x
+                    parameters[i + 1] += y
+
+        if upper == "Z":
+            x, y = start_x, start_y
+        elif upper == "H":
+            x = parameters[0]
+        elif upper == "V":
+            y = parameters[0]
+        else:
+            x, y = parameters[-2], parameters[-1]
+
+        if upper == "M":
+            start_x, start_y = x, y
+
+        result.append((upper, parameters))
+    return result
+
+
+def format_path(segments: list[tuple[str, list[float]]], precision: int) -> str:
+    # emit every segment in absolute or relative form, whichever is shorter
+    output = ""
+    previous = ""
+    last_number = ""
+    x, y = 0.0, 0.0
+    start_x, start_y = 0.0, 0.0
+    for command, parameters in segments:
+        parameters = [round(value, precision) for value in parameters]
+
+        if command == "L" and parameters[1] == y and previous:
+            command, parameters = "H", [parameters[0]]
+        elif command == "L" and parameters[0] == x and previous:
+            command, parameters = "V", [parameters[1]]
+
+        if command == "Z":
+            candidates = [("z", "")]
+        else:
+            if command == "H":
+                relative_parameters = [parameters[0] - x]
+            elif command == "V":
+                relative_parameters = [parameters[0] - y]
+            elif command == "A":
+                relative_parameters = parameters[:5] + [
+                    parameters[5] - x,
+                    parameters[6] - y,
+                ]
+            else:
+                relative_parameters = [
+                    value - (x if i % 2 == 0 else y)
+                    for i, value in enumerate(parameters)
+                ]
+
+            candidates = []
+            for letter, values in (
+                (command, parameters),
+                (command.lower(), relative_parameters),
+            ):
+                numbers = [format_number(value, precision) for value in values]
+                # repeated commands and linetos following a moveto are implicit
+                implicit = (letter == previous and letter not in "Mm") or (
+                    (letter, previous) in (("L", "M"), ("l", "m"))
+                )
+                if implicit:
+                    text = join_numbers(numbers, last_number)
+                else:
+                    text = letter + join_numbers(numbers)
+                candidates.append((text, numbers[-1]))
+
+        chosen, last_number = min(candidates, key=lambda candidate: len(candidate[0]))
+        output += chosen
+        if command == "Z":
+            previous = "z"
+        elif not chosen[0].isalpha():
+            # implicit commands keep the previous command letter
+            previous = {"M": "L", "m": "l"}.get(previous, previous)
+        else:
+            previous = chosen[0]
+
+        if command == "Z":
+            x, y = start_x, start_y
+        elif command == "H":
+            x = parameters[0]
+        elif command == "V":
+            y = parameters[0]
+        else:
+            x, y = parameters[-2], parameters[-1]
+        if command == "M":
+            start_x, start_y = x, y
+
+    return output.strip()
+
+
+def shorten_path_data(data: str, precision: int) -> str:
+    try:
+        return format_path(to_absolute(parse_path(data)), precision)
+    except ValueError:
+        return round_numbers(data, precision)
+
+
+def strip_ids(doc: lxml.etree._Element):
+    referenced: set[str] = set()
+    for element in doc.iter(lxml.etree.Element):
+        for name, value in element.attrib.items():
+            if name in (XLINK_HREF, "href") and value.startswith("#"):
+                referenced.add(value[1:])
+            else:
+                referenced.update(RE_URL_REFERENCE.findall(value))
+
+    for element in doc.iter(lxml.etree.Element):
+        if ("id" in element.attrib) and (element.attrib["id"] not in referenced):
+            element.attrib.pop("id")
+
+
+def remove_empty_containers(doc: lxml.etree._Element):
+    changed = True
+    while changed:
+        changed = False
+        for element in list(
+            doc.iter(f"{{{SVG_NAMESPACE}}}g", f"{{{SVG_NAMESPACE}}}defs")
+        ):
+            parent = element.getparent()
+            if parent is None:
+                continue
+
+            if len(element) == 0:
+                parent.remove(element)
+                changed = True
+            elif local_name(element) == "g" and not element.attrib:
+                # groups without attributes can be replaced by their children
+                index = parent.index(element)
+                for offset, child in enumerate(list(element)):
+                    parent.insert(index + offset, child)
+                parent.remove(element)
+                changed = True
+
+
+def optimize(doc: lxml.etree._Element, precision: int):
+    for element in list(doc.iter(lxml.etree.Element)):
+        if local_name(element) in REMOVED_ELEMENTS:
+            element.getparent().remove(element)
+
+    strip_ids(doc)
+    remove_empty_containers(doc)
+
+    doc.attrib.pop("version", None)
+    for element in doc.iter(lxml.etree.Element):
+        if local_name(element) not in TEXT_ELEMENTS:
+            if element.text is not None and not element.text.strip():
+                element.text = None
+        if element.tail is not None and not element.tail.strip():
+            element.tail = None
+
+        for name, value in element.attrib.items():
+            if name == "d":
+                element.attrib[name] = shorten_path_data(value, precision)
+            elif name in ("viewBox", "transform", "points"):
+                element.attrib[name] = round_numbers(value, precision)
+            elif name in NUMERIC_ATTRIBUTES:
+                match = RE_LENGTH.match(value.strip())
+                if match:
+                    element.attrib[name] = format_number(
+                        float(match.group(1)), precision
+                    ) + match.group(2)
+
+    lxml.etree.cleanup_namespaces(doc)
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+from collections.abc import Callable
+import importlib
+import re
+
+import lxml.etree
+
+from .optimize import optimize
+from .settings import PelicanMathSettings
+
+NAMESPACES = {"svg": "http://www.w3.org/2000/svg"}
+
+Transform = Callable[[lxml.etree._Element, str, PelicanMathSettings], None]
+
+
+def remove_svg_pageid(
+    doc: lxml.etree._Element,
+    equation: str,
+    settings: PelicanMathSettings,
+):
+    for element in doc.xpath("//svg:g", namespaces=NAMESPACES):
+        if re.fullmatch(r"page\d+", element.attrib.get("id", "")):
+            element.attrib.pop("id")
+
+
+def fix_strokeonly(
+    doc: lxml.etree._Element,
+    equation: str,
+    settings: PelicanMathSettings,
+):
+    for element in doc.xpath(
+        "//svg:path[@fill='none' and @stroke='#000']",
+        namespaces=NAMESPACES,
+    ):
+        element.attrib.pop("stroke")
+        element.attrib["class"] = settings.strokeonly_class
+
+
+def add_title(
+    doc: lxml.etree._Element,
+    equation: str,
+    settings: PelicanMathSettings,
+):
+    if not settings.titles:
+        return
+
+    title = lxml.etree.SubElement(doc, "title")
+    title.text = f"${equation}$"
+
+
+# comments are removed by the parser already
+DEFAULT_TRANSFORMS: list[Transform] = [
+    remove_svg_pageid,
+    fix_strokeonly,
+    add_title,
+]
+
+
+def resolve_transform(transform: str | Transform) -> Transform:
+    if not isinstance(transform, str):
+        return transform
+
+    module, _, name = transform.replace(":", ".").rpartition(".")
+    try:
+        resolved = getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError, ValueError) as e:
+        raise ValueError(f"unknown transform: {transform}") from e
+    if not callable(resolved):
+        raise ValueError(f"transform is not callable: {transform}")
+    return resolved
+
+
+def postprocess_svg(
+    code: str,
+    equation: str,
+    settings: PelicanMathSettings,
+) -> str:
+    doc = lxml.etree.fromstring(
+        code.encode(),
+        parser=lxml.etree.ETCompatXMLParser(),
+    )
+    for transform in DEFAULT_TRANSFORMS:
+        transform(doc, equation, settings)
+    for transform in settings.transforms:
+        resolve_transform(transform)(doc, equation, settings)
+    if settings.optimizer == "builtin":
+        optimize(doc, settings.builtin_precision)
+    return lxml.etree.tostring(doc).decode()
@@ -1,59 +1,59 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 import importlib.resources
 import logging
 import os
 from pathlib import Path
-import shutil
 import subprocess
+import threading
+import time
+from typing import Callable
 import uuid
 
-import lxml.etree
-
-from .database import Database
+from .database import get_database, hash_equation, render_cache
+from .latex_format import ensure_format, get_format_env
+from .normalize import get_cache_key, patch_title
+from .scratch import get_workspace, keep_failed
 from .settings import PelicanMathSettings
+from .stats import StageStats, amortize
+from .store import svg_markup
+from .workers import run_scour_in_process, run_svgo_server
 
 
-def remove_svg_comments(code: str) -> str:
-    return lxml.etree.tostring(
-        lxml.etree.fromstring(code.encode(), parser=lxml.etree.ETCompatXMLParser()),
-    ).decode()
+class RenderError(Exception):
+    pass
 
 
-def remove_svg_pageid(code: str) -> str:
-    doc = lxml.etree.fromstring(code.encode(), parser=lxml.etree.ETCompatXMLParser())
-    for element in doc.xpath(
-        "//svg:g",
-        namespaces={"svg": "http://www.w3.org/2000/svg"},
-    ):
-        if element.attrib.get("id", "") == "page1":
-            element.attrib.pop("id")
-    return lxml.etree.tostring(doc).decode()
+# renders the missing equations of pages, shared by all pages of a process
+_executor: tuple[int, ThreadPoolExecutor] | None = None
+_executor_lock = threading.Lock()
 
 
-def fix_strokeonly(code: str, css_class: str) -> str:
-    doc = lxml.etree.fromstring(code.encode(), parser=lxml.etree.ETCompatXMLParser())
-    for element in doc.xpath(
-        "//svg:path[@fill='none' and @stroke='#000']",
-        namespaces={"svg": "http://www.w3.org/2000/svg"},
-    ):
-        element.attrib.pop("stroke")
-        element.attrib["class"] = css_class
-    return lxml.etree.tostring(doc).decode()
+def get_executor(settings: PelicanMathSettings) -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if (_executor is None) or (_executor[0] != os.getpid()):
+            _executor = (os.getpid(), ThreadPoolExecutor(max(settings.jobs, 1)))
+        return _executor[1]
 
 
-def add_title(code: str, equation: str) -> str:
-    doc = lxml.etree.fromstring(code.encode(), parser=lxml.etree.ETCompatXMLParser())
-    title = lxml.etree.SubElement(doc, "title")
-    title.text = f"${equation}$"
-    return lxml.etree.tostring(doc).decode()
+def split_batches(equations: list[str], batch_size: int) -> list[list[str]]:
+    batch_size = max(batch_size, 1)
+    return [equations[i : i + batch_size] for i in range(0, len(equations), batch_size)]
 
 
 def run_scour(
     code: str,
     args: list[str],
     logger: logging.Logger = logging.getLogger(__name__ + ".run_scour"),
+    in_process: bool = True,
 ) -> str:
+    if in_process:
+        result = run_scour_in_process(code, args, logger)
+        if result is not None:
+            return result
+
     logger.debug("Run scour")
     cmd = ["scour"] + args
     result = (
@@ -73,7 +73,15 @@ def run_svgo(
     args: list[str],
     titles: bool,
     logger: logging.Logger = logging.getLogger(__name__ + ".run_svgo"),
+    server: bool = True,
+    servers: int = 1,
 ) -> str:
+    # servers is the maximum number of concurrently running svgo servers
+    if server:
+        result = run_svgo_server(code, args, titles, logger, servers)
+        if result is not None:
+            return result
+
     if not titles:
         logger.debug("Run svgo")
         cmd = ["svgo", "--input", "-", "--output", "-"] + args
@@ -113,36 +121,35 @@ def run_svgo(
         return result
 
 
-def render_svg(math: str, inline: bool, settings: PelicanMathSettings) -> str:
-    logger = logging.getLogger(__name__ + ".render_svg")
-
-    if os.environ.get("PELICAN_MATH_SVG_DRY", "FALSE").upper() == "FALSE":
-        dry_mode = False
-    else:
-        dry_mode = True
-
-    equation = math.strip()
+def render_fallback(equation: str) -> str:
+    return f"<code>${equation}$</code>"
 
-    db = Database()
-    svg, settings_string = db.fetch_rendered_equation(inline, equation)
-    if (svg is not None) and (settings_string == settings.serialize()):
-        logger.debug("Equation up-to-date")
-        return svg
 
-    if dry_mode:
-        logger.debug("Add unrendered equation to DB")
-        db.add_equation(inline, equation, settings)
-        return f"<code>${equation}$</code>"
+def generate_preamble(
+    settings: PelicanMathSettings,
+    multipage: bool,
+) -> list[str]:
+    if not multipage:
+        return list(settings.latex_preamble)
 
-    equationid = uuid.uuid4().hex
-    working_dir = Path.cwd() / ".cache" / "pelican-math-svg" / "tmp" / equationid
-    if working_dir.exists():
-        shutil.rmtree(working_dir)
-    working_dir.mkdir(parents=True)
+    # put every equation on a separate page of the document
+    if any(r"{standalone}" in line for line in settings.latex_preamble):
+        return (
+            [r"\PassOptionsToClass{multi=mathsvgpage}{standalone}"]
+            + settings.latex_preamble
+            + [r"\newenvironment{mathsvgpage}{}{}"]
+        )
+    return settings.latex_preamble + [
+        r"\newenvironment{mathsvgpage}{}{\newpage}",
+    ]
 
-    handler = logging.FileHandler(working_dir / "render.log")
-    handler.setLevel(logging.DEBUG)
 
+def generate_latex(
+    equations: list[str],
+    inline: bool,
+    settings: PelicanMathSettings,
+    multipage: bool,
+) -> str:
     # generate LaTeX code
     if inline:
         math_open = r"\("
@@ -151,119 +158,524 @@ def render_svg(math: str, inline: bool, settings: PelicanMathSettings) -> str:
         math_open = r"\("
         math_close = r"\)"
 
-    code = settings.latex_preamble + [
-        r"\begin{document}",
-        math_open,
-        equation,
-        math_close,
-        r"\end{document}",
-    ]
+    code = generate_preamble(settings, multipage) + [r"\begin{document}"]
+    for equation in equations:
+        if multipage:
+            code += [
+                r"\begin{mathsvgpage}",
+                math_open,
+                equation,
+                math_close,
+                r"\end{mathsvgpage}",
+            ]
+        else:
+            code += [math_open, equation, math_close]
+    code.append(r"\end{document}")
+    return "\n".join(code)
+
+
+def get_scale_args(inline: bool, settings: PelicanMathSettings) -> list[str]:
+    if inline:
+        scale = settings.scale_inline
+    else:
+        scale = settings.scale_display
+
+    if scale == 1.0:
+        return []
+
+    if isinstance(scale, tuple):
+        return [f"--scale={scale[0]},{scale[1]}"]
+
+    return [f"--scale={scale}"]
+
+
+def get_latex_args(settings: PelicanMathSettings) -> list[str]:
+    if settings.pipeline == "dvi":
+        return ["--output-format=dvi"] + settings.latex_args
+    return list(settings.latex_args)
+
+
+def get_dvisvgm_args(settings: PelicanMathSettings) -> list[str]:
+    if settings.pipeline == "pdf":
+        return list(settings.dvisvgm_args)
+
+    # without pdfcrop the bounding box has to be computed by dvisvgm
+    args = [arg for arg in settings.dvisvgm_args if arg != "--pdf"]
+    if not any(arg.startswith(("--exact-bbox", "--bbox")) for arg in args):
+        args.append("--exact-bbox")
+    return args
+
+
+def run_command(
+    cmd: list[str],
+    logger: logging.Logger,
+    env: dict[str, str] | None = None,
+):
+    logger.debug(f"{cmd=}")
+    output = subprocess.check_output(cmd, env=env).decode()
+    for line in output.splitlines():
+        logger.debug(line)
+
+
+def compile_svgs(
+    equations: list[str],
+    inline: bool,
+    settings: PelicanMathSettings,
+    working_dir: Path,
+    logger: logging.Logger,
+    stats: list[StageStats],
+) -> list[str]:
+    # the precompiled format always contains the multi-page preamble
+    multipage = (len(equations) > 1) or settings.latex_format
+
+    format_args: list[str] = []
+    format_env: dict[str, str] | None = None
+    if settings.latex_format:
+        format_path = ensure_format(
+            settings,
+            generate_preamble(settings, True),
+            logger,
+        )
+        if format_path is not None:
+            format_args = [f"--fmt={format_path.stem}"]
+            format_env = get_format_env(format_path)
 
     # write LaTeX file
     texfile_path = working_dir / "input.tex"
     with open(texfile_path, "w") as fptr:
-        fptr.write("\n".join(code))
-
-    try:
-        # render LaTeX to pdf file
-        logger.debug("Rendering LaTeX")
-        cmd = (
-            [
-                settings.latex_program,
-                f"--output-directory={working_dir}",
-            ]
-            + settings.latex_args
-            + [
-                str(texfile_path),
-            ]
-        )
-        logger.debug(f"{cmd=}")
-        output = subprocess.check_output(cmd).decode()
-        for line in output.splitlines():
-            logger.debug(line)
-        logger.debug("Finished rendering LaTeX")
+        fptr.write(generate_latex(equations, inline, settings, multipage))
+
+    # render LaTeX to pdf or dvi file
+    logger.debug("Rendering LaTeX")
+    start = time.perf_counter()
+    run_command(
+        [
+            settings.latex_program,
+            f"--output-directory={working_dir}",
+        ]
+        + format_args
+        + get_latex_args(settings)
+        + [
+            str(texfile_path),
+        ],
+        logger,
+        format_env,
+    )
+    if settings.pipeline == "dvi":
+        latex_output = working_dir / "input.dvi"
+    else:
+        latex_output = working_dir / "input.pdf"
+    stats.append(
+        StageStats(
+            "latex",
+            time.perf_counter() - start,
+            texfile_path.stat().st_size,
+            latex_output.stat().st_size,
+        ),
+    )
+    logger.debug("Finished rendering LaTeX")
 
+    env: dict[str, str] | None = None
+    if settings.pipeline == "pdf":
+        # pdfcrop crops every page of the document separately
         logger.debug("Cropping PDF")
-        cmd = (
-            ["pdfcrop"] + settings.pdfcrop_args + [str(Path(working_dir) / "input.pdf")]
+        start = time.perf_counter()
+        run_command(
+            ["pdfcrop"] + settings.pdfcrop_args + [str(latex_output)],
+            logger,
+        )
+        stats.append(
+            StageStats(
+                "pdfcrop",
+                time.perf_counter() - start,
+                latex_output.stat().st_size,
+                (working_dir / "input-crop.pdf").stat().st_size,
+            ),
         )
-        logger.debug(f"{cmd=}")
-        output = subprocess.check_output(cmd).decode()
-        for line in output.splitlines():
-            logger.debug(line)
         logger.debug("Finished cropping PDF")
+        latex_output = working_dir / "input-crop.pdf"
 
-        # convert pdf to svg
-        svgfile_path = working_dir / "output.svg"
-        if inline:
-            scale = settings.scale_inline
-        else:
-            scale = settings.scale_display
-        scale_args = []
-        if scale != 1.0:
-            if isinstance(scale, tuple):
-                scale_args = [
-                    f"--scale={scale[0]},{scale[1]}",
-                ]
-            else:
-                scale_args = [
-                    f"--scale={scale}",
-                ]
-
-        logger.debug("Convert PDF to SVG")
-        cmd = (
-            [
-                "dvisvgm",
-            ]
-            + settings.dvisvgm_args
-            + scale_args
-            + [
-                f"--output={svgfile_path}",
-                str(Path(working_dir) / "input-crop.pdf"),
-            ]
-        )
         env = os.environ.copy()
         env["GS_OPTIONS"] = "-dNEWPDF=false"
-        logger.debug(f"{cmd=}")
-        output = subprocess.check_output(cmd, env=env).decode()
-        for line in output.splitlines():
-            logger.debug(line)
-        logger.debug("Finished converting PDF to SVG")
 
-        with open(svgfile_path) as fptr:
-            svg = fptr.read().strip()
+    # convert all pages to svg in a single dvisvgm run
+    logger.debug("Convert to SVG")
+    start = time.perf_counter()
+    run_command(
+        [
+            "dvisvgm",
+        ]
+        + get_dvisvgm_args(settings)
+        + get_scale_args(inline, settings)
+        + [
+            "--page=1-",
+            f"--output={working_dir / 'output-%p.svg'}",
+            str(latex_output),
+        ],
+        logger,
+        env,
+    )
+    logger.debug("Finished converting to SVG")
+
+    pages: dict[int, Path] = {
+        int(path.stem.rsplit("-", 1)[1]): path
+        for path in working_dir.glob("output-*.svg")
+    }
+    if sorted(pages) != list(range(1, len(equations) + 1)):
+        raise RenderError(
+            f"expected {len(equations)} pages, dvisvgm produced {len(pages)}",
+        )
 
-        logging.info("Remove SVG comments")
-        svg = remove_svg_comments(svg)
+    svgs = []
+    for page in sorted(pages):
+        with open(pages[page]) as fptr:
+            svgs.append(fptr.read().strip())
+    stats.append(
+        StageStats(
+            "dvisvgm",
+            time.perf_counter() - start,
+            latex_output.stat().st_size,
+            sum(len(svg.encode()) for svg in svgs),
+        ),
+    )
+    return svgs
 
-        logging.info("Remove SVG pageid")
-        svg = remove_svg_pageid(svg)
 
-        logging.info("Fix strokeonly class")
-        svg = fix_strokeonly(svg, settings.strokeonly_class)
+def process_svg(
+    svg: str,
+    equation: str,
+    settings: PelicanMathSettings,
+    logger: logging.Logger,
+    stats: list[StageStats],
+) -> str:
+    def run_stage(stage: str, function: Callable[[str], str], svg: str) -> str:
+        start = time.perf_counter()
+        result = function(svg)
+        stats.append(
+            StageStats(
+                stage,
+                time.perf_counter() - start,
+                len(svg.encode()),
+                len(result.encode()),
+            ),
+        )
+        return result
 
-        if settings.titles:
-            logger.debug("Add title to SVG")
-            svg = add_title(svg, equation)
+    # lxml is only imported when an equation is actually rendered
+    from .postprocess import postprocess_svg
 
-        if settings.scour:
-            svg = run_scour(svg, settings.scour_args, logger)
+    logger.debug("Post-process SVG")
+    svg = run_stage(
+        "postprocess",
+        lambda svg: postprocess_svg(svg, equation, settings),
+        svg,
+    )
 
-        if settings.svgo:
-            svg = run_svgo(svg, settings.svgo_args, settings.titles, logger)
+    if settings.optimizer is None:
+        use_scour = settings.scour
+        use_svgo = settings.svgo
+    else:
+        use_scour = settings.optimizer == "scour"
+        use_svgo = settings.optimizer == "svgo"
+
+    if use_scour:
+        svg = run_stage(
+            "scour",
+            lambda svg: run_scour(
+                svg,
+                settings.scour_args,
+                logger,
+                settings.scour_in_process,
+            ),
+            svg,
+        )
 
-        logger.removeHandler(handler)
-        handler.close()
-        logger.debug("Remove working directory")
-        shutil.rmtree(working_dir)
+    if use_svgo:
+        svg = run_stage(
+            "svgo",
+            lambda svg: run_svgo(
+                svg,
+                settings.svgo_args,
+                settings.titles,
+                logger,
+                settings.svgo_server,
+                settings.jobs,
+            ),
+            svg,
+        )
 
-        logger.debug("Store rendered equation")
-        db.add_equation(inline, equation, settings, svg)
+    return svg
+
+
+class ForwardHandler(logging.Handler):
+    # passes records on to another logger if it is enabled for their level
+    def __init__(self, target: logging.Logger):
+        super().__init__()
+        self.target = target
+
+    def emit(self, record: logging.LogRecord):
+        # Logger.handle is bypassed, the filters of Pelican's logger class
+        # raise exceptions that are only caught inside Logger._log
+        if self.target.isEnabledFor(record.levelno):
+            self.target.callHandlers(record)
+
+
+def get_job_logger(
+    jobid: str,
+    path: Path,
+) -> tuple[logging.Logger, logging.Handler]:
+    # Every job gets its own logger writing all records to the job's log file,
+    # concurrent jobs do not mix their output. The logger is not registered
+    # with the logging module and is garbage collected with the job.
+    logger = logging.Logger(f"{__name__}.render_equations.{jobid}", logging.DEBUG)
+    handler = logging.FileHandler(path)
+    logger.addHandler(handler)
+    logger.addHandler(
+        ForwardHandler(logging.getLogger(__name__ + ".render_equations")),
+    )
+    return logger, handler
+
+
+def render_equations(
+    equations: list[str],
+    inline: bool,
+    settings: PelicanMathSettings,
+) -> list[str | None]:
+    # Render all equations as pages of a single LaTeX document. When the batch
+    # fails it is bisected until the failing equations are isolated, those are
+    # returned as None.
+    if not equations:
+        return []
+
+    jobid = uuid.uuid4().hex
+    batch_stats: list[StageStats] = []
+    stats: list[tuple[str, list[StageStats]]] = []
+    failed = False
+
+    with get_workspace(settings) as working_dir:
+        logger, handler = get_job_logger(jobid, working_dir / "render.log")
+        try:
+            svgs = compile_svgs(
+                equations,
+                inline,
+                settings,
+                working_dir,
+                logger,
+                batch_stats,
+            )
+            for index, equation in enumerate(equations):
+                stats.append(
+                    (
+                        equation,
+                        [amortize(entry, len(equations)) for entry in batch_stats],
+                    ),
+                )
+                svgs[index] = process_svg(
+                    svgs[index],
+                    equation,
+                    settings,
+                    logger,
+                    stats[-1][1],
+                )
+        except (subprocess.CalledProcessError, RenderError) as e:
+            failed = True
+            if len(equations) > 1:
+                logger.debug(f"Batch {jobid} failed, bisecting")
+            else:
+                logger.error(f"error rendering formula in job {jobid}")
+                if isinstance(e, subprocess.CalledProcessError):
+                    logger.error(f"{e.cmd=}")
+                    logger.error(f"{e.returncode=}")
+                    logger.error(f"{e.stderr=}")
+                else:
+                    logger.error(str(e))
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        if failed and (len(equations) == 1):
+            kept = keep_failed(working_dir, jobid, settings)
+            if kept is not None:
+                logger.error(f"files of job {jobid} are kept in {kept}")
+            return [None]
+
+    if failed:
+        # the halves are rendered after the workspace was released
+        middle = len(equations) // 2
+        return render_equations(
+            equations[:middle],
+            inline,
+            settings,
+        ) + render_equations(equations[middle:], inline, settings)
+
+    get_database(settings).add_stats(inline, stats, settings)
+    return list(svgs)
+
+
+def is_dry_mode() -> bool:
+    return os.environ.get("PELICAN_MATH_SVG_DRY", "FALSE").upper() != "FALSE"
+
+
+def fetch_svg(
+    equation: str,
+    inline: bool,
+    settings: PelicanMathSettings,
+    prefetched: dict[str, str | None] | None = None,
+) -> str | None:
+    # look up a rendered equation in the renders prefetched for the current
+    # page, the in-memory cache and the database
+    if (prefetched is not None) and (equation in prefetched):
+        return prefetched[equation]
+
+    key = (inline, hash_equation(equation), settings.fingerprint)
+    svg = render_cache.get(key)
+    if svg is not None:
         return svg
 
-    except subprocess.CalledProcessError as e:
-        logger.error(f"error rendering formula, check job {equationid}")
-        logger.error(f"{e.cmd=}")
-        logger.error(f"{e.returncode=}")
-        logger.error(f"{e.stderr=}")
-        return f"<code>${equation}$</code>"
+    svg = get_database(settings).fetch_rendered_equation(inline, equation, settings)
+    if svg is not None:
+        logging.getLogger(__name__ + ".fetch_svg").debug("Equation up-to-date")
+        render_cache.put(key, svg)
+    return svg
+
+
+def store_svg(equation: str, inline: bool, settings: PelicanMathSettings, svg: str):
+    get_database(settings).add_equation(inline, equation, settings, svg)
+    render_cache.put((inline, hash_equation(equation), settings.fingerprint), svg)
+
+
+def prefetch_svgs(
+    equations: list[str],
+    inline: bool,
+    settings: PelicanMathSettings,
+) -> dict[str, str | None]:
+    # Resolve all equations of a page up front: renders are looked up with a
+    # single query and, with the sync engine, the missing ones are rendered in
+    # parallel. Returns the renders by cache key, None if the equation could
+    # not be rendered (yet).
+    logger = logging.getLogger(__name__ + ".prefetch_svgs")
+
+    keys = dict.fromkeys(
+        get_cache_key(equation.strip(), settings) for equation in equations
+    )
+    svgs: dict[str, str | None] = {}
+    missing: list[str] = []
+    for key in keys:
+        svg = render_cache.get((inline, hash_equation(key), settings.fingerprint))
+        if svg is None:
+            missing.append(key)
+        else:
+            svgs[key] = svg
+    if not missing:
+        return svgs
+
+    fetched = get_database(settings).fetch_rendered_equations(inline, missing, settings)
+    for key, svg in fetched.items():
+        render_cache.put((inline, hash_equation(key), settings.fingerprint), svg)
+    svgs.update(fetched)
+    missing = [key for key in missing if key not in fetched]
+    if not missing:
+        return svgs
+
+    # the async engine renders the missing equations in the background
+    rendered: list[str | None] = [None] * len(missing)
+    if is_dry_mode():
+        logger.debug("Add unrendered equations to DB")
+        get_database(settings).add_missing_equations(inline, missing, settings)
+    elif settings.engine != "async":
+        # One batch per job, every batch is a single LaTeX run that is
+        # bisected if it fails. render_equations runs external tools, threads
+        # render the batches in parallel.
+        batches = split_batches(missing, -(-len(missing) // max(settings.jobs, 1)))
+        logger.debug(
+            f"Rendering {len(missing)} missing equations in {len(batches)} batches",
+        )
+        rendered = [
+            svg
+            for svgs in get_executor(settings).map(
+                lambda batch: render_equations(batch, inline, settings),
+                batches,
+            )
+            for svg in svgs
+        ]
+        get_database(settings).add_equations_bulk(
+            inline,
+            [(key, svg) for key, svg in zip(missing, rendered) if svg is not None],
+            settings,
+        )
+        for key, svg in zip(missing, rendered):
+            if svg is not None:
+                render_cache.put(
+                    (inline, hash_equation(key), settings.fingerprint), svg
+                )
+
+    svgs.update(zip(missing, rendered))
+    return svgs
+
+
+def lookup_svg(
+    math: str,
+    inline: bool,
+    settings: PelicanMathSettings,
+    prefetched: dict[str, str | None] | None = None,
+) -> str | None:
+    # returns None if the equation could not be rendered (yet)
+    logger = logging.getLogger(__name__ + ".lookup_svg")
+
+    equation = math.strip()
+    key = get_cache_key(equation, settings)
+
+    svg = fetch_svg(key, inline, settings, prefetched)
+    if svg is None:
+        if (prefetched is not None) and (key in prefetched):
+            # rendering the equation failed or was skipped in dry mode
+            return None
+
+        if is_dry_mode():
+            logger.debug("Add unrendered equation to DB")
+            get_database(settings).add_equation(inline, key, settings)
+            return None
+
+        svg = render_equations([key], inline, settings)[0]
+        if svg is None:
+            return None
+
+        logger.debug("Store rendered equation")
+        store_svg(key, inline, settings, svg)
+
+    if key != equation:
+        return patch_title(svg, equation, settings)
+    return svg
+
+
+def render_svg(math: str, inline: bool, settings: PelicanMathSettings) -> str:
+    svg = lookup_svg(math, inline, settings)
+    if svg is None:
+        return render_fallback(math.strip())
+    return svg
+
+
+def render_markup(
+    math: str,
+    inline: bool,
+    settings: PelicanMathSettings,
+    prefetched: dict[str, str | None] | None = None,
+) -> str:
+    # HTML embedding the equation according to the output mode
+    if settings.engine == "async" and not is_dry_mode():
+        # imported here, the engine itself depends on this module
+        from .engine import get_engine
+
+        equation = math.strip()
+        key = get_cache_key(equation, settings)
+        svg = fetch_svg(key, inline, settings, prefetched)
+        if svg is None:
+            return get_engine(settings).submit(key, inline, equation)
+        if key != equation:
+            svg = patch_title(svg, equation, settings)
+        return svg_markup(svg, equation, settings)
+
+    svg = lookup_svg(math, inline, settings, prefetched)
+    if svg is None:
+        return render_fallback(math.strip())
+    return svg_markup(svg, math.strip(), settings)
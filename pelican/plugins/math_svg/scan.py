@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import fnmatch
+import hashlib
+import logging
+from pathlib import Path
+import re
+from typing import NamedTuple
+
+from .database import Database
+from .extension import INLINE_MATH_PATTERN
+from .markdown_extension import DisplayMathProcessor
+from .normalize import get_cache_key
+from .settings import PelicanMathSettings
+
+# file extensions handled by Pelican's MarkdownReader
+MARKDOWN_EXTENSIONS = {".md", ".markdown", ".mkd", ".mdown"}
+
+RE_INLINE = re.compile(INLINE_MATH_PATTERN, re.DOTALL | re.UNICODE)
+RE_FENCE = re.compile(
+    r"^(?P<indent> {0,3})(?P<fence>`{3,}|~{3,}).*?\n.*?^(?P=indent)(?P=fence)[ ]*$",
+    re.MULTILINE | re.DOTALL,
+)
+RE_LIST_ITEM = re.compile(r"^ {0,3}(?:[*+-]|\d+\.)[ ]+")
+# python-markdown's tab_length
+INDENT = " " * 4
+
+
+class ScanResult(NamedTuple):
+    scanned: int
+    skipped: int
+    inline: int
+    display: int
+
+
+def normalize_source(text: str) -> str:
+    # the same normalization python-markdown applies before parsing
+    text = text.replace("\x02", "").replace("\x03", "")
+    text = text.replace("\r\n", "\n").replace("\r", "\n") + "\n\n"
+    text = text.expandtabs(4)
+    text = re.sub(r"(?<=\n) +\n", "\n", text)
+    return text
+
+
+def is_code_block(block: str, in_list: bool) -> bool:
+    # indented blocks are code, unless they continue a list item where code
+    # is indented by another level
+    return block.startswith(INDENT * 2 if in_list else INDENT)
+
+
+def extract_equations(text: str) -> tuple[list[str], list[str]]:
+    # Mirror the block splitting of python-markdown and the logic of
+    # DisplayMathProcessor/InlineMathProcessor. This is an approximation,
+    # equations that are missed are rendered during the Pelican build. Code
+    # blocks are skipped, inline patterns never see them.
+    text = RE_FENCE.sub("", normalize_source(text))
+    blocks = text.split("\n\n")
+
+    inline: list[str] = []
+    display: list[str] = []
+    in_list = False
+    while blocks:
+        block = blocks.pop(0)
+        code = is_code_block(block, in_list)
+        if RE_LIST_ITEM.match(block):
+            in_list = True
+        elif not block.startswith(INDENT):
+            in_list = False
+
+        if DisplayMathProcessor.RE_START.match(block):
+            candidates = [DisplayMathProcessor.RE_START.sub("", block)] + blocks
+            end = next(
+                (
+                    index
+                    for index, candidate in enumerate(candidates)
+                    if DisplayMathProcessor.RE_END.search(candidate)
+                ),
+                None,
+            )
+            if end is not None:
+                display.append(
+                    DisplayMathProcessor.RE_END.sub("", candidates[end]).strip(),
+                )
+                del blocks[:end]
+                continue
+
+        if not code:
+            inline += [m.group(1).strip() for m in RE_INLINE.finditer(block)]
+
+    return inline, display
+
+
+def find_sources(content_path: Path, ignore: list[str]) -> list[Path]:
+    return sorted(
+        path
+        for path in content_path.rglob("*")
+        if path.suffix in MARKDOWN_EXTENSIONS
+        and path.is_file()
+        and not any(fnmatch.fnmatch(path.name, pattern) for pattern in ignore)
+    )
+
+
+def scan_sources(
+    content_path: Path,
+    settings: PelicanMathSettings,
+    db: Database,
+    ignore: list[str] = [],
+    logger: logging.Logger = logging.getLogger(__name__ + ".scan_sources"),
+) -> ScanResult:
+    scanned = skipped = inline_count = display_count = 0
+    for path in find_sources(content_path, ignore):
+        name = str(path.relative_to(content_path))
+        mtime = path.stat().st_mtime
+
+        known = db.fetch_source(name, settings)
+        if (known is not None) and (known[0] == mtime):
+            skipped += 1
+            continue
+
+        data = path.read_bytes()
+        digest = hashlib.sha256(data).hexdigest()
+        if (known is not None) and (known[1] == digest):
+            db.update_source(name, mtime, digest, settings)
+            skipped += 1
+            continue
+
+        logger.debug(f"Scanning {name}")
+        inline, display = extract_equations(data.decode("utf-8"))
+        db.add_missing_equations(
+            True,
+            [get_cache_key(equation, settings) for equation in inline],
+            settings,
+        )
+        db.add_missing_equations(
+            False,
+            [get_cache_key(equation, settings) for equation in display],
+            settings,
+        )
+        db.update_source(name, mtime, digest, settings)
+
+        scanned += 1
+        inline_count += len(inline)
+        display_count += len(display)
+
+    return ScanResult(scanned, skipped, inline_count, display_count)
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+import getpass
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+
+from .settings import PelicanMathSettings
+
+# Workspaces are numbered slots of this process. A slot is returned to the
+# free list when its job finishes, the number of workspaces is bounded by the
+# number of concurrent jobs (threads of short-lived executors get new idents
+# all the time).
+_free_slots: list[int] = []
+_slot_count = 0
+# scratch roots that were already cleaned up by this process
+_collected: set[tuple[int, Path]] = set()
+_lock = threading.Lock()
+
+
+def forget_slots():
+    # the slots of a forked child are named after its own pid
+    global _slot_count, _lock
+    _free_slots.clear()
+    _slot_count = 0
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=forget_slots)
+
+
+def get_scratch_root(settings: PelicanMathSettings) -> Path:
+    if settings.scratch_dir is not None:
+        return Path(settings.scratch_dir)
+
+    # prefer memory-backed storage, LaTeX writes several small files per job
+    base = Path("/dev/shm")
+    if not (base.is_dir() and os.access(base, os.W_OK)):
+        base = Path(tempfile.gettempdir())
+    return base / f"pelican-math-svg-{getpass.getuser()}"
+
+
+def is_alive(pid: int) -> bool:
+    if os.name == "nt":
+        # os.kill terminates processes on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def get_size(path: Path) -> int:
+    return sum(entry.stat().st_size for entry in path.rglob("*") if entry.is_file())
+
+
+def clear_directory(path: Path):
+    for entry in path.iterdir():
+        if entry.is_dir() and not entry.is_symlink():
+            shutil.rmtree(entry)
+        else:
+            entry.unlink()
+
+
+def prune_failed(root: Path, limit: int):
+    # remove the oldest failed jobs until they fit into the size limit
+    failed = root / "failed"
+    if not failed.is_dir():
+        return
+
+    jobs = sorted(failed.iterdir(), key=lambda path: path.stat().st_mtime)
+    sizes = [get_size(job) for job in jobs]
+    total = sum(sizes)
+    for job, size in zip(jobs, sizes):
+        if total <= limit:
+            break
+        shutil.rmtree(job, ignore_errors=True)
+        total -= size
+
+
+def collect_garbage(
+    root: Path,
+    settings: PelicanMathSettings,
+    logger: logging.Logger = logging.getLogger(__name__ + ".collect_garbage"),
+):
+    # workspaces of processes that no longer exist are left over by crashes or
+    # terminated pool workers
+    workers = root / "workers"
+    if workers.is_dir():
+        for workspace in workers.iterdir():
+            pid = workspace.name.split("-", 1)[0]
+            if pid.isdigit() and not is_alive(int(pid)):
+                logger.debug(f"Remove orphaned workspace {workspace}")
+                shutil.rmtree(workspace, ignore_errors=True)
+
+    prune_failed(root, settings.scratch_keep_failed)
+
+
+@contextmanager
+def get_workspace(settings: PelicanMathSettings) -> Iterator[Path]:
+    # An empty working directory for a render job, it is emptied again and
+    # handed to the next job when the job finishes.
+    global _slot_count
+    root = get_scratch_root(settings)
+    pid = os.getpid()
+
+    with _lock:
+        if (pid, root) not in _collected:
+            collect_garbage(root, settings)
+            _collected.add((pid, root))
+
+        if _free_slots:
+            slot = _free_slots.pop()
+        else:
+            slot = _slot_count
+            _slot_count += 1
+
+    workspace = root / "workers" / f"{pid}-{slot}"
+    try:
+        if workspace.exists():
+            clear_directory(workspace)
+        else:
+            workspace.mkdir(parents=True)
+        yield workspace
+    finally:
+        if workspace.exists():
+            clear_directory(workspace)
+        with _lock:
+            _free_slots.append(slot)
+
+
+def keep_failed(
+    workspace: Path,
+    jobid: str,
+    settings: PelicanMathSettings,
+) -> Path | None:
+    # move the files of a failed job out of the workspace for inspection,
+    # returns None if they were discarded
+    if settings.scratch_keep_failed <= 0:
+        clear_directory(workspace)
+        return None
+
+    root = get_scratch_root(settings)
+    target = root / "failed" / jobid
+    target.mkdir(parents=True)
+    for entry in workspace.iterdir():
+        entry.rename(target / entry.name)
+
+    with _lock:
+        prune_failed(root, settings.scratch_keep_failed)
+    if not target.exists():
+        # larger than the limit on its own
+        return None
+    return target
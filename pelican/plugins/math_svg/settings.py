@@ -1,27 +1,80 @@
 from __future__ import annotations
 
+from collections.abc import Callable
+from functools import cache, cached_property
+import hashlib
 import json
-import shutil
+import os
 from typing import Any
 
-import pkg_resources
-
 from pelican import Pelican
 
+from .compress import get_zstandard
+from .tools import which
+
+
+@cache
+def get_plugin_version() -> str:
+    # importlib.metadata is slow to import and only needed once
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return version("pelican-math-svg")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def fingerprint_settings(serialized: str) -> str:
+    return hashlib.sha256(serialized.encode()).hexdigest()[:16]
+
 
 class PelicanMathSettings:
     def __init__(self):
-        self.plugin_version: str = pkg_resources.get_distribution(
-            "pelican-math-svg",
-        ).version
+        self.plugin_version: str = get_plugin_version()
 
         self.titles: bool = True
 
+        # render equivalent equations once, by removing whitespace that TeX
+        # ignores and braces around single tokens in sub- and superscripts
+        self.normalize_whitespace: bool = False
+        self.normalize_braces: bool = False
+
         self.scale_display: float | tuple[float, float] = 1.0
         self.scale_inline: float | tuple[float, float] = 1.0
 
         self.strokeonly_class: str = "strokeonly"
 
+        # "inline" embeds the SVG markup, "img" and "object" reference files
+        # written to output_dir, "sprite" embeds the SVG markup but references
+        # the glyphs in a sprite file written to output_dir
+        self.output: str = "inline"
+        self.output_dir: str = "math"
+        self.output_url: str = "/math"
+
+        # maximum number of SVGs kept in memory by each process
+        self.cache_size: int = 4096
+        # directory of the equation database and the LaTeX formats, relative
+        # paths are relative to the working directory
+        self.cache_path: str = os.path.join(".cache", "pelican-math-svg")
+
+        # compression of the renders stored in the database: "zlib", "zstd"
+        # (requires zstandard) or "none"
+        self.compression: str = "zlib"
+
+        # "sync" renders equations while parsing, "async" renders them in the
+        # background and fills them into the written files at the end
+        self.engine: str = "sync"
+        self.jobs: int = os.cpu_count() or 1
+
+        # working directories of render jobs, None uses /dev/shm if possible
+        self.scratch_dir: str | None = None
+        # maximum total size of the kept files of failed jobs in bytes
+        self.scratch_keep_failed: int = 64 * 1024 * 1024
+
+        # additional transforms applied to the parsed SVG, either callables or
+        # dotted import paths
+        self.transforms: list[str | Callable] = []
+
         self.latex_preamble: list[str] = [
             r"\documentclass[preview,border={2pt 0pt}]{standalone}",
             r"\usepackage{amsmath}",
@@ -29,6 +82,11 @@ class PelicanMathSettings:
         ]
         self.latex_program: str = "lualatex"
         self.latex_args: list[str] = ["--interaction=errorstopmode", "--halt-on-error"]
+        self.latex_format: bool = False
+
+        # "pdf" crops the PDF output of LaTeX and converts it with dvisvgm,
+        # "dvi" converts DVI output without cropping
+        self.pipeline: str = "pdf"
 
         self.dvisvgm_args: list[str] = [
             "--pdf",
@@ -41,7 +99,7 @@ class PelicanMathSettings:
             "--hires",
         ]
 
-        self.scour: bool = True if shutil.which("scour") else False
+        self.scour: bool = which("scour") is not None
         self.scour_args: list[str] = [
             "--strip-xml-prolog",
             "--remove-descriptions",
@@ -50,8 +108,15 @@ class PelicanMathSettings:
             "--strip-xml-space",
             "--enable-id-stripping",
         ]
-        self.svgo: bool = True if shutil.which("svgo") else False
+        self.scour_in_process: bool = True
+        self.svgo: bool = which("svgo") is not None
         self.svgo_args: list[str] = ["--multipass", "--precision", "5"]
+        self.svgo_server: bool = True
+
+        # None runs scour and/or svgo depending on their enabled flags,
+        # otherwise exactly one of "builtin", "scour" or "svgo" is used
+        self.optimizer: str | None = None
+        self.builtin_precision: int = 3
 
     def serialize(self) -> str:
         obj: dict[str, Any] = {
@@ -80,8 +145,32 @@ class PelicanMathSettings:
         if self.svgo_args:
             obj["svgo"]["args"] = self.svgo_args
 
+        if self.transforms:
+            obj["transforms"] = [
+                (
+                    transform
+                    if isinstance(transform, str)
+                    else f"{transform.__module__}.{transform.__qualname__}"
+                )
+                for transform in self.transforms
+            ]
+
+        if self.pipeline != "pdf":
+            obj["pipeline"] = self.pipeline
+
+        if self.optimizer is not None:
+            obj["optimizer"] = self.optimizer
+
+        if self.optimizer == "builtin":
+            obj["builtin"] = {"precision": self.builtin_precision}
+
         return json.dumps(obj)
 
+    @cached_property
+    def fingerprint(self) -> str:
+        # computed on first use, the settings must not change afterwards
+        return fingerprint_settings(self.serialize())
+
     @staticmethod
     def from_settings(pelican: Pelican) -> PelicanMathSettings:
         obj = PelicanMathSettings()
@@ -92,24 +181,85 @@ class PelicanMathSettings:
 
         obj.titles = settings.get("titles", obj.titles)
 
+        if "normalize" in settings:
+            obj.normalize_whitespace = settings["normalize"].get(
+                "whitespace",
+                obj.normalize_whitespace,
+            )
+            obj.normalize_braces = settings["normalize"].get(
+                "braces",
+                obj.normalize_braces,
+            )
+        obj.cache_size = settings.get("cache_size", obj.cache_size)
+        obj.cache_path = str(settings.get("cache_path", obj.cache_path))
+
+        obj.compression = settings.get("compression", obj.compression)
+        if obj.compression not in ("none", "zlib", "zstd"):
+            raise ValueError(f"unknown compression: {obj.compression}")
+        if obj.compression == "zstd" and get_zstandard() is None:
+            raise ValueError("zstd compression requires the zstandard package")
+
+        obj.engine = settings.get("engine", obj.engine)
+        if obj.engine not in ("sync", "async"):
+            raise ValueError(f"unknown render engine: {obj.engine}")
+        obj.jobs = settings.get("jobs", obj.jobs)
+
+        if "scratch" in settings:
+            obj.scratch_dir = settings["scratch"].get("dir", obj.scratch_dir)
+            obj.scratch_keep_failed = settings["scratch"].get(
+                "keep_failed",
+                obj.scratch_keep_failed,
+            )
+
+        obj.output = settings.get("output", obj.output)
+        if obj.output not in ("inline", "img", "object", "sprite"):
+            raise ValueError(f"unknown output mode: {obj.output}")
+        obj.output_dir = settings.get("output_dir", obj.output_dir)
+        obj.output_url = settings.get(
+            "output_url",
+            pelican.settings.get("SITEURL", "").rstrip("/") + "/" + obj.output_dir,
+        )
+
         obj.scale_inline = settings.get("scale_inline", obj.scale_inline)
         obj.scale_display = settings.get("scale_display", obj.scale_display)
 
         latex = settings.get("latex", None)
         if latex is not None:
-            obj.latex_args = latex.get("args", obj.latex_args)
-            obj.latex_preamble = latex.get("preamble", obj.latex_preamble)
+            # copies, the lists of the Pelican settings must not be modified
+            obj.latex_args = list(latex.get("args", obj.latex_args))
+            obj.latex_preamble = list(latex.get("preamble", obj.latex_preamble))
             obj.latex_preamble.extend(latex.get("preamble_extend", ()))
             obj.latex_program = latex.get("program", obj.latex_program)
+            obj.latex_format = latex.get("format", obj.latex_format)
+
+        obj.pipeline = settings.get("pipeline", obj.pipeline)
+        if obj.pipeline not in ("pdf", "dvi"):
+            raise ValueError(f"unknown render pipeline: {obj.pipeline}")
 
         obj.strokeonly_class = settings.get("strokeonly_class", obj.strokeonly_class)
+        obj.transforms = list(settings.get("transforms", obj.transforms))
 
         if "scour" in settings:
             obj.scour = settings["scour"].get("enabled", obj.scour)
             obj.scour_args = settings["scour"].get("args", obj.scour_args)
+            obj.scour_in_process = settings["scour"].get(
+                "in_process",
+                obj.scour_in_process,
+            )
 
         if "svgo" in settings:
             obj.svgo = settings["svgo"].get("enabled", obj.svgo)
             obj.svgo_args = settings["svgo"].get("args", obj.svgo_args)
+            obj.svgo_server = settings["svgo"].get("server", obj.svgo_server)
+
+        obj.optimizer = settings.get("optimizer", obj.optimizer)
+        if obj.optimizer not in (None, "builtin", "scour", "svgo"):
+            raise ValueError(f"unknown SVG optimizer: {obj.optimizer}")
+
+        if "builtin" in settings:
+            obj.builtin_precision = settings["builtin"].get(
+                "precision",
+                obj.builtin_precision,
+            )
 
         return obj
@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import math
+from typing import NamedTuple
+
+# stages running once per LaTeX document, their costs are split evenly between
+# the equations of a batch
+BATCH_STAGES = ("latex", "pdfcrop", "dvisvgm")
+EQUATION_STAGES = ("postprocess", "scour", "svgo")
+
+
+class StageStats(NamedTuple):
+    stage: str
+    seconds: float
+    bytes_in: int | None = None
+    bytes_out: int | None = None
+
+
+def amortize(stats: StageStats, count: int) -> StageStats:
+    return StageStats(
+        stats.stage,
+        stats.seconds / count,
+        None if stats.bytes_in is None else stats.bytes_in // count,
+        None if stats.bytes_out is None else stats.bytes_out // count,
+    )
+
+
+def percentile(values: list[float], q: float) -> float:
+    # nearest-rank percentile
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)]
+
+
+def compression_ratio(stats: list[StageStats]) -> float | None:
+    bytes_in = sum(entry.bytes_in or 0 for entry in stats)
+    bytes_out = sum(entry.bytes_out or 0 for entry in stats)
+    if bytes_in == 0:
+        return None
+    return bytes_out / bytes_in
+
+
+def format_table(header: list[str], rows: list[list[str]]) -> str:
+    widths = [
+        max(len(row[column]) for row in [header] + rows)
+        for column in range(len(header))
+    ]
+    return "\n".join(
+        "  ".join(
+            cell.ljust(width) if column == 0 else cell.rjust(width)
+            for column, (cell, width) in enumerate(zip(row, widths))
+        )
+        for row in [header] + rows
+    )
@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import hashlib
+import html
+import os
+from pathlib import Path
+import re
+import threading
+from typing import TYPE_CHECKING
+import uuid
+
+from .database import hash_equation
+from .settings import PelicanMathSettings
+
+if TYPE_CHECKING:
+    import lxml.etree
+
+RE_SVG_NAME = re.compile(r"^[0-9a-f]{64}\.svg$")
+SPRITE_NAME = "glyphs.svg"
+
+
+def get_svg_name(svg: str) -> str:
+    # files are named after their content, identical renders share a file
+    return hash_equation(svg) + ".svg"
+
+
+def write_svg(path: Path, svg: str):
+    # write to a temporary file first, readers never see partial files
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+    with open(tmp_path, "w") as fptr:
+        fptr.write(svg)
+    os.replace(tmp_path, path)
+
+
+def write_svgs(directory: Path, svgs: dict[str, str], prune: bool = False) -> int:
+    # write missing files and optionally remove files of stale renders,
+    # returns the number of written files
+    directory.mkdir(parents=True, exist_ok=True)
+
+    written = 0
+    for name, svg in svgs.items():
+        path = directory / name
+        if not path.exists():
+            write_svg(path, svg)
+            written += 1
+
+    if prune:
+        for path in directory.iterdir():
+            if RE_SVG_NAME.match(path.name) and (path.name not in svgs):
+                path.unlink()
+
+    return written
+
+
+class SVGStore:
+    # SVGs referenced by the generated HTML that still have to be written
+    def __init__(self):
+        self.svgs: dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def add(self, svg: str) -> str:
+        name = get_svg_name(svg)
+        with self.lock:
+            self.svgs[name] = svg
+        return name
+
+    def write(self, directory: Path) -> int:
+        with self.lock:
+            svgs = dict(self.svgs)
+            self.svgs.clear()
+        return write_svgs(directory, svgs)
+
+
+svg_store = SVGStore()
+
+
+class SpriteStore:
+    # glyph paths shared by all equations, keyed by their symbol id
+    def __init__(self):
+        self.symbols: dict[str, dict[str, str]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, path: lxml.etree._Element, precision: int) -> str:
+        # glyphs are identified by their normalized attributes, small
+        # differences in the path data end up in the same symbol
+        from .optimize import shorten_path_data
+
+        attributes = {
+            name: (shorten_path_data(value, precision) if name == "d" else value)
+            for name, value in sorted(path.attrib.items())
+            if name != "id"
+        }
+        key = " ".join(f"{name}={value}" for name, value in attributes.items())
+        symbol_id = "mg-" + hashlib.sha256(key.encode()).hexdigest()[:10]
+        with self.lock:
+            self.symbols.setdefault(symbol_id, attributes)
+        return symbol_id
+
+    def write(self, directory: Path) -> int:
+        # Merge the symbols into the sprite file of the directory, symbols of
+        # earlier builds are kept because cached pages may still use them.
+        # Returns the number of added symbols.
+        import lxml.etree
+
+        from .optimize import SVG_NAMESPACE
+
+        with self.lock:
+            symbols = dict(self.symbols)
+            self.symbols.clear()
+
+        path = directory / SPRITE_NAME
+        if path.exists():
+            doc = lxml.etree.parse(str(path)).getroot()
+            existing = {
+                symbol.attrib["id"]: dict(symbol[0].attrib)
+                for symbol in doc
+                if len(symbol) and ("id" in symbol.attrib)
+            }
+        else:
+            existing = {}
+
+        added = len(set(symbols) - set(existing))
+        if not added:
+            return 0
+
+        doc = lxml.etree.Element(f"{{{SVG_NAMESPACE}}}svg", nsmap={None: SVG_NAMESPACE})
+        for symbol_id, attributes in sorted({**existing, **symbols}.items()):
+            symbol = lxml.etree.SubElement(doc, f"{{{SVG_NAMESPACE}}}symbol")
+            symbol.attrib["id"] = symbol_id
+            symbol.attrib["overflow"] = "visible"
+            lxml.etree.SubElement(symbol, f"{{{SVG_NAMESPACE}}}path", attributes)
+
+        directory.mkdir(parents=True, exist_ok=True)
+        write_svg(path, lxml.etree.tostring(doc).decode())
+        return added
+
+
+sprite_store = SpriteStore()
+
+
+def sprite_svg(svg: str, store: SpriteStore, url: str, precision: int) -> str:
+    # move the glyphs referenced by <use> elements into the sprite store and
+    # reference them from the sprite file at url instead, lxml is only
+    # imported when sprites are used
+    import lxml.etree
+
+    from .optimize import SVG_NAMESPACE, XLINK_HREF
+
+    try:
+        doc = lxml.etree.fromstring(
+            svg.encode(),
+            parser=lxml.etree.ETCompatXMLParser(),
+        )
+    except lxml.etree.XMLSyntaxError:
+        return svg
+
+    glyphs = {
+        path.attrib["id"]: path
+        for path in doc.iter(f"{{{SVG_NAMESPACE}}}path")
+        if ("id" in path.attrib)
+        and (path.getparent().tag == f"{{{SVG_NAMESPACE}}}defs")
+    }
+
+    symbol_ids: dict[str, str] = {}
+    for use in doc.iter(f"{{{SVG_NAMESPACE}}}use"):
+        href = use.attrib.get("href", use.attrib.get(XLINK_HREF, ""))
+        glyph_id = href[1:]
+        if (not href.startswith("#")) or (glyph_id not in glyphs):
+            continue
+
+        if glyph_id not in symbol_ids:
+            symbol_ids[glyph_id] = store.add(glyphs[glyph_id], precision)
+        use.attrib.pop(XLINK_HREF, None)
+        use.attrib["href"] = f"{url}#{symbol_ids[glyph_id]}"
+
+    for glyph_id in symbol_ids:
+        defs = glyphs[glyph_id].getparent()
+        defs.remove(glyphs[glyph_id])
+        if len(defs) == 0:
+            defs.getparent().remove(defs)
+
+    lxml.etree.cleanup_namespaces(doc)
+    return lxml.etree.tostring(doc).decode()
+
+
+def svg_markup(svg: str, equation: str, settings: PelicanMathSettings) -> str:
+    if settings.output == "inline":
+        return svg
+
+    if settings.output == "sprite":
+        return sprite_svg(
+            svg,
+            sprite_store,
+            f"{settings.output_url}/{SPRITE_NAME}",
+            settings.builtin_precision,
+        )
+
+    url = f"{settings.output_url}/{svg_store.add(svg)}"
+    alt = html.escape(f"${equation}$")
+    if settings.output == "img":
+        return f'<img src="{url}" alt="{alt}">'
+    return f'<object type="image/svg+xml" data="{url}" aria-label="{alt}"></object>'
@@ -0,0 +1,26 @@
+// Long-running svgo worker for pelican-math-svg.
+//
+// Usage: node svgo_server.js <svgo package> <config as JSON> [config file]
+//
+// Every line on stdin is a JSON object {"svg": "..."}, every line written to
+// stdout is a JSON object {"data": "..."} or {"error": "..."}.
+const readline = require("readline");
+
+const svgo = require(process.argv[2]);
+let config = {};
+if (process.argv[4]) {
+    config = require(process.argv[4]);
+}
+config = Object.assign({}, config, JSON.parse(process.argv[3]));
+
+const lines = readline.createInterface({ input: process.stdin, terminal: false });
+lines.on("line", (line) => {
+    let response;
+    try {
+        const request = JSON.parse(line);
+        response = { data: svgo.optimize(request.svg, config).data };
+    } catch (error) {
+        response = { error: String(error) };
+    }
+    process.stdout.write(JSON.stringify(response) + "\n");
+});
@@ -0,0 +1,10 @@
+from __future__ import annotations
+
+from functools import cache
+import shutil
+
+
+@cache
+def which(name: str) -> str | None:
+    # PATH does not change during a build, look up every tool only once
+    return shutil.which(name)
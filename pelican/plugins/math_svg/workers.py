@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import atexit
+import importlib.resources
+import json
+import logging
+from pathlib import Path
+import subprocess
+import threading
+from typing import Any
+
+from .tools import which
+
+# svgo servers, keyed by their configuration
+_svgo_pools: dict[tuple[tuple[str, ...], bool], SvgoPool] = {}
+_svgo_lock = threading.Lock()
+
+
+class WorkerError(Exception):
+    pass
+
+
+def find_svgo_package() -> Path | None:
+    executable = which("svgo")
+    if executable is None:
+        return None
+
+    # the svgo executable lives in <package>/bin/
+    package = Path(executable).resolve().parent.parent
+    if not (package / "package.json").exists():
+        return None
+    return package
+
+
+def get_svgo_config(args: list[str]) -> dict[str, Any] | None:
+    config: dict[str, Any] = {}
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if arg == "--multipass":
+            config["multipass"] = True
+        elif arg in ("--precision", "-p") and index + 1 < len(args):
+            config["floatPrecision"] = int(args[index + 1])
+            index += 1
+        elif arg.startswith("--precision="):
+            config["floatPrecision"] = int(arg.split("=", 1)[1])
+        else:
+            # other options are only understood by the svgo CLI
+            return None
+        index += 1
+    return config
+
+
+class SvgoServer:
+    def __init__(self, package: Path, config: dict[str, Any], titles: bool):
+        self.package = package
+        self.config = config
+        self.titles = titles
+        self.process: subprocess.Popen | None = None
+
+    def command(self) -> list[str]:
+        files = importlib.resources.files("pelican.plugins.math_svg")
+        cmd = [
+            "node",
+            str(files / "svgo_server.js"),
+            str(self.package),
+            json.dumps(self.config),
+        ]
+        if self.titles:
+            cmd.append(str(files / "svgo.js"))
+        return cmd
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.command(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding="utf-8",
+            bufsize=1,
+        )
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.process = None
+
+    def request(self, code: str) -> dict[str, Any]:
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+
+        self.process.stdin.write(json.dumps({"svg": code}) + "\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise WorkerError("svgo server terminated")
+        return json.loads(line)
+
+    def optimize(self, code: str) -> str:
+        try:
+            response = self.request(code)
+        except (OSError, WorkerError):
+            # restart a crashed server once
+            self.close()
+            response = self.request(code)
+
+        if "error" in response:
+            raise WorkerError(response["error"])
+        return response["data"].strip()
+
+
+class SvgoPool:
+    # servers of one configuration, at most `size` of them are started and
+    # further callers wait for an idle one
+    def __init__(self):
+        self.idle: list[SvgoServer] = []
+        self.count = 0
+        self.condition = threading.Condition(_svgo_lock)
+
+    def acquire(
+        self,
+        package: Path,
+        config: dict[str, Any],
+        titles: bool,
+        size: int,
+    ) -> SvgoServer:
+        with self.condition:
+            while (not self.idle) and (self.count >= max(size, 1)):
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.count += 1
+        return SvgoServer(package, config, titles)
+
+    def release(self, server: SvgoServer, failed: bool = False):
+        if failed:
+            server.close()
+        with self.condition:
+            if failed:
+                self.count -= 1
+            else:
+                self.idle.append(server)
+            self.condition.notify()
+
+    def close_idle(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.count -= len(idle)
+        for server in idle:
+            server.close()
+
+
+def close_svgo_servers():
+    # stop the idle servers, e.g. at the end of a build, they are started
+    # again when needed
+    with _svgo_lock:
+        pools = list(_svgo_pools.values())
+    for pool in pools:
+        pool.close_idle()
+
+
+atexit.register(close_svgo_servers)
+
+
+def run_svgo_server(
+    code: str,
+    args: list[str],
+    titles: bool,
+    logger: logging.Logger = logging.getLogger(__name__ + ".run_svgo_server"),
+    size: int = 1,
+) -> str | None:
+    # size is the maximum number of servers of the configuration
+    config = get_svgo_config(args)
+    package = find_svgo_package()
+    if (config is None) or (package is None) or (which("node") is None):
+        return None
+
+    key = (tuple(args), titles)
+    with _svgo_lock:
+        pool = _svgo_pools.setdefault(key, SvgoPool())
+    server = pool.acquire(package, config, titles, size)
+
+    try:
+        logger.debug("Run svgo server")
+        result = server.optimize(code)
+        logger.debug("Finished running svgo server")
+    except (OSError, WorkerError) as e:
+        logger.warning(f"svgo server failed: {e}")
+        pool.release(server, failed=True)
+        return None
+    except BaseException:
+        # the slot of the server must never be lost
+        pool.release(server, failed=True)
+        raise
+
+    pool.release(server)
+    return result
+
+
+def run_scour_in_process(
+    code: str,
+    args: list[str],
+    logger: logging.Logger = logging.getLogger(__name__ + ".run_scour_in_process"),
+) -> str | None:
+    try:
+        from scour import scour
+    except ImportError:
+        return None
+
+    logger.debug("Run scour in-process")
+    options = scour.sanitizeOptions(scour.parse_args(args))
+    result = scour.scourString(code, options).strip()
+    logger.debug("Finished running scour in-process")
+    return result
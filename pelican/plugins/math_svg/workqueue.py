@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import socket
+import sqlite3
+import time
+from typing import NamedTuple
+
+from .database import hash_equation
+from .settings import PelicanMathSettings
+
+# seconds until the jobs of a worker that stopped renewing its leases are
+# handed out again
+LEASE = 300.0
+# jobs that were handed out this often are assumed to crash their workers
+MAX_ATTEMPTS = 3
+
+
+class QueuedJob(NamedTuple):
+    id: int
+    inline: bool
+    equations: list[str]
+
+
+class QueueStatus(NamedTuple):
+    pending: int
+    leased: int
+    abandoned: int
+    results: int
+    other_profiles: int
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    # Equations to render, shared by several hosts. The queue is an SQLite
+    # database on shared storage, every job is leased to a single worker
+    # until the worker finishes it or stops renewing the lease.
+    def __init__(self, path: Path, lease: float = LEASE):
+        self.lease = lease
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60.0, isolation_level=None)
+
+        # WAL relies on shared memory which is not available on network file
+        # systems, leases are only renewed every few seconds anyway
+        self.connection.execute("PRAGMA journal_mode = DELETE")
+
+        with self.transaction() as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "  id INTEGER PRIMARY KEY, "
+                "  inline INTEGER, "
+                "  profile TEXT, "
+                "  equations TEXT, "
+                "  worker TEXT, "
+                "  expires REAL, "
+                "  attempts INTEGER DEFAULT 0"
+                ")",
+            )
+            # renders of finished jobs until they are merged, failed renders
+            # are NULL
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "  hash TEXT, "
+                "  inline INTEGER, "
+                "  profile TEXT, "
+                "  equation TEXT, "
+                "  rendered TEXT, "
+                "  PRIMARY KEY (hash, inline, profile)"
+                ")",
+            )
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Cursor]:
+        # BEGIN IMMEDIATE takes the write lock up front, two workers can never
+        # lease the same job
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+
+    def push(
+        self,
+        jobs: list[tuple[bool, list[str]]],
+        settings: PelicanMathSettings,
+    ) -> int:
+        # Add jobs, equations that are already queued or rendered are skipped.
+        # Returns the number of added equations.
+        with self.transaction() as cursor:
+            # pushing again retries the jobs that crashed their workers
+            cursor.execute(
+                "UPDATE jobs SET worker = NULL, expires = NULL, attempts = 0 "
+                "WHERE profile = ? AND attempts >= ? AND expires < ?",
+                (settings.fingerprint, MAX_ATTEMPTS, time.time()),
+            )
+            queued = {
+                (bool(inline), equation)
+                for inline, equations in cursor.execute(
+                    "SELECT inline, equations FROM jobs WHERE profile = ?",
+                    (settings.fingerprint,),
+                )
+                for equation in json.loads(equations)
+            }
+            queued.update(
+                (bool(inline), equation)
+                for inline, equation in cursor.execute(
+                    "SELECT inline, equation FROM results WHERE profile = ?",
+                    (settings.fingerprint,),
+                )
+            )
+
+            added = 0
+            for inline, equations in jobs:
+                equations = [eq for eq in equations if (inline, eq) not in queued]
+                if not equations:
+                    continue
+                cursor.execute(
+                    "INSERT INTO jobs (inline, profile, equations) VALUES (?, ?, ?)",
+                    (inline, settings.fingerprint, json.dumps(equations)),
+                )
+                added += len(equations)
+        return added
+
+    def claim(self, worker: str, settings: PelicanMathSettings) -> QueuedJob | None:
+        # lease the next job that is not leased or whose lease expired
+        now = time.time()
+        with self.transaction() as cursor:
+            entry = cursor.execute(
+                "SELECT id, inline, equations FROM jobs "
+                "WHERE profile = ? AND (expires IS NULL OR expires < ?) "
+                "AND attempts < ? ORDER BY id LIMIT 1",
+                (settings.fingerprint, now, MAX_ATTEMPTS),
+            ).fetchone()
+            if entry is None:
+                return None
+            cursor.execute(
+                "UPDATE jobs SET worker = ?, expires = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (worker, now + self.lease, entry[0]),
+            )
+        return QueuedJob(entry[0], bool(entry[1]), json.loads(entry[2]))
+
+    def renew(self, worker: str, ids: list[int]) -> int:
+        # extend the leases of running jobs, returns the number of jobs that
+        # are still leased to the worker
+        with self.transaction() as cursor:
+            cursor.executemany(
+                "UPDATE jobs SET expires = ? WHERE id = ? AND worker = ?",
+                [(time.time() + self.lease, id, worker) for id in ids],
+            )
+            return cursor.rowcount
+
+    def finish(
+        self,
+        job: QueuedJob,
+        svgs: list[str | None],
+        settings: PelicanMathSettings,
+    ):
+        # Results are kept even if the lease expired in the meantime, another
+        # worker renders the same equations.
+        with self.transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                [
+                    (hash_equation(eq), job.inline, settings.fingerprint, eq, svg)
+                    for eq, svg in zip(job.equations, svgs)
+                ],
+            )
+            cursor.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+
+    def take_results(
+        self,
+        settings: PelicanMathSettings,
+    ) -> list[tuple[bool, str, str | None]]:
+        # remove and return the results of the settings profile
+        with self.transaction() as cursor:
+            results = [
+                (bool(entry[0]), entry[1], entry[2])
+                for entry in cursor.execute(
+                    "SELECT inline, equation, rendered FROM results WHERE profile = ?",
+                    (settings.fingerprint,),
+                ).fetchall()
+            ]
+            cursor.execute(
+                "DELETE FROM results WHERE profile = ?",
+                (settings.fingerprint,),
+            )
+        return results
+
+    def status(self, settings: PelicanMathSettings) -> QueueStatus:
+        now = time.time()
+        counts = [
+            self.connection.execute(query, parameters).fetchone()[0]
+            for query, parameters in [
+                (
+                    "SELECT COUNT(*) FROM jobs WHERE profile = ? "
+                    "AND (expires IS NULL OR expires < ?) AND attempts < ?",
+                    (settings.fingerprint, now, MAX_ATTEMPTS),
+                ),
+                (
+                    "SELECT COUNT(*) FROM jobs WHERE profile = ? AND expires >= ?",
+                    (settings.fingerprint, now),
+                ),
+                (
+                    "SELECT COUNT(*) FROM jobs WHERE profile = ? "
+                    "AND expires < ? AND attempts >= ?",
+                    (settings.fingerprint, now, MAX_ATTEMPTS),
+                ),
+                (
+                    "SELECT COUNT(*) FROM results WHERE profile = ?",
+                    (settings.fingerprint,),
+                ),
+                (
+                    "SELECT COUNT(*) FROM jobs WHERE profile != ?",
+                    (settings.fingerprint,),
+                ),
+            ]
+        ]
+        return QueueStatus(*counts)
@@ -24,6 +24,15 @@ def tests(c):
     c.run(f"{VENV}/bin/pytest", pty=True)
 
 
+@task
+def benchmark(c, output="benchmark.json"):
+    """Run the benchmarks and write the results to a JSON file"""
+    c.run(
+        f"{VENV}/bin/pytest benchmarks --benchmark-only --benchmark-json={output}",
+        pty=True,
+    )
+
+
 @task
 def black(c, check=False, diff=False):
     """Run Black auto-formatter, optionally with --check or --diff"""